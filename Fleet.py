@@ -0,0 +1,237 @@
+import argparse
+import concurrent.futures
+import http.client
+import json
+import logging
+import queue
+import time
+
+# Coordinator for sending commands to many IOTA-Pi workers concurrently. Each worker gets a pool of keep-alive
+# HTTP connections, and commands fan out over a thread pool with results aggregated per worker. Stops use their
+# own executor and always get a connection (a fresh one if all pooled ones are busy), so they never wait behind
+# long blocking moves.
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerConnectionPool:
+    """
+    Keep-alive HTTP connections to a single worker
+    """
+    def __init__(self, address, size=4, timeout=5.0):
+        host, _, port = address.replace('http://', '').rstrip('/').partition(':')
+        self.host, self.port = host, int(port or 8080)
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _get(self):
+        """
+        :return: (connection, True if it was reused from the pool)
+        """
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _put(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def warm(self):
+        """
+        Opens connection ahead of time, so first command does not pay for TCP setup
+        """
+        conn, _ = self._get()
+        conn.connect()
+        self._put(conn)
+
+    def request(self, method, path, body=None, timeout=None, content_type=None):
+        """
+        :param content_type: if given, body is sent as raw bytes of this type instead of as json
+        :return: (HTTP status, decoded body)
+        """
+        if content_type is not None:
+            data, headers = body, {'Content-Type': content_type}
+        else:
+            data = json.dumps(body).encode() if body is not None else None
+            headers = {'Content-Type': 'application/json'} if data is not None else {}
+        # A pooled connection the worker closed while idle fails before any response arrives - only then the
+        # request is known not to have been processed and is retried, once, on a new connection. Timeouts and
+        # failures of new connections are never retried, the worker may have acted on the request
+        conn, reused = self._get()
+        while True:
+            resp = None
+            try:
+                if timeout is not None:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+            except (BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if not reused or resp is not None:
+                    raise
+                logger.debug('Pooled connection to %s:%d was dropped, reconnecting', self.host, self.port)
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                reused = False
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+            else:
+                if conn.timeout != self.timeout:
+                    conn.timeout = self.timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(self.timeout)
+                if resp.will_close:
+                    conn.close()
+                else:
+                    self._put(conn)
+                if resp.getheader('Content-Type', '').startswith('application/json'):
+                    return resp.status, json.loads(payload)
+                if resp.getheader('Content-Type', '').startswith('application/octet-stream'):
+                    return resp.status, payload
+                return resp.status, payload.decode(errors='replace')
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class FleetCoordinator:
+    def __init__(self, workers, pool_size=4, timeout=5.0, max_parallel=32):
+        """
+        :param workers: dict of worker name to 'host:port' address (or list of addresses, used as names)
+        """
+        if not isinstance(workers, dict):
+            workers = {w: w for w in workers}
+        self.pools = {name: WorkerConnectionPool(addr, pool_size, timeout) for name, addr in workers.items()}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel,
+                                                              thread_name_prefix='fleet')
+        self.stop_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.pools), 1),
+                                                                   thread_name_prefix='fleet_stop')
+
+    def warm(self):
+        """
+        Pre-opens one connection per worker
+        :return: per worker results
+        """
+        return self._fanout({name: ('warm', None, None) for name in self.pools}, self.executor)
+
+    def _call(self, name, method, path, body, timeout):
+        t0 = time.perf_counter()
+        try:
+            if method == 'warm':
+                self.pools[name].warm()
+                status, data = 200, 'OK'
+            else:
+                status, data = self.pools[name].request(method, path, body, timeout)
+        except Exception as e:
+            return {'ok': False, 'status': None, 'body': str(e), 'elapsed': time.perf_counter() - t0}
+        return {'ok': 200 <= status < 300, 'status': status, 'body': data, 'elapsed': time.perf_counter() - t0}
+
+    def _fanout(self, calls, executor, timeout=None):
+        """
+        :param calls: dict of worker name to (method, path, body) or list of those
+        :return: dict of worker name to result dict (or list of result dicts)
+        """
+        futures = {}
+        for name, call in calls.items():
+            if name not in self.pools:
+                raise KeyError('Unknown worker {}'.format(name))
+            for i, (method, path, body) in enumerate(call if isinstance(call, list) else [call]):
+                futures[(name, i)] = executor.submit(self._call, name, method, path, body, timeout)
+        results = {}
+        for name, call in calls.items():
+            if isinstance(call, list):
+                results[name] = [futures[(name, i)].result() for i in range(len(call))]
+            else:
+                results[name] = futures[(name, 0)].result()
+        return results
+
+    def move(self, moves, timeout=None):
+        """
+        :param moves: dict of worker name to /move/ body (uuid, dir, steps, optional block/force), or list of
+                      bodies - commands for one worker are sent concurrently and queue there in arrival order
+        """
+        calls = {name: [('POST', '/move/', m) for m in body] if isinstance(body, list) else ('POST', '/move/', body)
+                 for name, body in moves.items()}
+        return self._fanout(calls, self.executor, timeout)
+
+    def synchronized_move(self, moves, lead=0.5, timeout=None):
+        """
+        Sends moves with common absolute start time, lead s from now - workers pre-plan and arm them,
+        releasing first pulses together (given synchronized clocks)
+        :return: (start time, per worker results)
+        """
+        start_at = time.time() + lead
+        stamped = {name: [dict(m, start_at=start_at) for m in body] if isinstance(body, list)
+                   else dict(body, start_at=start_at) for name, body in moves.items()}
+        return start_at, self.move(stamped, timeout)
+
+    def enable(self, targets, force=False):
+        """
+        :param targets: dict of worker name to motor uuid or list of uuids
+        """
+        return self._per_motor('/enable/', targets, {'force': 1} if force else {})
+
+    def disable(self, targets):
+        return self._per_motor('/disable/', targets, {})
+
+    def _per_motor(self, path, targets, extra):
+        calls = {}
+        for name, uuids in targets.items():
+            uuids = uuids if isinstance(uuids, list) else [uuids]
+            calls[name] = [('POST', path, dict(extra, uuid=u)) for u in uuids]
+        return self._fanout(calls, self.executor)
+
+    def stop(self, workers=None):
+        """
+        Stops all motors on given (default all) workers, on the priority executor
+        """
+        names = workers or list(self.pools)
+        return self._fanout({name: ('POST', '/stop/', {}) for name in names}, self.stop_executor)
+
+    def estop(self, clear=False, workers=None):
+        names = workers or list(self.pools)
+        body = {'clear': 1} if clear else {}
+        return self._fanout({name: ('POST', '/estop/', body) for name in names}, self.stop_executor)
+
+    def status(self, workers=None):
+        names = workers or list(self.pools)
+        return self._fanout({name: ('GET', '/motors/', None) for name in names}, self.executor)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.stop_executor.shutdown(wait=False)
+        for pool in self.pools.values():
+            pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IOTAPi fleet command fan-out")
+    parser.add_argument("command", choices=['status', 'stop', 'estop', 'estop-clear'])
+    parser.add_argument("workers", nargs='+', help="worker addresses as host:port")
+    args = parser.parse_args()
+
+    fleet = FleetCoordinator(args.workers)
+    try:
+        if args.command == 'status':
+            results = fleet.status()
+        elif args.command == 'stop':
+            results = fleet.stop()
+        else:
+            results = fleet.estop(clear=args.command == 'estop-clear')
+        print(json.dumps(results, indent=2))
+    finally:
+        fleet.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import logging
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+import Fleet
+
+# Fleet-wide status cache. One poller hits every worker's /motors/ at a fixed rate, and any number of dashboard
+# clients read the cached table from here, so load on the workers does not grow with the number of viewers.
+# Every entry carries the table version at which it last changed - clients pass back the version they have
+# and get only what changed since, optionally long-polling until something does.
+#
+# Entries are keyed 'worker/uuid' for motors and 'worker' for worker reachability.
+
+logger = logging.getLogger(__name__)
+
+MAX_TOMBSTONES = 1000
+
+
+class StatusAggregator:
+    def __init__(self, fleet, interval=0.5):
+        self.fleet = fleet
+        self.interval = interval
+        self.version = 0
+        self.floor = 0          # oldest version deltas can be computed from
+        self.table = {}
+        self.changed_at = {}
+        self.removed_at = {}
+        self.cond = threading.Condition()
+        self._stopevt = threading.Event()
+        self._thread = None
+
+    def _update(self, key, value):
+        if self.table.get(key) != value:
+            self.version += 1
+            self.table[key] = value
+            self.changed_at[key] = self.version
+            self.removed_at.pop(key, None)
+            return True
+        return False
+
+    def _remove(self, key):
+        self.version += 1
+        del self.table[key]
+        del self.changed_at[key]
+        self.removed_at[key] = self.version
+        if len(self.removed_at) > MAX_TOMBSTONES:
+            oldest = min(self.removed_at, key=self.removed_at.get)
+            self.floor = self.removed_at.pop(oldest)
+
+    def poll_once(self):
+        results = self.fleet.status()
+        with self.cond:
+            start = self.version
+            for worker, res in results.items():
+                if res['ok'] and isinstance(res['body'], dict):
+                    self._update(worker, {'reachable': True, 'error': None})
+                    seen = set()
+                    for uuid, state in res['body'].items():
+                        key = '{}/{}'.format(worker, uuid)
+                        seen.add(key)
+                        self._update(key, state)
+                    for key in [k for k in self.table if k.startswith(worker + '/') and k not in seen]:
+                        self._remove(key)
+                else:
+                    # Keep last known motor states, only flag worker itself
+                    self._update(worker, {'reachable': False, 'error': str(res['body'])})
+            if self.version != start:
+                self.cond.notify_all()
+
+    def _run(self):
+        logger.info('Status poller starting, %d workers every %f s', len(self.fleet.pools), self.interval)
+        while not self._stopevt.is_set():
+            t0 = time.monotonic()
+            try:
+                self.poll_once()
+            except Exception:
+                logger.exception('Status poll failed')
+            self._stopevt.wait(max(0.0, self.interval - (time.monotonic() - t0)))
+
+    def start(self):
+        self._thread = threading.Thread(name='status_poller', target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopevt.set()
+
+    def snapshot(self, since=None, wait=0.0):
+        """
+        :param since: version client already has, None for full table
+        :param wait: s to block for changes when there are none yet
+        :return: dict with version and either full table or changed entries and removed keys since version
+        """
+        with self.cond:
+            if since is not None and wait > 0:
+                self.cond.wait_for(lambda: self.version > since, wait)
+            if since is None or since < self.floor or since > self.version:
+                return {'version': self.version, 'full': True, 'entries': dict(self.table)}
+            return {'version': self.version, 'full': False,
+                    'entries': {k: self.table[k] for k, v in self.changed_at.items() if v > since},
+                    'removed': [k for k, v in self.removed_at.items() if v > since]}
+
+
+app = Flask(__name__)
+aggregator = None
+
+
+@app.route("/fleet/", strict_slashes=False)
+def web_fleet():
+    """
+    Fleet state table - full, or delta with ?since=<version>, optionally long-polling with &wait=<s>
+    """
+    try:
+        since = request.args.get('since')
+        since = int(since) if since is not None else None
+        wait = min(float(request.args.get('wait', 0)), 30.0)
+    except ValueError:
+        return 'Bad since/wait parameter', 400
+    return jsonify(aggregator.snapshot(since, wait))
+
+
+def main():
+    global aggregator
+    parser = argparse.ArgumentParser(description="IOTAPi fleet status aggregator")
+    parser.add_argument("workers", nargs='+', help="worker addresses as host:port")
+    parser.add_argument("--interval", help="worker poll interval, s", type=float, default=0.5)
+    parser.add_argument("--port", help="port to serve fleet table on", type=int, default=8090)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    fleet = Fleet.FleetCoordinator(args.workers, pool_size=1)
+    aggregator = StatusAggregator(fleet, args.interval)
+    aggregator.start()
+    try:
+        app.run(host='0.0.0.0', port=args.port, use_reloader=False, debug=False, threaded=True)
+    finally:
+        aggregator.stop()
+        fleet.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,27 @@
-import collections, sys, os, logging, time, threading
-import Util
+import collections, contextlib, sys, os, logging, time, threading
+import Metrics, PositionStore, StateBlock, Supervisor, Util
 
 logger = logging.getLogger(__name__)
 motors = collections.OrderedDict()
 config_raw = None
+config_path = None
 lockout = False # Currently used for blocking actual output changes during testing
 
 movelock = threading.Lock()
+reserved_pins = {}  # pin -> owner, for outputs claimed outside of motor config while in use (scan trigger)
 
-# Test if we are on actual RPi
+queue_depth = Metrics.Gauge('iotapi_queue_depth', 'Commands waiting in motor queue', ['motor'],
+                            func=lambda: {(m.uuid,): m.queue.qsize() for m in motors.values()})
+
+# Test if we are on actual RPi, otherwise fall back to in-memory stand-in for constants and cleanup calls.
+# IOTAPI_SIM=1 forces the stand-in even on a Pi, for load testing and replays
 try:
+    if os.environ.get('IOTAPI_SIM') == '1':
+        raise ImportError('Simulated GPIO requested')
     import RPi.GPIO as GPIO
     isRPi = True
 except ImportError:
+    import SimGPIO as GPIO
     isRPi = False
 
 # Setup some constants
@@ -35,6 +44,50 @@ def addMotor(mt):
     logger.debug("Added motor %s (%s) to the control list", mt.uuid, mt.full_name)
 
 
+# Holds the move lock, recording how long the owner had to wait for it
+@contextlib.contextmanager
+def hold_movelock(owner):
+    t0 = time.perf_counter()
+    with movelock:
+        Metrics.movelock_wait.observe(time.perf_counter() - t0, owner)
+        yield
+
+
+def removeMotor(mt):
+    if motors.get(mt.uuid) is mt:
+        del motors[mt.uuid]
+        StateBlock.unregister(mt)
+        logger.debug("Removed motor %s (%s) from the control list", mt.uuid, mt.full_name)
+
+
+# Pins of a motor
+def motor_pins(mt):
+    return {p for p in [mt.PIN_DIR, mt.PIN_STEP, mt.PIN_ENABLE, mt.PIN_SLEEP, mt.PIN_LIM_UP, mt.PIN_LIM_DN,
+                        mt.PIN_TRIGGER] + mt.PINS_MICROSTEP if p is not None}
+
+
+# Pins claimed by configured motors and reserved ones
+def used_pins():
+    return {p for mt in motors.values() for p in motor_pins(mt)} | set(reserved_pins)
+
+
+def reserve_pin(pin, owner):
+    if pin in used_pins():
+        raise ValueError('Pin {} is already in use'.format(pin))
+    reserved_pins[pin] = owner
+    logger.debug('Pin %s reserved by %s', pin, owner)
+
+
+def release_pin(pin):
+    reserved_pins.pop(pin, None)
+
+
+# Keeps control list in uuid order, as after initial load
+def sort_motors():
+    for uuid in sorted(motors.keys()):
+        motors.move_to_end(uuid)
+
+
 # Runs actual initialization for all declared motors
 def init_motors():
     if (isRPi):
@@ -159,6 +212,7 @@ def test1():
 
 
 def gpio_summary():
+    Metrics.gpio_summary_calls.inc()
     if isRPi:
         GPIO.setmode(GPIO.BCM)
         summary = collections.OrderedDict()
@@ -186,6 +240,9 @@ def shutdown():
         logger.info('Shutting down motors')
         for mt in motors.values():
             mt.shutdown()
+        Supervisor.shutdown()
+        PositionStore.close_store()
+        StateBlock.close_block()
         logger.info('GPIO cleanup on shutdown')
         GPIO.cleanup()
         logger.info('Finally, setting not-enable pins high')
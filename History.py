@@ -0,0 +1,229 @@
+import array
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import Metrics
+
+# Queryable history of executed motor commands and interlock transitions, kept in a local SQLite database in
+# WAL mode. Motor threads only push a tuple onto a bounded queue, a writer thread inserts them in batches of up
+# to BATCH_SIZE or FLUSH_INTERVAL worth of entries per transaction - if it falls behind, entries are dropped
+# (and counted) rather than slowing motion down. Queries and pruning use their own connections, which WAL lets
+# run alongside the writer.
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0        # s the writer collects entries for before inserting
+PRUNE_INTERVAL = 3600.0     # s between retention prunes done by the writer
+MAX_PAGE = 1000
+BUSY_TIMEOUT = 5.0          # s
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY, motor INTEGER NOT NULL, cmd TEXT NOT NULL, params TEXT,
+    start REAL NOT NULL, end REAL NOT NULL, steps INTEGER NOT NULL, result INTEGER);
+CREATE INDEX IF NOT EXISTS commands_motor_start ON commands (motor, start);
+CREATE INDEX IF NOT EXISTS commands_start ON commands (start);
+CREATE TABLE IF NOT EXISTS interlocks (
+    id INTEGER PRIMARY KEY, motor INTEGER NOT NULL, time REAL NOT NULL, state INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS interlocks_motor_time ON interlocks (motor, time);
+CREATE INDEX IF NOT EXISTS interlocks_time ON interlocks (time);
+"""
+
+# Entry kinds
+COMMAND = 0
+INTERLOCK = 1
+
+dropped = Metrics.Counter('iotapi_history_dropped_total', 'History entries lost due to writer backlog')
+
+_queue = None
+_thread = None
+_path = None
+_retention = None
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def start(path, retention=None):
+    """
+    Opens history database, creating it if missing, and starts the writer
+    :param retention: age in s after which the writer prunes entries, None keeps everything
+    """
+    global _queue, _thread, _path, _retention
+    conn = _connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    conn.close()
+    _path, _retention = path, retention
+    _queue = queue.Queue(maxsize=QUEUE_SIZE)
+    _thread = threading.Thread(name='history', target=_run, args=(path, _queue))
+    _thread.daemon = True
+    _thread.start()
+    logger.info('Recording history to %s', path)
+
+
+def stop():
+    global _queue, _thread
+    q, thread = _queue, _thread
+    _queue = _thread = None
+    if q is not None:
+        q.put(None)
+        thread.join(5.0)
+
+
+def enabled():
+    return _queue is not None
+
+
+# Command parameters as stored - bulky ones (trigger lists, trajectory buffers) reduced to a summary
+def _params(msg):
+    out = []
+    for p in msg[1:]:
+        if p is None or isinstance(p, (bool, int, float, str)):
+            out.append(p)
+        elif isinstance(p, (list, tuple, array.array)):
+            out.append({'count': len(p)})
+        else:
+            out.append(type(p).__name__)
+    return json.dumps(out)
+
+
+def _put(item):
+    q = _queue
+    if q is None:
+        return
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        dropped.inc()
+
+
+def record_command(uuid, msg, start, end, steps, result):
+    """
+    :param start: wall time command execution started
+    :param end: wall time it finished
+    :param steps: step pulses issued, take-up and reversals included - not the net displacement
+    :param result: result code, None if command was ignored or failed
+    """
+    if _queue is not None:
+        _put((COMMAND, (uuid, msg[0], _params(msg), start, end, steps, result)))
+
+
+def record_interlock(uuid, state):
+    if _queue is not None:
+        _put((INTERLOCK, (uuid, time.time(), state)))
+
+
+def _run(path, q):
+    conn = _connect(path)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    n = 0
+    last_prune = time.monotonic()
+    running = True
+    while running:
+        try:
+            item = q.get(timeout=PRUNE_INTERVAL)
+        except queue.Empty:
+            item = ()
+        batch = {COMMAND: [], INTERLOCK: []}
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while item is not None:
+            if item:
+                batch[item[0]].append(item[1])
+            if sum(len(v) for v in batch.values()) >= BATCH_SIZE:
+                break
+            try:
+                item = q.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        if item is None:
+            running = False
+        try:
+            with conn:
+                conn.executemany('INSERT INTO commands (motor, cmd, params, start, end, steps, result) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)', batch[COMMAND])
+                conn.executemany('INSERT INTO interlocks (motor, time, state) VALUES (?, ?, ?)', batch[INTERLOCK])
+            n += len(batch[COMMAND]) + len(batch[INTERLOCK])
+        except sqlite3.Error:
+            logger.exception('History batch of %d entries lost', len(batch[COMMAND]) + len(batch[INTERLOCK]))
+            dropped.inc(amount=len(batch[COMMAND]) + len(batch[INTERLOCK]))
+        if _retention is not None and time.monotonic() - last_prune > PRUNE_INTERVAL:
+            last_prune = time.monotonic()
+            try:
+                _prune(conn, _retention)
+            except sqlite3.Error:
+                logger.exception('History pruning failed')
+    conn.close()
+    logger.info('History writer stopped after %d entries', n)
+
+
+def _prune(conn, older_than):
+    cutoff = time.time() - older_than
+    with conn:
+        commands = conn.execute('DELETE FROM commands WHERE start < ?', (cutoff,)).rowcount
+        interlocks = conn.execute('DELETE FROM interlocks WHERE time < ?', (cutoff,)).rowcount
+    logger.info('Pruned %d commands and %d interlock events older than %s s', commands, interlocks, older_than)
+    return {'commands': commands, 'interlocks': interlocks}
+
+
+def prune(older_than=None):
+    """
+    Deletes entries older than given age in s, by default the retention history was started with
+    :return: dict of deleted row counts per table
+    """
+    older_than = older_than if older_than is not None else _retention
+    if older_than is None:
+        raise ValueError('No retention given')
+    conn = _connect(_path)
+    try:
+        return _prune(conn, older_than)
+    finally:
+        conn.close()
+
+
+def _page(table, column, uuid, since, until, before, limit, extra=None):
+    where, args = [], []
+    for clause, value in (('motor = ?', uuid), (column + ' >= ?', since), (column + ' < ?', until),
+                          ('id < ?', before)) + ((extra,) if extra else ()):
+        if value is not None:
+            where.append(clause)
+            args.append(value)
+    sql = 'SELECT * FROM {}{} ORDER BY id DESC LIMIT ?'.format(table, ' WHERE ' + ' AND '.join(where)
+                                                              if where else '')
+    conn = _connect(_path)
+    try:
+        rows = [dict(r) for r in conn.execute(sql, args + [min(int(limit), MAX_PAGE)])]
+    finally:
+        conn.close()
+    return rows
+
+
+def commands(uuid=None, since=None, until=None, cmd=None, before=None, limit=100):
+    """
+    Pages through executed commands, newest first
+    :param since: wall time, inclusive
+    :param until: wall time, exclusive
+    :param before: only entries with id below this, for fetching the next page
+    :return: list of row dicts, params decoded
+    """
+    rows = _page('commands', 'start', uuid, since, until, before, limit, ('cmd = ?', cmd))
+    for r in rows:
+        r['params'] = json.loads(r['params']) if r['params'] else None
+    return rows
+
+
+def interlocks(uuid=None, since=None, until=None, before=None, limit=100):
+    """
+    Pages through interlock transitions, newest first
+    :return: list of row dicts
+    """
+    return _page('interlocks', 'time', uuid, since, until, before, limit)
@@ -0,0 +1,163 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+
+import Fleet
+import Replay
+
+# Load test measuring how /motors/ polling and command traffic interfere with step timing. A worker is started
+# on the simulated GPIO backend, then for every poller count in the sweep the motors are kept moving by command
+# senders while pollers hammer /motors/. Each level reports HTTP latency percentiles and throughput, worker
+# thread count and per step lateness against the planned profile, tagged with commit and label so reports from
+# different commits or serving modes can be compared.
+
+logger = logging.getLogger(__name__)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _poller(address, interval, stopevt, out):
+    pool = Fleet.WorkerConnectionPool(address, size=1, timeout=30.0)
+    while not stopevt.is_set():
+        t0 = time.perf_counter()
+        try:
+            status, _ = pool.request('GET', '/motors/')
+        except Exception:
+            status = None
+        out.append((time.perf_counter() - t0, status))
+        if interval:
+            stopevt.wait(interval)
+    pool.close()
+
+
+def _sender(address, uuid, steps, stopevt, out):
+    pool = Fleet.WorkerConnectionPool(address, size=1, timeout=60.0)
+    direction = 1
+    while not stopevt.is_set():
+        t0 = time.perf_counter()
+        try:
+            status, body = pool.request('POST', '/move/', {'uuid': uuid, 'dir': direction, 'steps': steps,
+                                                            'block': 1})
+        except Exception:
+            status, body = None, None
+        out.append((time.perf_counter() - t0, status if body != 'Failed' else 409))
+        direction ^= 1
+    pool.close()
+
+
+def _sampler(pool, stopevt, out):
+    while not stopevt.wait(0.5):
+        try:
+            status, text = pool.request('GET', '/metrics')
+        except Exception:
+            continue
+        for line in text.splitlines():
+            if line.startswith('iotapi_threads '):
+                out.append(float(line.split()[1]))
+
+
+def _summary(samples, duration):
+    stats = Replay.percentiles([lat for lat, _ in samples])
+    stats.update({'throughput': len(samples) / duration,
+                  'errors': sum(1 for _, st in samples if st is None or st >= 400)})
+    return stats
+
+
+def run_level(address, uuids, pollers, senders, duration, steps, poll_interval):
+    """
+    Runs one load level against worker
+    :return: report dict of the level
+    """
+    control = Fleet.WorkerConnectionPool(address, size=2, timeout=60.0)
+    control.request('GET', '/trace/?format=bin&clear=1')
+    stopevt = threading.Event()
+    polls, commands, threads_seen = [], [], []
+    workers = [threading.Thread(target=_poller, args=(address, poll_interval, stopevt, polls))
+               for _ in range(pollers)]
+    workers += [threading.Thread(target=_sender, args=(address, uuids[n % len(uuids)], steps, stopevt, commands))
+                for n in range(senders)]
+    workers.append(threading.Thread(target=_sampler, args=(control, stopevt, threads_seen)))
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    time.sleep(duration)
+    stopevt.set()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - t0
+    status, trace_data = control.request('GET', '/trace/?format=bin')
+    lateness = Replay.step_timing(control, trace_data) if status == 200 else {}
+    control.close()
+    return {'pollers': pollers, 'senders': senders, 'duration': elapsed,
+            'poll': _summary(polls, elapsed), 'command': _summary(commands, elapsed),
+            'threads': {'max': max(threads_seen), 'mean': sum(threads_seen) / len(threads_seen)}
+            if threads_seen else {},
+            'step_lateness': lateness}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IOTAPi poll load vs step timing test")
+    parser.add_argument("config", help="worker config, run on simulated GPIO")
+    parser.add_argument("--pollers", help="comma separated poller counts to sweep", default="0,1,4,16")
+    parser.add_argument("--senders", help="concurrent blocking move senders", type=int, default=1)
+    parser.add_argument("--duration", help="s per load level", type=float, default=10.0)
+    parser.add_argument("--steps", help="steps per move", type=int, default=2000)
+    parser.add_argument("--poll-interval", help="s between polls of one poller (0 = back to back)", type=float,
+                        default=0.0)
+    parser.add_argument("--port", help="port of spawned worker", type=int, default=18098)
+    parser.add_argument("--label", help="serving mode or other tag stored in report", default='')
+    parser.add_argument("--json", help="write report to file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    proc = Replay.spawn_worker(args.config, args.port)
+    address = '127.0.0.1:{}'.format(args.port)
+    levels = []
+    try:
+        control = Fleet.WorkerConnectionPool(address, size=1, timeout=30.0)
+        status, motors = control.request('GET', '/motors/')
+        uuids = sorted(int(u) for u in motors)
+        for uuid in uuids:
+            control.request('POST', '/enable/', {'uuid': uuid})
+        control.close()
+        for pollers in [int(n) for n in args.pollers.split(',')]:
+            logger.info('Level - %d pollers, %d senders, %g s', pollers, args.senders, args.duration)
+            levels.append(run_level(address, uuids, pollers, args.senders, args.duration, args.steps,
+                                    args.poll_interval))
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+    report = {'commit': _commit(), 'label': args.label, 'python': platform.python_version(),
+              'time': time.time(), 'params': vars(args), 'levels': levels}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print('commit {} {}'.format(report['commit'], args.label))
+    print('{:>7s} {:>9s} {:>9s} {:>9s} {:>8s} {:>9s} {:>7s} {:>10s} {:>10s}'.format(
+        'pollers', 'poll/s', 'p50 ms', 'p99 ms', 'cmd/s', 'cmd p99', 'threads', 'late p99', 'late max'))
+    for lv in levels:
+        late = [r for r in lv['step_lateness'].values()]
+        late_p99 = max(r['p99'] for r in late) * 1e3 if late else float('nan')
+        late_max = max(r['max'] for r in late) * 1e3 if late else float('nan')
+        poll, cmd = lv['poll'], lv['command']
+        print('{:7d} {:9.1f} {:9.2f} {:9.2f} {:8.2f} {:9.1f} {:7.0f} {:10.3f} {:10.3f}'.format(
+            lv['pollers'], poll['throughput'], poll.get('p50', float('nan')) * 1e3,
+            poll.get('p99', float('nan')) * 1e3, cmd['throughput'], cmd.get('p99', float('nan')) * 1e3,
+            lv['threads'].get('max', float('nan')), late_p99, late_max))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import traceback
+
+
+# Log sink intended for SD-card backed workers - records are kept in memory and written out in large blocks,
+# either periodically, once enough data accumulates, or immediately for high severity records.
+# Full segments are rotated to timestamped files, gzipped by a background thread, and the oldest segments are
+# deleted once total on-disk size goes over the cap.
+class BatchedRotatingHandler(logging.Handler):
+    def __init__(self, filename, flush_interval=10.0, flush_bytes=65536, flush_level=logging.ERROR,
+                 max_bytes=4194304, max_total_bytes=33554432, compress=True, encoding='utf8'):
+        logging.Handler.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.flush_level = flush_level
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.compress = compress
+        self.encoding = encoding
+
+        self._buf = []
+        self._buf_bytes = 0
+        self._pending = []  # rotated segments awaiting compression
+        self._stream = open(self.filename, 'ab')
+        self._size = self._stream.tell()
+
+        self._running = True
+        self._wake = threading.Event()
+        self._thread = threading.Thread(name='log_flush_{}'.format(os.path.basename(filename)),
+                                        target=self._background, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + '\n').encode(self.encoding)
+            with self.lock:
+                self._buf.append(data)
+                self._buf_bytes += len(data)
+                if self._buf_bytes >= self.flush_bytes or record.levelno >= self.flush_level:
+                    self._write_buffer()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            self._write_buffer()
+
+    # Must be called with handler lock held
+    def _write_buffer(self):
+        if not self._buf or self._stream is None:
+            return
+        block = b''.join(self._buf)
+        self._buf = []
+        self._buf_bytes = 0
+        self._stream.write(block)
+        self._stream.flush()
+        self._size += len(block)
+        if self._size >= self.max_bytes:
+            self._rotate()
+
+    # Must be called with handler lock held
+    def _rotate(self):
+        self._stream.close()
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        target = '{}.{}'.format(self.filename, stamp)
+        n = 0
+        while os.path.exists(target) or os.path.exists(target + '.gz'):
+            n += 1
+            target = '{}.{}.{}'.format(self.filename, stamp, n)
+        os.rename(self.filename, target)
+        self._pending.append(target)
+        self._stream = open(self.filename, 'ab')
+        self._size = 0
+        self._wake.set()
+
+    def _background(self):
+        while self._running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                self._process_segments()
+            except Exception:
+                # Logging from inside the log sink would recurse, so report the old fashioned way
+                traceback.print_exc(file=sys.stderr)
+
+    def _process_segments(self):
+        with self.lock:
+            pending, self._pending = self._pending, []
+        for path in pending:
+            if self.compress:
+                with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1048576)
+                os.remove(path)
+        if pending:
+            self._enforce_cap()
+
+    # Removes oldest rotated segments until everything (including live file) fits within the cap
+    def _enforce_cap(self):
+        segments = sorted(glob.glob(glob.escape(self.filename) + '.*'), key=os.path.getmtime)
+        total = self._size + sum(os.path.getsize(p) for p in segments)
+        while segments and total > self.max_total_bytes:
+            path = segments.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def close(self):
+        self._running = False
+        self._wake.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5.0)
+        with self.lock:
+            self._write_buffer()
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+        self._process_segments()
+        logging.Handler.close(self)
+
+
+# Compact one-object-per-line format for machine ingestion
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'t': round(record.created, 6),
+                 'lvl': record.levelname,
+                 'name': record.name,
+                 'thr': record.threadName,
+                 'line': record.lineno,
+                 'msg': record.getMessage()}
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'))
@@ -1,53 +1,146 @@
 import argparse
+import collections
+import itertools
 import logging.config
 import json
 import sys
 import os
 import signal
 
-import Util, GPIOMgr
+import Util, GPIOMgr, History, PositionStore, Recorder, StateBlock
 import Webserver
 from Stepper import Stepper
 
 logger = logging.getLogger(__name__)
 num_responses = 0
 
+class ConfigException(Exception):
+    pass
+
+
+def build_motor(name, motor):
+    return Stepper(motor['uuid'],name,motor['friendly_name'],motor['pin_direction'],motor['pin_step'],
+                   motor['pin_enable'],motor['pin_sleep'],motor['pin_lim_up'],motor['pin_lim_dn'],
+                   motor['lim_up_state'],motor['lim_dn_state'],motor['step_size'],
+                   motor['step_pulse_time'],motor['step_delay_time'],
+                   motor['autoenable'],motor['autodisable'],
+                   motor['jerk'], motor['velocity'], motor['acceleration'], motor.get('pin_trigger'),
+                   motor.get('soft_limit_margin', 0), motor.get('microstep'),
+                   motor.get('backlash', 0), motor.get('waveform'),
+                   motor.get('start_speed'))
+
+
+# Reads and validates config, returning it with (not yet registered) motor objects keyed by name
+def parse_config(config_path):
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    if config['compatible_with'] != Util.VERSION_MAJOR:
+        raise ConfigException("Incompatible config specified")
+    motors = collections.OrderedDict()
+    for k, motor in sorted((config.get('motors') or {}).items(), key=lambda t: t[1]['uuid']):
+        motors[k] = build_motor(k, motor)
+    for a, b in itertools.combinations(motors.values(), 2):
+        if a.uuid == b.uuid or a.full_name == b.full_name:
+            raise ConfigException("Motors {} and {} share name attributes".format(a.name, b.name))
+    return config, motors
+
+
 def load_config(config_path):
     try:
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-            if config['compatible_with'] != Util.VERSION_MAJOR:
-                logger.fatal("Incompatible config specified - aborting")
-                sys.exit(3)
-            if config.get('motors'):
-                for k, motor in sorted(config['motors'].items(), key=lambda t: t[1]['uuid']):
-                    mt = Stepper(motor['uuid'],k,motor['friendly_name'],motor['pin_direction'],motor['pin_step'],
-                                 motor['pin_enable'],motor['pin_sleep'],motor['pin_lim_up'],motor['pin_lim_dn'],
-                                 motor['lim_up_state'],motor['lim_dn_state'],motor['step_size'],
-                                 motor['step_pulse_time'],motor['step_delay_time'],
-                                 motor['autoenable'],motor['autodisable'],
-                                 motor['jerk'], motor['velocity'], motor['acceleration'])
-                    GPIOMgr.addMotor(mt)
-            else:
-                logger.warning('No motors found in config file!')
-            GPIOMgr.config_raw = config
+        config, motors = parse_config(config_path)
+        if motors:
+            for mt in motors.values():
+                GPIOMgr.addMotor(mt)
+        else:
+            logger.warning('No motors found in config file!')
+        GPIOMgr.config_raw = config
+        GPIOMgr.config_path = config_path
+    except ConfigException as e:
+        logger.fatal("%s - aborting", e)
+        sys.exit(3)
     except SystemExit:
         raise
     except Exception as e:
         logger.exception("Exception processing config file - aborting")
         sys.exit(4)
 
+
+def reload_config():
+    """
+    Re-reads current config file and rebuilds only motors whose settings changed, leaving others running
+    :return: dict of motor name to action taken
+    """
+    config, motors = parse_config(GPIOMgr.config_path)
+    old_cfg = (GPIOMgr.config_raw or {}).get('motors') or {}
+    new_cfg = config.get('motors') or {}
+    current = {mt.name: mt for mt in GPIOMgr.motors.values()}
+    actions = collections.OrderedDict()
+    for name in sorted(set(old_cfg) | set(new_cfg)):
+        if name not in new_cfg:
+            actions[name] = 'removed'
+        elif name not in old_cfg:
+            actions[name] = 'added'
+        elif new_cfg[name] != old_cfg[name]:
+            actions[name] = 'rebuilt'
+        else:
+            actions[name] = 'unchanged'
+
+    # Check everything up front, so that reload is either applied fully or not at all
+    for name, action in actions.items():
+        mt = current.get(name)
+        if action in ('removed', 'rebuilt') and mt is not None and (mt.is_moving() or getattr(mt, 'busy', False)
+                                                                     or not mt.queue.empty()):
+            raise ConfigException("Motor {} is busy, can not reinitialize".format(name))
+    final = [current[n] for n, a in actions.items() if a == 'unchanged' and n in current] + \
+            [motors[n] for n, a in actions.items() if a in ('added', 'rebuilt')]
+    for a, b in itertools.combinations(final, 2):
+        if a.uuid == b.uuid or a.full_name == b.full_name:
+            raise ConfigException("Motors {} and {} share name attributes".format(a.name, b.name))
+    for mt in final:
+        clash = GPIOMgr.motor_pins(mt) & set(GPIOMgr.reserved_pins)
+        if clash:
+            raise ConfigException("Motor {} pins {} are in use by {}".format(
+                mt.name, sorted(clash), ', '.join(sorted({GPIOMgr.reserved_pins[p] for p in clash}))))
+
+    for name, action in actions.items():
+        mt = current.get(name)
+        if action in ('removed', 'rebuilt') and mt is not None:
+            logger.info('Reload - shutting down motor %s', mt.names())
+            mt._disable_direct()
+            mt.shutdown()
+            GPIOMgr.removeMotor(mt)
+    for name, action in actions.items():
+        if action in ('added', 'rebuilt'):
+            mt = motors[name]
+            logger.info('Reload - initializing motor %s', mt.names())
+            GPIOMgr.addMotor(mt)
+            mt.initialize(RPi=GPIOMgr.isRPi)
+    GPIOMgr.sort_motors()
+    GPIOMgr.config_raw = config
+    logger.info('Config reloaded: %s', dict(actions))
+    return actions
+
+
 def main():
     try:
         parser = argparse.ArgumentParser(description="IOTAPi client software")
         parser.add_argument("config", help="config file relative path")
         parser.add_argument("-q","--quiet", help="disables all stdout logging (not file logging)", action="store_true")
+        parser.add_argument("--jsonlog", help="write file logs as json lines instead of plain text", action="store_true")
+        parser.add_argument("--state", help="motor position state file (empty to disable)", default="motor_state.bin")
+        parser.add_argument("--port", help="webserver port", type=int, default=8080)
+        parser.add_argument("--shm", help="shared memory motor state block name (empty to disable)",
+                            default=StateBlock.DEFAULT_NAME)
+        parser.add_argument("--record", help="record incoming requests to file, for Replay")
+        parser.add_argument("--history", help="command history database (empty to disable)", default="history.db")
+        parser.add_argument("--history-days", help="days of history kept (0 keeps everything)", type=float,
+                            default=30)
         args = parser.parse_args()
 
         #signal.signal(signal.SIGINT, shutdown)
         #signal.signal(signal.SIGTERM, shutdown)
 
-        Util.init_logger(args.quiet)
+        Util.init_logger(args.quiet, args.jsonlog)
         logger.debug("Loggers initialized")
         logger.debug("IOTAPI-client version %d.%d starting up",Util.VERSION_MAJOR,Util.VERSION_MINOR)
         logger.debug("CWD: %s", os.getcwd())
@@ -59,11 +152,24 @@ def main():
         logger.debug("Loading config")
         load_config(args.config)
 
+        if args.state:
+            logger.debug("Mapping motor state file")
+            PositionStore.open_store(args.state)
+
+        if args.shm:
+            StateBlock.open_block(args.shm)
+
+        if args.history:
+            History.start(args.history, args.history_days * 86400 if args.history_days > 0 else None)
+
         logger.info("Initializing motors")
         GPIOMgr.init_motors()
 
+        if args.record:
+            Recorder.start(args.record)
+
         logger.debug("Starting webserver")
-        Webserver.init_flask()
+        Webserver.init_flask(args.port)
 
         logger.info("Webserver app done, shutting down other things")
         shutdown(-1, None)
@@ -78,7 +184,9 @@ def main():
 def shutdown(signum, frame):
     # TODO - probably fake local request to flask to get shutdown function with context
     logger.info('Received signal %s - shutting down', signum)
+    Recorder.stop()
     GPIOMgr.shutdown()
+    History.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,134 @@
+import bisect
+import threading
+
+# Minimal metrics registry rendered in Prometheus text exposition format (version 0.0.4).
+# Every metric guards its values with its own lock, held only for a dict update, so recording from the
+# control threads is cheap and never contends with rendering for long. Nothing here is called per step.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default buckets in seconds, spanning step-scale delays to long moves
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+registry = []
+
+
+def _fmt_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _fmt_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [(self.name, _fmt_labels(self.labels, k), v) for k, v in sorted(items)]
+
+
+# Gauges are either set directly, or computed at scrape time by a callback returning {labelvalues: value}
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        Counter.__init__(self, name, doc, labels)
+        self.func = func
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def samples(self):
+        if self.func is not None:
+            items = list(self.func().items())
+            return [(self.name, _fmt_labels(self.labels, k), v) for k, v in sorted(items)]
+        return Counter.samples(self)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labelvalues -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(labelvalues)
+            if v is None:
+                v = self.values[labelvalues] = [0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                v[idx] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.values.items()]
+        out = []
+        for k, v in sorted(items):
+            cumulative = 0
+            for bound, n in zip(self.buckets, v):
+                cumulative += n
+                out.append((self.name + '_bucket', _fmt_labels(self.labels, k, 'le="{}"'.format(bound)), cumulative))
+            out.append((self.name + '_bucket', _fmt_labels(self.labels, k, 'le="+Inf"'), v[-1]))
+            out.append((self.name + '_sum', _fmt_labels(self.labels, k), v[-2]))
+            out.append((self.name + '_count', _fmt_labels(self.labels, k), v[-1]))
+        return out
+
+
+def render():
+    lines = []
+    for m in registry:
+        lines.append('# HELP {} {}'.format(m.name, m.doc))
+        lines.append('# TYPE {} {}'.format(m.name, m.kind))
+        for name, labels, value in m.samples():
+            lines.append('{}{} {}'.format(name, labels, _fmt_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+# Motion
+steps_total = Counter('iotapi_motor_steps_total', 'Step pulses issued', ['motor'])
+moves_total = Counter('iotapi_moves_total', 'Finished move commands by result', ['motor', 'result'])
+move_duration = Histogram('iotapi_move_duration_seconds', 'Duration of executed moves', ['motor'])
+stop_latency = Histogram('iotapi_stop_latency_seconds', 'Time from stop request to last step pulse', ['motor'])
+stop_detect = Histogram('iotapi_stop_detect_seconds', 'Time from stop request to motion being abandoned',
+                        ['motor'])
+start_skew = Histogram('iotapi_start_skew_seconds', 'Absolute error of scheduled move first pulse time',
+                       ['motor'])
+interlock_trips = Counter('iotapi_interlock_trips_total', 'Transitions into an interlock state',
+                          ['motor', 'ilock'])
+
+# Queues and locking
+queue_wait = Histogram('iotapi_queue_wait_seconds', 'Time commands spend queued before execution', ['motor'])
+movelock_wait = Histogram('iotapi_movelock_wait_seconds', 'Time spent waiting to acquire the move lock', ['motor'])
+
+# Web
+http_latency = Histogram('iotapi_http_request_duration_seconds', 'HTTP request handling time',
+                         ['route', 'method'])
+threads = Gauge('iotapi_threads', 'Live threads in worker process', func=lambda: {(): threading.active_count()})
+dump_state_calls = Counter('iotapi_dump_state_calls_total', 'Motor state dumps served')
+gpio_summary_calls = Counter('iotapi_gpio_summary_calls_total', 'GPIO summaries generated')
@@ -0,0 +1,187 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Small memory-mapped file holding last known position and homing state per motor, for warm restarts.
+# Each motor slot has two record copies - writes always go to the older one and carry a CRC and a sequence
+# number, so a write torn by a crash or power loss leaves the other copy intact.
+#
+# Layout (little endian): header '<4sHH' (magic, version, slot count), then per slot 2 records of
+# '<HBbqqQdI' (uuid, flags, direction, position, learned travel range or 0, sequence, wall time,
+# crc32 of preceding fields).
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'IOTP'
+VERSION = 2
+MAX_SLOTS = 16
+MIN_INTERVAL = 1.0          # s between non-forced writes of one motor
+LIMIT_TOLERANCE = 100       # steps a limit switch may be off from where the stored position puts it
+
+# Record flags
+HOMED = 1
+CLEAN = 2                   # written by clean shutdown
+MOVING = 4                  # written while motion in progress, position is only approximate
+HOME_UP = 8                 # zero was set at the UP limit
+ESTIMATED = 16              # position settled from waveform schedule after a halt, may be off by a few steps
+
+HEADER = struct.Struct('<4sHH')
+RECORD = struct.Struct('<HBbqqQdI')
+SLOT_SIZE = 2 * RECORD.size
+
+_lock = threading.Lock()
+_mm = None
+_file = None
+_slots = {}     # uuid -> slot index
+_seq = {}       # uuid -> last written sequence
+_last = {}      # uuid -> (write time, position, flags, travel) of last write
+
+
+def open_store(path):
+    """
+    Maps state file, creating or resetting it if missing or not in current format
+    """
+    global _mm, _file
+    size = HEADER.size + MAX_SLOTS * SLOT_SIZE
+    valid = False
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        with open(path, 'rb') as f:
+            magic, version, nslots = HEADER.unpack(f.read(HEADER.size))
+        valid = magic == MAGIC and version == VERSION and nslots == MAX_SLOTS
+    if not valid:
+        logger.warning('State file %s missing or incompatible - starting fresh', path)
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, MAX_SLOTS) + bytes(MAX_SLOTS * SLOT_SIZE))
+            f.flush()
+            os.fsync(f.fileno())
+    _file = open(path, 'r+b')
+    _mm = mmap.mmap(_file.fileno(), size)
+    _slots.clear()
+    for i in range(MAX_SLOTS):
+        rec = _read_slot(i)
+        if rec is not None:
+            _slots[rec[0]] = i
+    logger.info('State file %s mapped, %d motor records present', path, len(_slots))
+
+
+def close_store():
+    global _mm, _file
+    with _lock:
+        if _mm is not None:
+            _mm.flush()
+            _mm.close()
+            _file.close()
+            _mm = _file = None
+
+
+def _read_copy(slot, copy):
+    offset = HEADER.size + slot * SLOT_SIZE + copy * RECORD.size
+    raw = _mm[offset:offset + RECORD.size]
+    rec = RECORD.unpack(raw)
+    if rec[5] == 0 or zlib.crc32(raw[:-4]) != rec[-1]:
+        return None
+    return rec
+
+
+# Returns newest intact record copy of slot as (uuid, flags, direction, position, travel, seq, time, crc),
+# or None
+def _read_slot(slot):
+    copies = [r for r in (_read_copy(slot, 0), _read_copy(slot, 1)) if r is not None]
+    return max(copies, key=lambda r: r[5]) if copies else None
+
+
+def load(uuid):
+    """
+    :return: dict of last stored state of motor, or None if nothing usable is stored
+    """
+    if _mm is None:
+        return None
+    with _lock:
+        slot = _slots.get(uuid)
+        rec = _read_slot(slot) if slot is not None else None
+    if rec is None:
+        return None
+    _seq[uuid] = rec[5]
+    return {'flags': rec[1], 'direction': rec[2], 'position': rec[3], 'travel': rec[4], 'seq': rec[5],
+            'time': rec[6]}
+
+
+def save(mt, moving=False, clean=False, force=False):
+    """
+    Stores motor state, unless it is unchanged or the motor was written less than MIN_INTERVAL ago
+    """
+    if _mm is None:
+        return
+    flags = (HOMED if mt.homed else 0) | (CLEAN if clean else 0) | (MOVING if moving else 0) | \
+            (HOME_UP if getattr(mt, 'home_dir', 0) == 1 else 0) | \
+            (ESTIMATED if getattr(mt, 'position_estimated', False) else 0)
+    travel = mt.travel_range or 0
+    now = time.monotonic()
+    last = _last.get(mt.uuid)
+    if last is not None:
+        if last[1] == mt.position and last[2] == flags and last[3] == travel:
+            return
+        if not force and now - last[0] < MIN_INTERVAL:
+            return
+    with _lock:
+        slot = _slots.get(mt.uuid)
+        if slot is None:
+            # Slots of unreadable records are left out of _slots, so indices in use may have gaps
+            used = set(_slots.values())
+            free = [i for i in range(MAX_SLOTS) if i not in used]
+            if not free:
+                logger.error('No free state slot for motor %s', mt.uuid)
+                return
+            slot = _slots[mt.uuid] = free[0]
+        seq = _seq.get(mt.uuid, 0) + 1
+        # Overwrite whichever copy is older (or broken)
+        copies = [_read_copy(slot, 0), _read_copy(slot, 1)]
+        copy = 0 if copies[0] is None or (copies[1] is not None and copies[0][5] < copies[1][5]) else 1
+        head = RECORD.pack(mt.uuid, flags, mt.direction, mt.position, travel, seq, time.time(), 0)[:-4]
+        offset = HEADER.size + slot * SLOT_SIZE + copy * RECORD.size
+        _mm[offset:offset + RECORD.size] = head + struct.pack('<I', zlib.crc32(head))
+        _mm.flush()
+        _seq[mt.uuid] = seq
+        _last[mt.uuid] = (now, mt.position, flags, travel)
+
+
+def validate(state, lim_up, lim_dn):
+    """
+    Checks stored state against limit switches currently active and the clean shutdown marker. Position left
+    by an unclean shutdown may have missed the last writes, so it is only kept as a starting point - the
+    motor has to be homed again before its position is trusted
+    :return: (usable, homed, reason)
+    """
+    if state['flags'] & MOVING:
+        return False, False, 'motion was in progress'
+    if lim_up and lim_dn:
+        return False, False, 'both limits active'
+    if not state['flags'] & HOMED:
+        return True, False, 'not homed'
+    pos = state['position']
+    # Home limit sits just below zero (or just above, when homed UP), the other one on the far side
+    if state['flags'] & HOME_UP:
+        home_hit, far_hit, sign = lim_up, lim_dn, -1
+    else:
+        home_hit, far_hit, sign = lim_dn, lim_up, 1
+    if home_hit and sign * pos > LIMIT_TOLERANCE:
+        return False, False, 'home limit active away from zero'
+    if far_hit and sign * pos <= 0:
+        return False, False, 'far limit active at or before zero'
+    if not home_hit and sign * pos < -LIMIT_TOLERANCE:
+        return False, False, 'position beyond home limit without it being active'
+    travel = state['travel']
+    if travel:
+        if far_hit and sign * pos < travel - LIMIT_TOLERANCE:
+            return False, False, 'far limit active short of learned travel'
+        if not far_hit and sign * pos > travel + LIMIT_TOLERANCE:
+            return False, False, 'position beyond far limit without it being active'
+    if not state['flags'] & CLEAN:
+        return True, False, 'consistent, but not written by clean shutdown - unverified, homing required'
+    if state['flags'] & ESTIMATED:
+        return True, False, 'consistent, but estimated after halted waveform move - homing required'
+    return True, True, 'consistent'
@@ -0,0 +1,198 @@
+import cProfile
+import collections
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+# On-demand profiling of a motor's command execution or of web request handling, for a bounded duration.
+# Sampling mode walks the stacks of the profiled threads every interval and counts collapsed stacks (flame graph
+# input). Deterministic mode runs cProfile in every command or request that starts while the session is on, and
+# merges the results into a pstats file. Motor executor and request hooks only check that a session exists, so
+# with profiling off nothing runs. One session at a time, the last one keeps its result for download.
+
+logger = logging.getLogger(__name__)
+
+MAX_DURATION = 300.0        # s
+MIN_INTERVAL = 0.0005       # s between samples
+MAX_STACK_DEPTH = 100
+
+# Modes
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+
+# Scope of web request handlers, motor scopes are motor uuids
+WEB = 'web'
+
+# Session states
+RUNNING = 'running'
+DONE = 'done'
+
+_lock = threading.Lock()
+current = None
+
+
+class ProfilerException(Exception):
+    pass
+
+
+class ProfileSession:
+    def __init__(self, mode, scope, duration, interval=0.005):
+        """
+        :param mode: SAMPLE or CPROFILE
+        :param scope: WEB or motor uuid
+        :param duration: s after which profiling stops on its own
+        :param interval: s between stack samples
+        """
+        if mode not in (SAMPLE, CPROFILE):
+            raise ProfilerException('Unknown mode {}'.format(mode))
+        if not 0 < duration <= MAX_DURATION or interval < MIN_INTERVAL:
+            raise ProfilerException('Bad duration or interval')
+        self.mode = mode
+        self.scope = scope
+        self.duration = duration
+        self.interval = interval
+        self.state = RUNNING
+        self.started = self.finished = None
+        self.threads = {}           # ident -> name of threads currently in scope
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.stopevt = threading.Event()
+        self._thread = None
+
+    def start(self, busy_threads=()):
+        """
+        :param busy_threads: (ident, name) of threads already running in scope - only sampling can pick them up
+        """
+        self.started = time.time()
+        if self.mode == SAMPLE:
+            self.threads.update(busy_threads)
+        self._thread = threading.Thread(name='profiler', target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.stopevt.set()
+
+    def _run(self):
+        logger.info('Profiling (%s) of %s started for %g s', self.mode, self.scope, self.duration)
+        deadline = time.perf_counter() + self.duration
+        if self.mode == SAMPLE:
+            me = threading.get_ident()
+            while not self.stopevt.wait(self.interval) and time.perf_counter() < deadline:
+                frames = sys._current_frames()
+                with self.lock:
+                    threads = list(self.threads.items())
+                for ident, name in threads:
+                    frame = frames.get(ident)
+                    if frame is not None and ident != me:
+                        self.samples[_collapse(name, frame)] += 1
+                        self.sample_count += 1
+        else:
+            self.stopevt.wait(self.duration)
+        self.state = DONE
+        self.finished = time.time()
+        logger.info('Profiling of %s finished after %.1f s', self.scope, self.finished - self.started)
+
+    def attach(self):
+        """
+        Enters scope on calling thread
+        :return: token for detach
+        """
+        ident = threading.get_ident()
+        if self.mode == SAMPLE:
+            with self.lock:
+                self.threads[ident] = threading.current_thread().name
+            return ident, None
+        prof = cProfile.Profile()
+        prof.enable()
+        return ident, prof
+
+    def detach(self, token):
+        ident, prof = token
+        with self.lock:
+            if prof is None:
+                self.threads.pop(ident, None)
+            else:
+                prof.disable()
+                self.profiles.append(prof)
+
+    def result(self):
+        """
+        :return: (bytes, mimetype, file name) - collapsed stacks text or marshalled pstats, None if nothing was
+                 captured
+        """
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        with self.lock:
+            if self.mode == SAMPLE:
+                if not self.samples:
+                    return None
+                text = ''.join('{} {}\n'.format(stack, n) for stack, n in sorted(self.samples.items()))
+                return text.encode('utf-8'), 'text/plain', 'profile-{}-{}.collapsed'.format(self.scope, stamp)
+            if not self.profiles:
+                return None
+            stats = pstats.Stats(self.profiles[0])
+            for prof in self.profiles[1:]:
+                stats.add(prof)
+        return marshal.dumps(stats.stats), 'application/octet-stream', 'profile-{}-{}.pstats'.format(self.scope,
+                                                                                                     stamp)
+
+    def status(self):
+        return {'mode': self.mode, 'scope': self.scope, 'state': self.state, 'duration': self.duration,
+                'interval': self.interval, 'started': self.started, 'finished': self.finished,
+                'samples': self.sample_count, 'profiles': len(self.profiles)}
+
+
+# Collapsed stack line of frame, outermost call first
+def _collapse(name, frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    stack.append(name)
+    return ';'.join(reversed(stack))
+
+
+def start(mode, scope, duration, interval=0.005, busy_threads=()):
+    global current
+    with _lock:
+        if current is not None and current.state == RUNNING:
+            raise ProfilerException('Another profiling session is running')
+        session = ProfileSession(mode, scope, duration, interval)
+        current = session
+        session.start(busy_threads)
+    return session
+
+
+def stop():
+    """
+    :return: True if a running session was stopped
+    """
+    session = current
+    if session is not None and session.state == RUNNING:
+        session.stop()
+        session._thread.join(1.0)
+        return True
+    return False
+
+
+def attach(scope):
+    """
+    Called on entry to a command or request of given scope, only when a session exists
+    :return: token to pass to detach, or None if not profiled
+    """
+    session = current
+    if session is None or session.state != RUNNING or session.scope != scope:
+        return None
+    return session, session.attach()
+
+
+def detach(token):
+    session, inner = token
+    session.detach(inner)
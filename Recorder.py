@@ -0,0 +1,105 @@
+import logging
+import queue
+import struct
+import threading
+import time
+
+import Metrics
+
+# Opt-in capture of incoming HTTP requests, for reproducing production command/poll mixes offline with Replay.
+# Request handlers only push a tuple onto a bounded queue, a writer thread does the file IO - if it falls
+# behind, requests are dropped from the recording (and counted) rather than slowed down.
+#
+# File layout (little endian): header '<4sH' (magic, version), then per request '<dBBHI' (s since recording
+# start, method index, flags, path length, body length), followed by path (with query string) and raw body.
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'IOTR'
+VERSION = 1
+HEADER = struct.Struct('<4sH')
+RECORD = struct.Struct('<dBBHI')
+METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS', 'PATCH')
+QUEUE_SIZE = 10000
+
+# Record flags
+JSON_BODY = 1
+
+dropped = Metrics.Counter('iotapi_recorder_dropped_total', 'Requests left out of recording due to backlog')
+
+_queue = None
+_thread = None
+_t0 = None
+
+
+def start(path):
+    """
+    Starts recording requests to file, replacing it
+    """
+    global _queue, _thread, _t0
+    f = open(path, 'wb')
+    f.write(HEADER.pack(MAGIC, VERSION))
+    _t0 = time.perf_counter()
+    _queue = queue.Queue(maxsize=QUEUE_SIZE)
+    _thread = threading.Thread(name='recorder', target=_run, args=(f, _queue))
+    _thread.daemon = True
+    _thread.start()
+    logger.info('Recording requests to %s', path)
+
+
+def stop():
+    global _queue, _thread
+    q, thread = _queue, _thread
+    _queue = _thread = None
+    if q is not None:
+        q.put(None)
+        thread.join(5.0)
+
+
+def recording():
+    return _queue is not None
+
+
+def record(method, path, body, is_json):
+    q = _queue
+    if q is None:
+        return
+    try:
+        q.put_nowait((time.perf_counter() - _t0, method, path, body, is_json))
+    except queue.Full:
+        dropped.inc()
+
+
+def _run(f, q):
+    n = 0
+    with f:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            t, method, path, body, is_json = item
+            path = path.encode('utf-8')
+            f.write(RECORD.pack(t, METHODS.index(method) if method in METHODS else 0,
+                                JSON_BODY if is_json else 0, len(path), len(body)) + path + body)
+            n += 1
+            if q.empty():
+                f.flush()
+    logger.info('Recording stopped after %d requests', n)
+
+
+def read(path):
+    """
+    Iterates over recorded requests
+    :return: generator of (s since start, method, path, body bytes, is_json)
+    """
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a request recording of version {}'.format(path, VERSION))
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            t, method, flags, path_len, body_len = RECORD.unpack(head)
+            req_path = f.read(path_len).decode('utf-8')
+            yield t, METHODS[method], req_path, f.read(body_len), bool(flags & JSON_BODY)
@@ -0,0 +1,203 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import Fleet
+import Recorder
+import Trace
+
+# Replays a request recording (see Recorder) against a worker at 1x or Nx speed, then reports per-route latency
+# percentiles and how much step timing on the worker degraded under that load. Step timing comes from the
+# worker's event trace - every move found in it is compared pulse by pulse against the planned profile, which
+# /simulate/ returns for the same step count.
+#
+# Replays are meant for a worker on the simulated GPIO backend - --spawn starts one locally with IOTAPI_SIM=1.
+
+logger = logging.getLogger(__name__)
+
+SKIP_PATHS = ('/shutdown/', '/trace/')
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    :return: dict of 'p<n>' nearest-rank percentiles plus max and count, empty values give only count 0
+    """
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    out = {'p{}'.format(p): values[min(len(values) - 1, int(len(values) * p / 100))] for p in points}
+    out.update({'max': values[-1], 'count': len(values)})
+    return out
+
+
+def spawn_worker(config, port):
+    """
+    Starts local worker on simulated GPIO, waiting until it accepts connections
+    """
+    env = dict(os.environ, IOTAPI_SIM='1')
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, os.path.join(here, 'Main.py'), config, '-q', '--port', str(port),
+                             '--state', '', '--history', '', '--shm', ''], env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError('Worker exited with code {}'.format(proc.returncode))
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('Worker did not start listening on port {}'.format(port))
+
+
+def replay(records, pool, speed=1.0, threads=16):
+    """
+    Sends recorded requests on their recorded schedule, compressed by speed
+    :return: (dict of 'METHOD path' to list of (latency s, status)), list of schedule slips in s)
+    """
+    results = collections.defaultdict(list)
+    slips = []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='replay')
+
+    def send(method, path, body, is_json):
+        t0 = time.perf_counter()
+        try:
+            status, _ = pool.request(method, path, body or None,
+                                     content_type='application/json' if is_json else 'application/octet-stream')
+        except Exception:
+            status = None
+        return time.perf_counter() - t0, status
+
+    futures = []
+    start = time.perf_counter()
+    for t, method, path, body, is_json in records:
+        if path.split('?')[0] in SKIP_PATHS:
+            continue
+        due = start + t / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            slips.append(-delay)
+        futures.append(('{} {}'.format(method, path.split('?')[0]), executor.submit(send, method, path, body,
+                                                                                     is_json)))
+    for route, fut in futures:
+        results[route].append(fut.result())
+    executor.shutdown()
+    return results, slips
+
+
+def step_timing(pool, trace_data):
+    """
+    Matches moves in trace dump against planned profiles
+    :return: dict of motor uuid to percentiles of per step lateness in s, plus number of moves compared,
+             motors without any step interval compared are left out
+    """
+    events = collections.defaultdict(list)
+    for n in range(len(trace_data) // Trace.RECORD.size):
+        t_ns, motor, event, value = Trace.RECORD.unpack_from(trace_data, n * Trace.RECORD.size)
+        events[motor].append((t_ns, event, value))
+    plans = {}
+    report = {}
+    for motor, evts in events.items():
+        lateness = []
+        moves = 0
+        pulses, steps = None, 0
+        for t_ns, event, value in evts:
+            if event == Trace.MOVE_START:
+                pulses, steps = [], value
+            elif event == Trace.PULSE and pulses is not None:
+                pulses.append(t_ns)
+            elif event == Trace.MOVE_END and pulses is not None:
+                # Only complete moves are comparable, stopped and wrapped ones are skipped
+                if value == 0 and steps and len(pulses) == steps:
+                    key = (motor, steps)
+                    if key not in plans:
+                        status, body = pool.request('GET', '/simulate/?uuid={}&steps={}&profile=1'.format(motor,
+                                                                                                        steps))
+                        plans[key] = body['plan']['delays'] if status == 200 else None
+                    delays = plans[key]
+                    if delays is not None:
+                        moves += 1
+                        lateness.extend((b - a) * 1e-9 - d for a, b, d in zip(pulses, pulses[1:], delays))
+                pulses = None
+        # Single step moves have no intervals to compare
+        if lateness:
+            report[motor] = dict(percentiles(lateness), moves=moves)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IOTAPi request recording replay")
+    parser.add_argument("recording", help="file written by worker with --record")
+    parser.add_argument("worker", nargs='?', help="worker address as host:port (default spawns local sim worker)")
+    parser.add_argument("--spawn", help="config to start local simulated worker with")
+    parser.add_argument("--port", help="port of spawned worker", type=int, default=18099)
+    parser.add_argument("--speed", help="replay speed factor", type=float, default=1.0)
+    parser.add_argument("--threads", help="max requests in flight", type=int, default=16)
+    parser.add_argument("--json", help="print report as json", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if not args.worker and not args.spawn:
+        parser.error('give either worker address or --spawn config')
+
+    records = list(Recorder.read(args.recording))
+    proc = spawn_worker(args.spawn, args.port) if args.spawn else None
+    pool = Fleet.WorkerConnectionPool(args.worker or '127.0.0.1:{}'.format(args.port), size=args.threads,
+                                      timeout=60.0)
+    try:
+        pool.request('GET', '/trace/?format=bin&clear=1')
+        logger.info('Replaying %d requests at %gx', len(records), args.speed)
+        t0 = time.perf_counter()
+        results, slips = replay(records, pool, args.speed, args.threads)
+        elapsed = time.perf_counter() - t0
+        # Let queued motion finish before taking the trace
+        while True:
+            status, motors = pool.request('GET', '/motors/')
+            if status != 200 or not any(m.get('queuesize') or m.get('statestr') in ('MOVING', 'HOMING')
+                                        for m in motors.values()):
+                break
+            time.sleep(0.2)
+        status, trace_data = pool.request('GET', '/trace/?format=bin')
+        report = {
+            'requests': len(records), 'elapsed': elapsed, 'speed': args.speed,
+            'schedule_slip': percentiles(slips),
+            'routes': {route: dict(percentiles([lat for lat, _ in res]),
+                                   errors=sum(1 for _, st in res if st is None or st >= 400))
+                       for route, res in sorted(results.items())},
+            'step_lateness': step_timing(pool, trace_data) if isinstance(trace_data, bytes) else {},
+        }
+    finally:
+        pool.close()
+        if proc is not None:
+            proc.terminate()
+            proc.wait(10)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print('{} requests in {:.2f} s at {}x, {} sent late'.format(report['requests'], elapsed, args.speed,
+                                                                 report['schedule_slip']['count']))
+    print('{:40s} {:>6s} {:>9s} {:>9s} {:>9s} {:>9s} {:>6s}'.format('route', 'n', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                                    'max ms', 'errors'))
+    for route, r in report['routes'].items():
+        print('{:40s} {:6d} {:9.2f} {:9.2f} {:9.2f} {:9.2f} {:6d}'.format(route, r['count'], r['p50'] * 1e3,
+                                                                        r['p90'] * 1e3, r['p99'] * 1e3,
+                                                                        r['max'] * 1e3, r['errors']))
+    print('Step lateness vs plan:')
+    for motor, r in sorted(report['step_lateness'].items()):
+        print('  motor {}: {} moves, {} steps - p50 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'.format(
+            motor, r['moves'], r['count'], r['p50'] * 1e3, r['p99'] * 1e3, r['max'] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
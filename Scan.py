@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+
+import GPIOMgr
+import Util
+from Stepper import DISABLED, SoftLimitException
+
+# Server-side raster scans. A scan job walks a list of absolute points over one or more motors and runs the
+# move-settle-trigger sequence for every point locally. Moves are submitted as blocking move_to, so they get the
+# same checks as requested ones and are preempted by stop like any other move; the job then dwells (abortable)
+# and pulses the trigger output, whose pin stays reserved while the scan runs. Timing of every point is kept for
+# the report. One scan at a time.
+
+logger = logging.getLogger(__name__)
+
+MAX_POINTS = 100000
+MAX_DWELL = 60.0            # s
+MAX_TRIGGER_WIDTH = 0.1     # s
+
+# Job states
+RUNNING = 'running'
+DONE = 'done'
+ABORTED = 'aborted'
+FAILED = 'failed'
+
+_lock = threading.Lock()
+current = None
+
+
+class ScanException(Exception):
+    pass
+
+
+def grid_points(axes, snake=True):
+    """
+    Expands per motor (start, stop, num) ranges into a raster, first axis slowest
+    :param snake: reverse every other line of each inner axis, so consecutive points stay adjacent
+    :return: list of point tuples
+    """
+    points = [()]
+    for start, stop, num in axes:
+        num = int(num)
+        if num < 1:
+            raise ScanException('Axis needs at least one point')
+        values = [int(round(start + (stop - start) * k / (num - 1))) if num > 1 else int(start)
+                  for k in range(num)]
+        expanded = []
+        for n, p in enumerate(points):
+            expanded.extend(p + (v,) for v in (values[::-1] if snake and n % 2 else values))
+        points = expanded
+        if len(points) > MAX_POINTS:
+            raise ScanException('More than {} points'.format(MAX_POINTS))
+    return points
+
+
+class ScanJob:
+    def __init__(self, motors, points, dwell=0.0, trigger_pin=None, trigger_width=0.001):
+        """
+        :param motors: list of Stepper objects, one per point coordinate
+        :param points: list of absolute step positions, one tuple per point
+        :param dwell: settle time after moves, before trigger (s)
+        :param trigger_pin: BCM pin pulsed at every point, or None
+        :param trigger_width: trigger pulse length (s)
+        """
+        if not points or len(points) > MAX_POINTS:
+            raise ScanException('Scan needs between 1 and {} points'.format(MAX_POINTS))
+        if any(len(p) != len(motors) for p in points):
+            raise ScanException('Every point needs one position per motor')
+        if len(set(mt.uuid for mt in motors)) != len(motors):
+            raise ScanException('Repeated motor in scan')
+        if not 0 <= dwell <= MAX_DWELL or not 0 <= trigger_width <= MAX_TRIGGER_WIDTH:
+            raise ScanException('Bad dwell or trigger width')
+        if trigger_pin is not None and (trigger_pin not in Util.BCM_PINS or trigger_pin in GPIOMgr.used_pins()):
+            raise ScanException('Trigger pin {} is not a free BCM pin'.format(trigger_pin))
+        self.motors = motors
+        self.points = [tuple(int(x) for x in p) for p in points]
+        self.dwell = dwell
+        self.trigger_pin = trigger_pin
+        self.trigger_width = trigger_width
+        self.state = RUNNING
+        self.error = None
+        self.report = []
+        self.started = self.finished = None
+        self.abortevt = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.trigger_pin is not None:
+            try:
+                GPIOMgr.reserve_pin(self.trigger_pin, 'scan trigger')
+            except ValueError as e:
+                raise ScanException(str(e))
+            GPIOMgr.set_mode_outputs([self.trigger_pin], GPIOMgr.GPIO.LOW)
+        self.started = time.time()
+        self._thread = threading.Thread(name='scan', target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def abort(self):
+        """
+        Stops scan at the next checkpoint, preempting any move in flight
+        """
+        self.abortevt.set()
+        for mt in self.motors:
+            mt.stop()
+
+    # Moves motor to target and waits for it, raising ScanException if the move was rejected or fell short
+    def _move_to(self, mt, target):
+        if target == mt.position:
+            return
+        if mt.state == DISABLED and not mt.auto_enable:
+            raise ScanException('Motor {} is not enabled'.format(mt.uuid))
+        try:
+            result = mt.move_to(target, block=True)
+        except SoftLimitException as e:
+            raise ScanException('Motor {} - {}'.format(mt.uuid, e))
+        if self.abortevt.is_set():
+            raise ScanException('Aborted')
+        if result != 'Done' or mt.position != target:
+            raise ScanException('Move of motor {} to {} ended with {} at {}'.format(mt.uuid, target, result,
+                                                                                    mt.position))
+
+    def _run(self):
+        logger.info('Scan of %d points over motors %s starting', len(self.points), [mt.uuid for mt in self.motors])
+        try:
+            for n, point in enumerate(self.points):
+                t0 = time.perf_counter()
+                for mt, target in zip(self.motors, point):
+                    if self.abortevt.is_set():
+                        raise ScanException('Aborted')
+                    self._move_to(mt, target)
+                t_moved = time.perf_counter()
+                if self.abortevt.wait(self.dwell):
+                    raise ScanException('Aborted')
+                t_trigger = time.time()
+                if self.trigger_pin is not None:
+                    GPIOMgr.pulse_pin(self.trigger_pin, self.trigger_width)
+                self.report.append({'index': n, 'target': point, 'position': [mt.position for mt in self.motors],
+                                    'move': t_moved - t0, 'settle': time.perf_counter() - t_moved,
+                                    'trigger': t_trigger})
+                if self.abortevt.is_set():
+                    raise ScanException('Aborted')
+            self.state = DONE
+        except ScanException as e:
+            self.state = ABORTED if self.abortevt.is_set() else FAILED
+            self.error = str(e)
+        except Exception as e:
+            logger.exception('Scan failed')
+            self.state = FAILED
+            self.error = str(e)
+        finally:
+            if self.trigger_pin is not None:
+                GPIOMgr.release_pin(self.trigger_pin)
+        self.finished = time.time()
+        logger.info('Scan %s after %d of %d points (%s)', self.state, len(self.report), len(self.points),
+                    self.error)
+
+    def status(self, since=0):
+        """
+        :param since: first point index to include in the report
+        """
+        return {'state': self.state, 'error': self.error, 'points': len(self.points), 'done': len(self.report),
+                'started': self.started, 'finished': self.finished, 'report': self.report[since:]}
+
+
+def start(motors, points, dwell=0.0, trigger_pin=None, trigger_width=0.001):
+    global current
+    with _lock:
+        if current is not None and current.state == RUNNING:
+            raise ScanException('Another scan is running')
+        job = ScanJob(motors, points, dwell, trigger_pin, trigger_width)
+        job.start()
+        current = job
+    return job
+
+
+def abort():
+    """
+    :return: True if a running scan was aborted
+    """
+    job = current
+    if job is not None and job.state == RUNNING:
+        job.abort()
+        return True
+    return False
@@ -0,0 +1,55 @@
+# Stand-in for RPi.GPIO when running off the Pi (development, local test workers). Provides the constants and
+# calls GPIOMgr uses, keeping pin modes and levels in memory. GPIOMgr still treats such runs as non-RPi, so
+# hardware side effects stay disabled and limit switches read as not triggered.
+
+VERSION = '0.SIM.0'
+RPI_REVISION = '-1'
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+
+_mode = None
+_functions = {}
+_levels = {}
+
+
+def setmode(mode):
+    global _mode
+    _mode = mode
+
+
+def getmode():
+    return _mode
+
+
+def gpio_function(pin):
+    return _functions.get(pin, IN)
+
+
+def setup(pins, direction, pull_up_down=PUD_OFF, initial=None):
+    for pin in (pins if isinstance(pins, (list, tuple)) else [pins]):
+        _functions[pin] = direction
+        if direction == OUT:
+            _levels[pin] = initial if initial is not None else LOW
+        else:
+            _levels[pin] = HIGH if pull_up_down == PUD_UP else LOW
+
+
+def input(pin):
+    return _levels.get(pin, LOW)
+
+
+def output(pin, state):
+    _levels[pin] = state
+
+
+def cleanup():
+    _functions.clear()
+    _levels.clear()
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from multiprocessing import shared_memory
+
+from StateBlockReader import DEFAULT_NAME, MAGIC, VERSION, HEADER, SEQ, DATA, SLOT_SIZE, HOMED, ESTOP, COARSE
+
+# Publishes motor state, position and direction into a shared memory segment, so that processes on the same
+# host can read them without HTTP (StateBlockReader documents the layout and the read side). Slots are updated
+# under a seqlock - sequence made odd, data written, sequence made even - which keeps reads lock-free. Motors
+# publish on every step while moving, and at the start and end of every command.
+
+logger = logging.getLogger(__name__)
+
+MAX_SLOTS = 16
+
+_lock = threading.Lock()
+_shm = None
+_buf = None
+_slots = {}     # uuid -> slot index
+_seq = {}       # slot index -> last written sequence
+
+
+def open_block(name=DEFAULT_NAME):
+    """
+    Creates state block segment, replacing one left behind by a previous run
+    """
+    global _shm, _buf
+    size = HEADER.size + MAX_SLOTS * SLOT_SIZE
+    try:
+        shm = shared_memory.SharedMemory(name, create=True, size=size)
+    except FileExistsError:
+        logger.warning('Replacing stale state block %s', name)
+        shared_memory.SharedMemory(name).unlink()
+        shm = shared_memory.SharedMemory(name, create=True, size=size)
+    shm.buf[:size] = bytes(size)
+    HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, MAX_SLOTS, SLOT_SIZE)
+    _shm, _buf = shm, shm.buf
+    _slots.clear()
+    _seq.clear()
+    logger.info('Publishing motor state in shared memory %s', name)
+
+
+def close_block():
+    global _shm, _buf
+    with _lock:
+        if _shm is None:
+            return
+        # Tells attached readers this block is gone, and leaves no motor data behind to be taken for live
+        HEADER.pack_into(_buf, 0, b'\0' * 4, VERSION, MAX_SLOTS, SLOT_SIZE)
+        size = MAX_SLOTS * SLOT_SIZE
+        _buf[HEADER.size:HEADER.size + size] = bytes(size)
+        _buf = None
+        _shm.close()
+        _shm.unlink()
+        _shm = None
+
+
+def register(mt):
+    """
+    Assigns motor a slot, the one it had if it was registered before
+    """
+    if _buf is None:
+        return
+    with _lock:
+        if mt.uuid not in _slots:
+            used = set(_slots.values())
+            free = [n for n in range(MAX_SLOTS) if n not in used]
+            if not free:
+                logger.error('No free state block slot for motor %s', mt.uuid)
+                return
+            _slots[mt.uuid] = free[0]
+    publish(mt)
+
+
+def unregister(mt):
+    with _lock:
+        slot = _slots.pop(mt.uuid, None)
+        if slot is not None and _buf is not None:
+            _write(slot, 0, 0.0, 0, 0, 0, 0)
+
+
+def publish(mt):
+    slot = _slots.get(mt.uuid)
+    if slot is None or _buf is None:
+        return
+    flags = (HOMED if mt.homed else 0) | (ESTOP if mt.ESTOP else 0) | (COARSE if mt.coarse else 0)
+    with _lock:
+        if _buf is not None:
+            _write(slot, mt.position, time.time(), mt.uuid, mt.state, mt.direction, flags)
+
+
+def publisher(mt):
+    """
+    Prepares per step publishing for a move - state, direction and flags are fixed to their current values
+    :return: function taking new position, or None if motor is not published
+    """
+    slot = _slots.get(mt.uuid)
+    if slot is None or _buf is None:
+        return None
+    publish(mt)
+    offset = HEADER.size + slot * SLOT_SIZE
+    data_offset = offset + SEQ.size
+    uuid, state, direction = mt.uuid, mt.state, mt.direction
+    flags = (HOMED if mt.homed else 0) | (ESTOP if mt.ESTOP else 0) | (COARSE if mt.coarse else 0)
+    pack_seq, pack_data, now = SEQ.pack_into, DATA.pack_into, time.time
+
+    def publish_position(position):
+        with _lock:
+            buf = _buf
+            if buf is None:
+                return
+            seq = _seq[slot]
+            pack_seq(buf, offset, seq + 1)
+            pack_data(buf, data_offset, position, now(), uuid, state, direction, flags)
+            pack_seq(buf, offset, seq + 2)
+            _seq[slot] = seq + 2
+    return publish_position
+
+
+def _write(slot, *data):
+    offset = HEADER.size + slot * SLOT_SIZE
+    seq = _seq.get(slot, 0)
+    SEQ.pack_into(_buf, offset, seq + 1)
+    DATA.pack_into(_buf, offset + SEQ.size, *data)
+    SEQ.pack_into(_buf, offset, seq + 2)
+    _seq[slot] = seq + 2
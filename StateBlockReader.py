@@ -0,0 +1,125 @@
+import collections
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# Reader of the motor state block a worker publishes in shared memory (see StateBlock), for processes on the
+# same host that need motor positions without going through HTTP. Only needs the standard library - copy this
+# file next to the consumer.
+#
+# Layout (little endian), segment name 'iotapi_state' by default:
+#   header '<4sHHH6x' - magic b'IOTS', version, slot count, slot size (16 bytes)
+#   slots  '<QqdHhbB2x' each - sequence, position (steps), wall time of update (s), motor uuid (0 = free slot),
+#          state, direction, flags (32 bytes)
+#
+# Every slot is a seqlock: the worker makes the sequence odd before changing a slot and even again once done.
+# A read is consistent when the sequence was even and unchanged across it, otherwise it is retried. Reads do
+# not block the worker and take a few microseconds.
+
+DEFAULT_NAME = 'iotapi_state'
+MAGIC = b'IOTS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH6x')
+SEQ = struct.Struct('<Q')
+DATA = struct.Struct('<qdHhbB2x')
+SLOT_SIZE = SEQ.size + DATA.size
+
+# Flags
+HOMED = 1
+ESTOP = 2
+COARSE = 4                  # coarse microstep mode, position still in fine steps
+
+# Motor states, as in Stepper
+STATES = {50: 'DISABLED', 100: 'IDLE', 200: 'MOVING', 250: 'HOMING', -10: 'ERROR', -20: 'HARDKILL',
+          -100: 'UNKNOWN', -50: 'UNINITIALIZED'}
+
+MAX_RETRIES = 10000
+
+MotorState = collections.namedtuple('MotorState', 'uuid seq position time state direction flags')
+
+
+class StateBlockClosed(Exception):
+    pass
+
+
+class StateBlockReader:
+    def __init__(self, name=DEFAULT_NAME):
+        self._shm = shared_memory.SharedMemory(name)
+        # Attaching registers the segment for unlinking at our exit, which is the worker's business
+        resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._buf = self._shm.buf
+        magic, version, self.slots, slot_size = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            self.close()
+            raise ValueError('Shared memory {} is not a motor state block of version {}'.format(name, VERSION))
+        self._index = {}
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+
+    def _read_slot(self, slot):
+        buf = self._buf
+        offset = HEADER.size + slot * SLOT_SIZE
+        for _ in range(MAX_RETRIES):
+            seq = SEQ.unpack_from(buf, offset)[0]
+            if not seq & 1:
+                data = DATA.unpack_from(buf, offset + SEQ.size)
+                if SEQ.unpack_from(buf, offset)[0] == seq:
+                    return MotorState(data[2], seq, data[0], data[1], data[3], data[4], data[5])
+        raise RuntimeError('Slot {} kept changing over {} read attempts'.format(slot, MAX_RETRIES))
+
+    def _check(self):
+        if self._buf is None or HEADER.unpack_from(self._buf, 0)[0] != MAGIC:
+            raise StateBlockClosed('Worker closed the state block, open it again')
+
+    def read(self, uuid):
+        """
+        :return: consistent MotorState of motor, None if it is not published
+        """
+        # Checked on every read - a closed or replaced block would otherwise keep serving its last data
+        self._check()
+        slot = self._index.get(uuid)
+        if slot is not None:
+            state = self._read_slot(slot)
+            if state.uuid == uuid:
+                return state
+        # Slot unknown or reassigned, look it up again
+        for slot in range(self.slots):
+            state = self._read_slot(slot)
+            if state.uuid == uuid:
+                self._index[uuid] = slot
+                return state
+        return None
+
+    def read_all(self):
+        """
+        :return: dict of uuid to MotorState of all published motors
+        """
+        self._check()
+        states = (self._read_slot(slot) for slot in range(self.slots))
+        return {s.uuid: s for s in states if s.uuid}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="IOTAPi shared memory motor state reader")
+    parser.add_argument("--name", help="shared memory segment name", default=DEFAULT_NAME)
+    parser.add_argument("--watch", help="s between reads, keeps printing", type=float)
+    args = parser.parse_args()
+    reader = StateBlockReader(args.name)
+    try:
+        while True:
+            for s in sorted(reader.read_all().values()):
+                print('{} pos {} dir {} {} flags {} seq {} age {:.3f} s'.format(
+                    s.uuid, s.position, s.direction, STATES.get(s.state, s.state), s.flags, s.seq,
+                    time.time() - s.time))
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
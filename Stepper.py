@@ -1,3 +1,5 @@
+import array
+import collections
 import logging
 import math
 import queue
@@ -5,7 +7,17 @@ import threading
 import time
 
 import GPIOMgr
+import History
+import Metrics
+import PositionStore
+import StateBlock
+import Supervisor
+import Trace
+import Trajectory
 import Util
+import Waveform
+
+logger = logging.getLogger(__name__)
 
 DISABLED = 50       # Disabled but otherwise normal
 IDLE = 100          # Enabled but idle
@@ -24,6 +36,97 @@ ILOCK_ESTOP = 120
 ILOCK_OK = 10
 ILOCK_STR = {100: 'ILOCK_DN', 110: 'ILOCK_UP', 120: 'ILOCK_ESTOP'}
 
+MOVE_RESULT_STR = {0: 'done', -1: 'stopped', -2: 'failed'}
+
+PROFILE_CACHE_STEPS = 1000000     # total steps of planned profiles kept for reuse
+
+_profile_cache = collections.OrderedDict()
+_profile_cache_steps = 0
+_profile_lock = threading.Lock()
+
+
+def plan_profile(ns, jerk, vel, acc, stopevt=None):
+    """
+    Plans smooth motion profile of ns steps, reusing plans of identical earlier moves. Has no side effects
+    besides the cache, so it also serves dry runs.
+    :param stopevt: event polled while planning long profiles
+    :return: (array of inter-step delays in s, summary dict with duration and per phase (steps, time)),
+             or None if stopevt got set while planning
+    """
+    global _profile_cache_steps
+    key = (ns, jerk, vel, acc)
+    with _profile_lock:
+        plan = _profile_cache.get(key)
+        if plan is not None:
+            _profile_cache.move_to_end(key)
+            return plan
+
+    steps_to_full_speed = int((vel*vel)/(2*acc))
+    slowdown_step = int(ns - steps_to_full_speed + 1)
+    if ns < steps_to_full_speed*2:
+        # Won't get to full speed, slow down halfway
+        slowdown_step = ns/2 + 1
+
+    ramping_up = True
+    ramping_down = False
+    initial_delay = math.sqrt(2.0/acc)
+    current_delay = initial_delay*0.676
+    min_delay = 1.0/vel
+    # We are using taylor series approximation to ideal ramp
+
+    delays = array.array('d')
+    phases = [[0, 0.0], [0, 0.0], [0, 0.0]]     # ramp up, cruise, ramp down
+    for i in range(1, ns+1):
+        if stopevt is not None and not i & 1023 and stopevt.is_set():
+            # Long profiles take a while to plan - do not make stop wait for it
+            return None
+        if ramping_up:
+            #current_delay -= 2 * current_delay / (4 * i + 1)
+            current_delay = initial_delay * (math.sqrt(i+1)-math.sqrt(i))
+            if current_delay < min_delay:
+                current_delay = min_delay
+                ramping_up = False
+            if i == slowdown_step:
+                ramping_up = False
+                ramping_down = True
+        elif ramping_down:
+            if i == ns:
+                delays.append(0)
+                phases[2][0] += 1
+                break
+            current_delay -= 2 * current_delay / (4 * (i - ns) + 1)
+        else:
+            if i == slowdown_step:
+                ramping_down = True
+        delays.append(current_delay)
+        phase = phases[0] if ramping_up else phases[2] if ramping_down else phases[1]
+        phase[0] += 1
+        phase[1] += current_delay
+
+        if current_delay > initial_delay or current_delay < 0:
+            logger.warning("Step %d - bad delay %f", i, current_delay)
+
+    positive = [d for d in delays if d > 0]
+    summary = {'steps': ns, 'duration': sum(delays), 'ramp_up': phases[0], 'cruise': phases[1],
+               'ramp_down': phases[2], 'peak_velocity': 1.0 / min(positive) if positive else 0.0}
+    plan = (delays, summary)
+    with _profile_lock:
+        if key not in _profile_cache:
+            _profile_cache[key] = plan
+            _profile_cache_steps += ns
+            while _profile_cache_steps > PROFILE_CACHE_STEPS and len(_profile_cache) > 1:
+                _, (old, _) = _profile_cache.popitem(last=False)
+                _profile_cache_steps -= len(old)
+    return plan
+
+
+def start_rate(acc):
+    """
+    :return: rate of the first step of profiles planned at acc (steps/s) - a motor starts and stops at it
+             without ramping
+    """
+    return 1.0 / (math.sqrt(2.0 / acc) * (math.sqrt(2) - 1))
+
 
 class Stepper:
     DIR_UP = 1
@@ -31,20 +134,54 @@ class Stepper:
 
     ESTOP = False
 
+    # Homing - bound on limit search, slow search margin before expected limit (fraction of expected
+    # distance plus fixed part, capped), and speed fraction used for searching and backing off
+    HOMING_MAX_STEPS = 3 * 80 * 3600 #3in*80tpi*3600spr
+    HOMING_MARGIN_FRAC = 0.02
+    HOMING_MARGIN_MIN = 200
+    HOMING_MARGIN_MAX = 3600
+    HOMING_SLOW_FACTOR = 0.1
+
+    # Position-compare triggers armed per move
+    MAX_TRIGGERS = 100000
+
+    # Scheduled moves - busy wait window before release, time before release the move lock is taken to enable
+    # and plan under it, and how far ahead a move may be scheduled (s)
+    START_SPIN_TIME = 0.002
+    ARM_LEAD = 0.5
+    MAX_SCHEDULE_AHEAD = 3600
+
+    # Microstep switching - driver settle time after mode pin change (s), and defaults of fine approach length
+    # (in coarse steps) and shortest coarse stretch worth switching for (in coarse pulses)
+    MICROSTEP_SETTLE = 0.001
+    MICROSTEP_APPROACH = 4
+    MICROSTEP_MIN_COARSE = 10
+
     position = -1
     state = UNKNOWN
 
     def __init__(self, uuid, name, fname, dr, st, en, sl, LUp, LDn, LUpState, LDnState, st_size, ptime, st_dtime, aen, adis,
-                 jerk, vel, acc):
+                 jerk, vel, acc, trig=None, soft_margin=0, microstep=None, backlash=0,
+                 waveform=None, start_speed=None):
         self.logger = logging.getLogger(__name__+'.'+str(uuid))
         try:
             # Sanity checks
             assert (all(x in Util.BCM_PINS for x in [dr, st, en, sl, LUp, LDn]))
+            assert trig is None or (trig in Util.BCM_PINS and trig not in [dr, st, en, sl, LUp, LDn])
             assert (all(x in [0, 1] for x in [LUpState, LDnState]))
             assert (0 <= ptime < 1000)
             assert (0 <= st_dtime < 1000)
             for i in [jerk, vel, acc]:
                 assert (0 <= i < 20000)
+            assert start_speed is None or 0 < start_speed < 20000
+            assert st_size > 0 and soft_margin >= 0
+            assert 0 <= backlash < 10000
+            if microstep is not None:
+                assert all(x in Util.BCM_PINS and x not in [dr, st, en, sl, LUp, LDn, trig]
+                           for x in microstep['pins'])
+                assert all(len(microstep[k]) == len(microstep['pins']) and all(x in [0, 1] for x in microstep[k])
+                           for k in ['fine', 'coarse'])
+                assert int(microstep['ratio']) > 1
 
             # Basic parameters
             self.uuid = uuid
@@ -56,28 +193,80 @@ class Stepper:
             self.PIN_SLEEP = sl
             self.PIN_LIM_UP, self.LIM_UP_HIT = LUp, LUpState
             self.PIN_LIM_DN, self.LIM_DN_HIT = LDn, LDnState
+            self.PIN_TRIGGER = trig
 
-            # Step size factor corresponds to 1/microsteps, with single steps at 256 level
+            # Step size - user units per step, for absolute positions given in units
             self.step_size = st_size
 
+            # Soft limits are kept this many steps inside the homed range
+            self.soft_margin = soft_margin
+
+            # Optional microstep mode select pins with their fine and coarse levels. Position, limits and all
+            # step counts stay in fine steps, a coarse pulse moves ratio of them. Velocity is a pulse rate, so
+            # coarse travel is ratio times faster at the same step loop speed. Acceleration is divided by ratio
+            # for coarse phases, keeping the physical acceleration (and load on the mechanics) the configured one
+            if microstep is not None:
+                self.PINS_MICROSTEP = list(microstep['pins'])
+                self.MICROSTEP_FINE = list(microstep['fine'])
+                self.MICROSTEP_COARSE = list(microstep['coarse'])
+                self.microstep_ratio = int(microstep['ratio'])
+                self.microstep_approach = int(microstep.get('approach', self.MICROSTEP_APPROACH)) * \
+                    self.microstep_ratio
+                self.microstep_min_coarse = int(microstep.get('min_coarse', self.MICROSTEP_MIN_COARSE))
+            else:
+                self.PINS_MICROSTEP = []
+                self.microstep_ratio = 1
+            self.coarse = False
+
+            # Backlash of the drive train in steps, taken up by extra pulses when a move reverses. Direction the
+            # drive train was last driven in (None until first motion), and take-up pulses still missing to load
+            # it there - nonzero when a move was cut short during take-up, carried into the next move
+            self.backlash = int(backlash)
+            self.loaded_dir = None
+            self.takeup_left = 0
+            # Step pulses issued since start, take-up and reversals included - what history records per command
+            self.pulse_count = 0
+
+            # Optional hardware-timed step output backend (see Waveform), connected on initialization
+            self.waveform_backend = waveform
+            self.waveform = None
+
             # Converting pulse time to s (below 1ms is not possible without RT kernel or C bindings)
             self.pulse_time = ptime / 1000.0
             self.step_delay = st_dtime / 1000.0
 
             # Motion parameters
             self.jerk, self.vel, self.acc = jerk, vel, acc
+            # Speed trajectories may start, stop and change velocity by at once, step loop start rate if not given
+            self.start_speed = start_speed
 
             self.auto_enable = bool(aen)
             self.auto_disable = bool(adis)
 
             self.state = UNINITIALIZED
             self.homed = False
+            # Set when a waveform move was halted and position was settled from its schedule, not from
+            # counted pulses - kept in the state file until the next homing
+            self.position_estimated = False
+            self.home_dir = Stepper.DIR_DN
+            self.travel_range = None
+            self.last_home_drift = None
+            self.error = 0
+            self.stop_requested_at = None
+            self.last_stop_latency = None
+            self.last_start_skew = None
+            self.trajectory = None
+            self.trigger_report = None
+            self.current = None
+            self.move_target = None
+            self.move_eta = None
+            self.step_overhead = 0.0
             self.thread_on = False
+            self.ilock_state = ILOCK_OK
 
-            # Event indicating new command
+            # Event indicating stop request, and command intake drained by the supervisor
             self.stopevt = threading.Event()
-            self.doneevt = threading.Event()
-            self.queue = queue.Queue(maxsize=100)
+            self.queue = Supervisor.CommandQueue(maxsize=100)
 
             self.logger.info('NEW Stepper (%s) (uuid %s) (fname %s) with pins %d,%d,%d,%d,%d,%d (Dr,St,En,Sl,LUp,LDn)',
                              name, uuid, fname, dr, st, en, sl, LUp, LDn)
@@ -116,16 +305,53 @@ class Stepper:
         GPIOMgr.set_mode_outputs(set1b, GPIOMgr.GPIO.HIGH)
         # Enable limit pullups
         GPIOMgr.set_mode_inputs(set2, GPIOMgr.GPIO.PUD_UP)
+        if self.PIN_TRIGGER is not None:
+            GPIOMgr.set_mode_outputs([self.PIN_TRIGGER], GPIOMgr.GPIO.LOW)
+        # Start out fine, anything not going through move planning expects it
+        if self.PINS_MICROSTEP:
+            for pin, level in zip(self.PINS_MICROSTEP, self.MICROSTEP_FINE):
+                GPIOMgr.set_mode_outputs([pin], level)
+        self.coarse = False
+        if self.waveform_backend and self.waveform is None:
+            try:
+                self.waveform = Waveform.open_backend(self.waveform_backend)
+                self.logger.info('Step output through %s waveform backend', self.waveform_backend)
+            except Waveform.WaveformException as e:
+                self.logger.error('Waveform backend unavailable (%s) - using step loop', e)
+        # Pick up where previous run left off, if that can be trusted
+        self._restore_state()
         self.logger.info("Motor %s initialized - dir %s, en %s, awk %s",
                          self.name, self.direction, self.enabled, self.awake)
 
-        # Create and start thread
-        thread = threading.Thread(name='mt_thr_{}'.format(self.uuid), target=self.control_thread, args=())
-        self.t = thread
-        thread.setDaemon(False)
-        thread.start()
-
         self.state = DISABLED
+        StateBlock.register(self)
+
+        # Hand command intake over to the supervisor
+        Supervisor.register(self)
+
+    # Restores position and homing state from state file if it passes validation, then marks motor as running
+    def _restore_state(self):
+        state = PositionStore.load(self.uuid)
+        if state is None:
+            self.logger.info('No stored state for motor %s, starting unhomed at 0', self.uuid)
+        else:
+            # Travel is a property of the mechanics, so it is kept even if position can not be trusted
+            self.travel_range = state['travel'] or None
+            ok, homed, reason = PositionStore.validate(state, self.is_lim_reached(Stepper.DIR_UP),
+                                                       self.is_lim_reached(Stepper.DIR_DN))
+            clean = bool(state['flags'] & PositionStore.CLEAN)
+            if ok:
+                self.position = state['position']
+                self.homed = homed
+                self.home_dir = Stepper.DIR_UP if state['flags'] & PositionStore.HOME_UP else Stepper.DIR_DN
+                if state['direction'] != self.direction:
+                    self._set_direction(state['direction'])
+                self.logger.info('Restored position %d (homed %s) from %s shutdown (seq %d) - %s', self.position,
+                                 self.homed, 'clean' if clean else 'UNCLEAN', state['seq'], reason)
+            else:
+                self.logger.warning('Discarding stored position %d from %s shutdown - %s', state['position'],
+                                    'clean' if clean else 'UNCLEAN', reason)
+        PositionStore.save(self, force=True)
 
     # For steppers, we can reset live without any further actions
     def reinitialize(self):
@@ -135,208 +361,676 @@ class Stepper:
     def is_moving(self):
         return self.state == MOVING or self.state == HOMING
     
-    def control_thread(self):
+    def execute(self, queued_at, msg):
         """
-        Independent thread responsible for executing motor commands
-        :return:
+        Executes single motor command, called on motor executor thread by the supervisor
+        :param queued_at: perf_counter timestamp of enqueueing
+        :param msg: command message
+        :return: command result code (None if command was ignored)
         """
-        self.logger.info('Motor %s control thread starting up', self.uuid)
-        self.thread_on = True
+        Trace.record(self.uuid, Trace.QUEUE_POP, self.queue.qsize())
+        Metrics.queue_wait.observe(time.perf_counter() - queued_at, self.uuid)
+        self.logger.info('Thread command %s', msg)
+        started, initial_pulses = time.time(), self.pulse_count
+        result = None
+        StateBlock.publish(self)
         try:
-            while self.thread_on:
-                # Get next msg
-                try:
-                    msg = self.queue.get(block=True, timeout=0.05)
-                except queue.Empty:
-                    pass
+            result = self._run_command(msg)
+            return result
+        finally:
+            PositionStore.save(self, force=True)
+            StateBlock.publish(self)
+            History.record_command(self.uuid, msg, started, time.time(), self.pulse_count - initial_pulses,
+                                   result)
+
+    def _run_command(self, msg):
+        if msg[0] == 'move_to':
+            # Absolute move is resolved against actual position only now, so it is exact whatever ran before.
+            # Optional (vel, acc) profile replaces configured motion parameters for this move only
+            delta = msg[1] - self.position
+            direction = self.direction if delta == 0 else (Stepper.DIR_UP if delta > 0 else Stepper.DIR_DN)
+            msg = ['move', direction, abs(delta), False] + ([None, None, msg[2]] if len(msg) > 2 else [])
+        if msg[0] == 'move':
+            ilock = self.check_interlocks(raise_exc=False)
+            direction = msg[1]
+            numsteps = msg[2]
+            force = msg[3]
+            start_at = msg[4] if len(msg) > 4 else None
+            triggers = msg[5] if len(msg) > 5 else None
+            vel, acc = msg[6] if len(msg) > 6 and msg[6] is not None else (None, None)
+            if ilock != ILOCK_OK:
+                if force:
+                    self.logger.warning('Forced move with active interlock %s - this is dangerous!', ilock)
                 else:
-                    self.logger.info('Thread command %s', msg)
-                    if msg[0] == 'move':
-                        ilock = self.check_interlocks(raise_exc=False)
-                        direction = msg[1]
-                        numsteps = msg[2]
-                        force = msg[3]
-                        if ilock != ILOCK_OK:
-                            if force:
-                                self.logger.warning('Forced move with active interlock %s - this is dangerous!', ilock)
-                            else:
-                                self.logger.warning('Interlock fail %s - move ignored!', ilock)
-                                self.doneevt.set()
-                                continue
-
-                        # Acquire move lock to ensure only this motor will move
-                        with GPIOMgr.movelock:
-                            self.logger.info("Move %d steps in direction %d", numsteps, direction)
-                            if direction != self.direction:
-                                self.state = MOVING
-                                self._set_direction(direction)
-                                self.state = IDLE
-                                self.logger.debug("Direction changed to %s", direction)
-                            else:
-                                self.logger.debug("Direction %s already correct", direction)
+                    self.logger.warning('Interlock fail %s - move ignored!', ilock)
+                    Metrics.moves_total.inc(self.uuid, 'rejected')
+                    return None
+            end = self.position + (numsteps if direction == Stepper.DIR_UP else -numsteps)
+            error = None if force else self._soft_limit_error(end, self.position)
+            if error is not None:
+                self.logger.warning('%s - move ignored!', error)
+                Metrics.moves_total.inc(self.uuid, 'rejected')
+                return None
+            self.move_target = (self.current, end)
 
-                            if numsteps == 0:
-                                self.logger.debug("Not moving since step number is 0")
-                            else:
-                                if self.state == DISABLED:
-                                    if self.auto_enable:
-                                        self._enable_direct()
-                                    else:
-                                        self.logger.warning('not enabled, ignoring move command!')
-                                        continue
-                                self.state = MOVING
-                                self.logger.debug("Doing %d steps", numsteps)
-                                try:
-                                    result = self._do_steps(numsteps, override=force)
-                                except MoveException as e:
-                                    self.logger.exception("Exception triggered during move!")
-                                    self.error = -2
-                                    result = -2
-                                self.logger.info("Motion finished, result code: %s", result)
-                                self.state = IDLE
-                            if self.auto_disable:
-                                self._disable_direct()
-                            self.doneevt.set()
-                    if msg[0] == 'home':
-                        ilock = self.check_interlocks(raise_exc=False)
-                        if ilock != ILOCK_OK:
-                            self.logger.warning('Interlock %s FAIL - move ignored!', ILOCK_STR[ilock])
-                            continue
-                        direction = msg[1]
-
-                        # Acquire move lock to ensure only this motor will move
-                        with GPIOMgr.movelock:
-                            self.logger.info("Home in direction %d", direction)
-                            if direction != self.direction:
-                                self.state = MOVING
-                                self._set_direction(direction)
-                                self.state = IDLE
-                                self.logger.debug("Direction changed to %s", self.direction)
-                            else:
-                                self.logger.debug("Direction %s already correct", self.direction)
-
-                            self.state = MOVING
-                            self.logger.debug("Moving until interlock trigger")
-                            initial_pos = self.position
-                            try:
-                                maxsteps = 3 * 80 * 3600 #3in*80tpi*3600spr
-                                self._do_steps(maxsteps, vel=self.vel)
-                            except MoveException as e:
-                                delta_steps = self.position - initial_pos
-                                self.logger.info('Limit hit after %d steps, backing off', delta_steps)
-                            else:
-                                raise MoveException("Did not hit limit over max number of steps!!!")
-                            time.sleep(0.1)
-
-                            initial_pos = self.position
-                            try:
-                                self._set_direction(direction ^ 1)
-                                self.logger.debug("Direction changed to %s", self.direction)
-                                self._do_steps(3600 * 10, jerk=0, vel=self.vel/10, acc=self.acc/5, override=True, stop_on_unlatch=True)
-                            except MoveException as e:
-                                delta_steps = self.position - initial_pos
-                                self.logger.info('Limit removed after %d steps, this is new zero', delta_steps)
-                                self.position = 0
-                                self.homed = True
-                            else:
-                                self.logger.error("ilock release backoff failed!")
-                                self.state = IDLE
-                                self.doneevt.set()
-
-                            self.logger.info("Homing finished")
-                            self.state = IDLE
-                            self.doneevt.set()
-                    elif msg[0] == 'enable':
-                        force = msg[1]
-                        ilock = self.check_interlocks(raise_exc=False)
-                        if ilock != ILOCK_OK and not force:
-                            self.logger.warning('interlock %s FAIL, enable ignored!', ILOCK_STR[ilock])
-                            continue
-                        if self.error != 0:
-                            if force:
-                                self.logger.debug('error %s cleared)', self.error)
-                                self.error = 0
+            result = None
+            if start_at is not None:
+                # Bulk of the wait for a scheduled move is spent without the move lock, other motors keep moving
+                if self.stopevt.wait(max(0.0, start_at - self.ARM_LEAD - time.time())):
+                    return self._on_stop()
+            # Acquire move lock to ensure only this motor will move
+            with GPIOMgr.hold_movelock(self.uuid):
+                self.logger.info("Move %d steps in direction %d", numsteps, direction)
+                if self.stopevt.is_set():
+                    return self._on_stop()
+                if direction != self.direction:
+                    self.state = MOVING
+                    self._set_direction(direction)
+                    self.state = IDLE
+                    self.logger.debug("Direction changed to %s", direction)
+                else:
+                    self.logger.debug("Direction %s already correct", direction)
+
+                if numsteps == 0:
+                    self.logger.debug("Not moving since step number is 0")
+                else:
+                    if self.state == DISABLED:
+                        if self.auto_enable:
+                            self._enable_direct()
+                        else:
+                            self.logger.warning('not enabled, ignoring move command!')
+                            return None
+                    self.state = MOVING
+                    self.logger.debug("Doing %d steps", numsteps)
+                    initial_pos, t_start = self.position, time.perf_counter()
+                    # Reversal first takes up backlash, within the same ramp and without counting as position
+                    takeup = self._takeup(direction)
+                    if takeup:
+                        self.logger.debug("Direction reversal, %d steps of backlash take-up", takeup)
+                    if triggers is not None:
+                        triggers = self._arm_triggers(triggers, numsteps)
+                        phases = [(numsteps, 1)]
+                    else:
+                        phases = self._microstep_phases(numsteps, self.position, direction)
+                    try:
+                        if len(phases) == 1:
+                            # Planned up front (stop aware), estimate then reuses the plan
+                            delays = self._plan_delays(numsteps + takeup, vel=vel, acc=acc)
+                            if delays is None:
+                                result = self._on_stop()
                             else:
-                                self.logger.warning('error code %s present, enable ignored (use force to clear)', self.error)
-                                continue
-                        # Acquire move lock
-                        with GPIOMgr.movelock:
+                                self.move_eta = (self.current, max(time.time(), start_at or 0) +
+                                                 self.estimate_move(numsteps + takeup, vel, acc))
+                                result = self._do_steps(numsteps + takeup, override=force, delays=delays,
+                                                        start_at=start_at, triggers=triggers, takeup=takeup)
+                        else:
+                            phases[0] = (phases[0][0] + takeup, 1)
+                            self.move_eta = (self.current, max(time.time(), start_at or 0) +
+                                             self._estimate_phases(phases, vel, acc))
+                            result = self._do_phases(phases, force, start_at, takeup, vel, acc)
+                    except MoveException as e:
+                        self.logger.exception("Exception triggered during move!")
+                        self.error = -2
+                        result = -2
+                    finally:
+                        self._set_coarse(False)
+                    if result == 0 and start_at is None and len(phases) == 1 and vel is None and acc is None:
+                        self._learn_overhead(numsteps + takeup, time.perf_counter() - t_start)
+                    self.logger.info("Motion finished, result code: %s", result)
+                    Metrics.steps_total.inc(self.uuid, amount=abs(self.position - initial_pos))
+                    Metrics.moves_total.inc(self.uuid, MOVE_RESULT_STR.get(result, 'failed'))
+                    Metrics.move_duration.observe(time.perf_counter() - t_start, self.uuid)
+                    self.state = IDLE
+                if self.auto_disable:
+                    self._disable_direct()
+            return result
+        elif msg[0] == 'trajectory':
+            buf = msg[1]
+            try:
+                ilock = self.check_interlocks(raise_exc=False)
+                if ilock != ILOCK_OK:
+                    self.logger.warning('Interlock %s FAIL - trajectory ignored!', ILOCK_STR[ilock])
+                    Metrics.moves_total.inc(self.uuid, 'rejected')
+                    return None
+
+                result = None
+                # Acquire move lock to ensure only this motor will move
+                with GPIOMgr.hold_movelock(self.uuid):
+                    if self.stopevt.is_set():
+                        return self._on_stop()
+                    if self.state == DISABLED:
+                        if self.auto_enable:
                             self._enable_direct()
-                    elif msg[0] == 'disable':
-                        ilock = self.check_interlocks(raise_exc=False)
-                        if ilock != ILOCK_OK:
-                            self.logger.warning('interlock %s FAIL, proceeding with disable anyways', ILOCK_STR[ilock])
-                        # Acquire move lock
-                        with GPIOMgr.movelock:
-                            self._disable_direct()
+                        else:
+                            self.logger.warning('not enabled, ignoring trajectory command!')
+                            return None
+                    try:
+                        buf.set_origin(self.position)
+                    except SoftLimitException as e:
+                        self.logger.warning('%s - trajectory ignored!', e)
+                        Metrics.moves_total.inc(self.uuid, 'rejected')
+                        return None
+                    self.state = MOVING
+                    initial_pos, t_start = self.position, time.perf_counter()
+                    try:
+                        result = self._do_trajectory(buf)
+                    except MoveException as e:
+                        self.logger.exception("Exception triggered during trajectory!")
+                        self.error = -2
+                        result = -2
+                    self.logger.info("Trajectory finished after %d segments, result code: %s", buf.head, result)
+                    Metrics.steps_total.inc(self.uuid, amount=abs(self.position - initial_pos))
+                    Metrics.moves_total.inc(self.uuid, MOVE_RESULT_STR.get(result, 'failed'))
+                    Metrics.move_duration.observe(time.perf_counter() - t_start, self.uuid)
+                    self.state = IDLE
+                    if self.auto_disable:
+                        self._disable_direct()
+                return result
+            finally:
+                buf.close()
+        elif msg[0] == 'home':
+            ilock = self.check_interlocks(raise_exc=False)
+            if ilock != ILOCK_OK:
+                self.logger.warning('Interlock %s FAIL - move ignored!', ILOCK_STR[ilock])
+                return None
+            direction = msg[1]
+
+            # Acquire move lock to ensure only this motor will move
+            with GPIOMgr.hold_movelock(self.uuid):
+                self.logger.info("Home in direction %d", direction)
+                if self.stopevt.is_set():
+                    return self._on_stop()
+                if direction != self.direction:
+                    self.state = MOVING
+                    self._set_direction(direction)
+                    self.state = IDLE
+                    self.logger.debug("Direction changed to %s", self.direction)
+                else:
+                    self.logger.debug("Direction %s already correct", self.direction)
+
+                self.state = MOVING
+                home_start_pos = self.position
+                result = self._seek_limit(direction, self._distance_to_limit(direction))
+                if result == 0:
+                    # Settle, but remain preemptible
+                    if self.stopevt.wait(0.1):
+                        result = self._on_stop()
                     else:
-                        continue
-            self.logger.debug('Thread %s stopping gracefully!', self.t.name)
-        except (KeyboardInterrupt, SystemExit) as e:
-            self.logger.info('Thread %s shutting down gracefully',self.t.name)
-            GPIOMgr.shutdown()
-            self.thread_on = False
-        except Exception as e:
-            self.logger.exception(e)
-            self.thread_on = False
+                        result = self._release_limit(direction ^ 1)
+                if result == 0:
+                    if self.homed and self.home_dir != direction:
+                        # Zeroing at the opposite end of a known position measures full travel on the way
+                        self._learn_travel(abs(self.position))
+                    elif self.homed:
+                        self.logger.info('Re-zeroing with %d steps of drift', self.position)
+                        self.last_home_drift = self.position
+                    self.position = 0
+                    self.homed = True
+                    self.position_estimated = False
+                    self.home_dir = direction
+                self.logger.info("Homing finished, result code: %s", result)
+                Metrics.steps_total.inc(self.uuid, amount=abs(self.position - home_start_pos))
+                self.state = IDLE
+            return result
+        elif msg[0] == 'range':
+            # Travel check - seek limit opposite to home and back off it, learning travel between the limits
+            if not self.homed:
+                self.logger.warning('Range check requires homed motor - ignored!')
+                return None
+            ilock = self.check_interlocks(raise_exc=False)
+            if ilock != ILOCK_OK:
+                self.logger.warning('Interlock %s FAIL - range check ignored!', ILOCK_STR[ilock])
+                return None
+            far = self.home_dir ^ 1
 
-    def _do_steps(self, ns, jerk=None, vel=None, acc=None, override=False, stop_on_unlatch=False):
-        # Busy wait smooth motion algorithm
-        jerk = jerk or self.jerk
-        vel = vel or self.vel
-        acc = acc or self.acc
-        time_to_full_speed = (vel-jerk)/acc
-        steps_to_full_speed = int((vel*vel)/(2*acc))
-        slowdown_step = int(ns - steps_to_full_speed + 1)
-        dir_factor = 1 if self.direction == 1 else -1
-        self.logger.debug('%f s to full speed', time_to_full_speed)
-        self.logger.debug('%f steps to full speed', steps_to_full_speed)
-        if ns < steps_to_full_speed*2:
-            # Won't get to full speed, slow down halfway
-            self.logger.debug('Wont get to full speed, modifying slowdown step')
-            slowdown_step = ns/2 + 1
-        self.logger.debug('%f is slowdown step', slowdown_step)
-
-        ramping_up = True
-        ramping_down = False
-        current_speed = jerk
-        initial_delay = math.sqrt(2.0/acc)
-        current_delay = initial_delay*0.676
-        min_delay = 1.0/vel
-        self.logger.debug("Initial delay: %f ms", initial_delay*1000)
-        self.logger.debug("Min delay: %f ms", min_delay * 1000)
-        # We are using taylor series approximation to ideal ramp
-
-        delays = []
-        for i in range(1, ns+1):
-            if ramping_up:
-                #current_delay -= 2 * current_delay / (4 * i + 1)
-                current_delay = initial_delay * (math.sqrt(i+1)-math.sqrt(i))
-                if current_delay < min_delay:
-                    self.logger.debug("Delay before end: %f ms", current_delay * 1000.0)
-                    current_delay = min_delay
-                    ramping_up = False
-                    self.logger.debug("Rampup end (step %d)", i)
-                if i == slowdown_step:
-                    ramping_up = False
-                    ramping_down = True
-                    self.logger.debug("Turnaround before rampup end")
-                    self.logger.debug("Rampdown start (step %d)", i)
-            elif ramping_down:
-                if i == ns:
-                    delays.append(0)
-                    break
-                current_delay -= 2 * current_delay / (4 * (i - ns) + 1)
+            # Acquire move lock to ensure only this motor will move
+            with GPIOMgr.hold_movelock(self.uuid):
+                if self.stopevt.is_set():
+                    return self._on_stop()
+                self.state = MOVING
+                range_start_pos = self.position
+                result = self._seek_limit(far, self._distance_to_limit(far))
+                if result == 0:
+                    if self.stopevt.wait(0.1):
+                        result = self._on_stop()
+                    else:
+                        result = self._release_limit(far ^ 1)
+                if result == 0:
+                    self._learn_travel(abs(self.position))
+                self.logger.info("Range check finished, result code: %s", result)
+                Metrics.steps_total.inc(self.uuid, amount=abs(self.position - range_start_pos))
+                self.state = IDLE
+            return result
+        elif msg[0] == 'enable':
+            force = msg[1]
+            ilock = self.check_interlocks(raise_exc=False)
+            if ilock != ILOCK_OK and not force:
+                self.logger.warning('interlock %s FAIL, enable ignored!', ILOCK_STR[ilock])
+                return None
+            if self.error != 0:
+                if force:
+                    self.logger.debug('error %s cleared)', self.error)
+                    self.error = 0
+                else:
+                    self.logger.warning('error code %s present, enable ignored (use force to clear)', self.error)
+                    return None
+            # Acquire move lock
+            with GPIOMgr.hold_movelock(self.uuid):
+                self._enable_direct()
+            return 0
+        elif msg[0] == 'disable':
+            ilock = self.check_interlocks(raise_exc=False)
+            if ilock != ILOCK_OK:
+                self.logger.warning('interlock %s FAIL, proceeding with disable anyways', ILOCK_STR[ilock])
+            # Acquire move lock
+            with GPIOMgr.hold_movelock(self.uuid):
+                self._disable_direct()
+            return 0
+        else:
+            return None
+
+    # Expected steps from current position to limit in given direction, None if unknown
+    def _distance_to_limit(self, direction):
+        if not self.homed:
+            return None
+        # Position grows away from the home limit
+        from_home = self.position if self.home_dir == Stepper.DIR_DN else -self.position
+        if direction == self.home_dir:
+            return max(from_home, 0)
+        elif self.travel_range:
+            return max(self.travel_range - from_home, 0)
+        else:
+            return None
+
+    def _seek_limit(self, direction, expected=None):
+        """
+        Drives until limit in given direction is hit. With expected distance known, covers the bulk of it at
+        full speed and only searches the last few percent (or beyond) slowly.
+        :return: 0 on limit hit, -1 if stopped
+        """
+        if direction != self.direction:
+            self._set_direction(direction)
+            self.logger.debug("Direction changed to %s", self.direction)
+        initial_pos = self.position
+        remaining = self.HOMING_MAX_STEPS
+        vel = self.vel
+        try:
+            if expected is not None:
+                margin = min(self.HOMING_MARGIN_MAX, self.HOMING_MARGIN_MIN + self.HOMING_MARGIN_FRAC * expected)
+                if expected > margin:
+                    fast = int(expected - margin)
+                    self.logger.debug('Fast approach over %d of %d expected steps', fast, expected)
+                    if self._do_steps(fast, vel=self.vel, per_step=True) == -1:
+                        return -1
+                    remaining -= fast
+                vel = self.vel * self.HOMING_SLOW_FACTOR
+            self.logger.debug("Searching for limit at %f sps", vel)
+            result = self._do_steps(remaining, vel=vel, per_step=True)
+        except MoveException as e:
+            self.logger.info('Limit hit after %d steps', abs(self.position - initial_pos))
+            return 0
+        if result == -1:
+            self.logger.warning('Limit search aborted by stop')
+            return result
+        raise MoveException("Did not hit limit over max number of steps!!!")
+
+    def _release_limit(self, direction):
+        """
+        Backs off slowly from active limit until it unlatches
+        :return: 0 on release, -1 if stopped, -2 if limit never released
+        """
+        initial_pos = self.position
+        try:
+            self._set_direction(direction)
+            self.logger.debug("Direction changed to %s", self.direction)
+            result = self._do_steps(3600 * 10, jerk=0, vel=self.vel*self.HOMING_SLOW_FACTOR, acc=self.acc/5,
+                                    override=True, stop_on_unlatch=True)
+        except MoveException as e:
+            self.logger.info('Limit removed after %d steps', abs(self.position - initial_pos))
+            return 0
+        if result != -1:
+            self.logger.error("ilock release backoff failed!")
+            result = -2
+        return result
+
+    def _learn_travel(self, travel):
+        if self.travel_range:
+            self.logger.info('Travel between limits %d steps (previously %d)', travel, self.travel_range)
+        else:
+            self.logger.info('Travel between limits learned - %d steps', travel)
+        self.travel_range = travel
+
+    def _plan_delays(self, ns, jerk=None, vel=None, acc=None):
+        """
+        Precomputes inter-step delays of smooth motion profile
+        :return: array of delays in s, or None if stop was requested while planning
+        """
+        plan = plan_profile(ns, jerk or self.jerk, vel or self.vel, acc or self.acc, self.stopevt)
+        if plan is None:
+            return None
+        delays, summary = plan
+        self.logger.debug('Planned %d steps - %d/%d/%d up/cruise/down, %f s', ns, summary['ramp_up'][0],
+                          summary['cruise'][0], summary['ramp_down'][0], summary['duration'])
+        return delays
+
+    def estimate_move(self, ns, vel=None, acc=None):
+        """
+        Predicts move duration from planned profile plus step overhead observed on previous moves
+        :param vel: velocity of the move, if not the configured one
+        :param acc: acceleration of the move, if not the configured one
+        :return: duration in s
+        """
+        if ns == 0:
+            return 0.0
+        phases = self._microstep_phases(ns)
+        if len(phases) > 1:
+            return self._estimate_phases(phases, vel, acc)
+        return plan_profile(ns, self.jerk, vel or self.vel, acc or self.acc)[1]['duration'] + ns * self.step_overhead
+
+    def _microstep_phases(self, ns, pos=None, direction=None):
+        """
+        Splits move of ns fine steps into fine alignment to the coarse step grid, coarse travel and fine final
+        approach. Unknown start position is taken as aligned
+        :return: list of (pulses, fine steps per pulse), single fine phase when coarse travel does not pay off
+        """
+        ratio = self.microstep_ratio
+        if ratio == 1:
+            return [(ns, 1)]
+        if pos is None:
+            align = 0
+        else:
+            align = (-pos) % ratio if direction == Stepper.DIR_UP else pos % ratio
+        coarse = (ns - align - self.microstep_approach) // ratio
+        if coarse < self.microstep_min_coarse:
+            return [(ns, 1)]
+        return [(align, 1), (coarse, ratio), (ns - align - coarse * ratio, 1)]
+
+    # Predicts duration of phased move, as a move of its own per phase
+    def _estimate_phases(self, phases, vel=None, acc=None):
+        return sum(plan_profile(n, self.jerk, vel or self.vel, (acc or self.acc) / scale)[1]['duration'] +
+                   n * self.step_overhead + self.MICROSTEP_SETTLE for n, scale in phases if n)
+
+    # Take-up pulses a move in direction needs first - what is still missing towards the loaded direction, or
+    # the part of the backlash already crossed towards it when reversing
+    def _takeup(self, direction):
+        if self.loaded_dir is None:
+            return 0
+        if direction == self.loaded_dir:
+            return self.takeup_left
+        return self.backlash - self.takeup_left
+
+    def _do_phases(self, phases, force, start_at=None, takeup=0, vel=None, acc=None):
+        """
+        Runs phased move, switching microstep mode while standing between phases
+        :param takeup: backlash take-up pulses included in the first (fine) phase
+        :return: result code of the last phase run
+        """
+        result = 0
+        for pulses, scale in phases:
+            if not pulses:
+                continue
+            self._set_coarse(scale > 1)
+            self.logger.debug('%s phase of %d pulses', 'Coarse' if scale > 1 else 'Fine', pulses)
+            delays = self._plan_delays(pulses, vel=vel, acc=(acc or self.acc) / scale)
+            if delays is None:
+                return self._on_stop()
+            result = self._do_steps(pulses, override=force, delays=delays, start_at=start_at, scale=scale,
+                                    takeup=takeup)
+            start_at = None
+            takeup = 0
+            if result != 0:
+                break
+        return result
+
+    # Drives microstep mode select pins, letting the driver settle on change
+    def _set_coarse(self, coarse):
+        if coarse == self.coarse or not self.PINS_MICROSTEP:
+            return
+        for pin, level in zip(self.PINS_MICROSTEP, self.MICROSTEP_COARSE if coarse else self.MICROSTEP_FINE):
+            GPIOMgr.set_pin_value(pin, level)
+        self.coarse = coarse
+        time.sleep(self.MICROSTEP_SETTLE)
+
+    # Updates step overhead estimate from a finished move
+    def _learn_overhead(self, ns, elapsed):
+        if ns >= 100:
+            planned = plan_profile(ns, self.jerk, self.vel, self.acc)[1]['duration']
+            self.step_overhead += 0.2 * (max(0.0, (elapsed - planned) / ns) - self.step_overhead)
+
+    def queue_eta(self):
+        """
+        Predicts when running and queued commands of motor will be done
+        :return: dict with remaining time (s) and completion wall time (None if some command can not be
+                 predicted), and per command duration estimates
+        """
+        current, queued = Supervisor.pending(self)
+        now = time.time()
+        t, pos = now, self.position
+        commands = []
+        if current is not None:
+            target, eta = self.move_target, self.move_eta
+            if target is not None and target[0] is current and eta is not None and eta[0] is current:
+                # Already running, only what is left of it counts
+                t, pos = max(now, eta[1]), target[1]
+                commands.append({'cmd': current[0], 'duration': t - now, 'running': True})
             else:
-                if i == slowdown_step:
-                    ramping_down = True
-                    self.logger.debug("Rampdown start (step %d)", i)
-            # self.logger.debug("Step %d, speed %f sps", i, current_speed*1000)
-            delays.append(current_delay)
+                queued = [current] + queued
+        for msg in queued:
+            duration, pos = self._estimate(msg, pos)
+            commands.append({'cmd': msg[0], 'duration': duration})
+            if t is not None and msg[0] == 'move' and len(msg) > 4 and msg[4] is not None:
+                t = max(t, msg[4])
+            t = t + duration if t is not None and duration is not None else None
+        return {'remaining': t - now if t is not None else None, 'finish': t, 'commands': commands}
+
+    # Predicts (duration, end position) of command started from pos, None where not known in advance
+    def _estimate(self, msg, pos):
+        if msg[0] == 'move':
+            return self.estimate_move(msg[2]), self._project(msg, pos)
+        if msg[0] == 'move_to':
+            vel, acc = msg[2] if len(msg) > 2 and msg[2] is not None else (None, None)
+            return (self.estimate_move(abs(msg[1] - pos), vel, acc) if pos is not None else None), msg[1]
+        if msg[0] in ('enable', 'disable'):
+            return 0.0, pos
+        return None, self._project(msg, pos)
+
+    def _wait_until(self, start_at):
+        """
+        Holds an armed move until wall clock start_at - sleeps while far off, then busy waits for the last
+        stretch, so release is as exact as the step loop timing itself
+        :return: False if stop was requested while waiting
+        """
+        deadline = time.perf_counter() + (start_at - time.time())
+        self.logger.debug('Armed, releasing in %f s', deadline - time.perf_counter())
+        return self._hold_until(deadline)
+
+    # Waits for perf_counter deadline, sleeping for all but the last START_SPIN_TIME. False if stop was requested
+    def _hold_until(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > self.START_SPIN_TIME:
+            if self.stopevt.wait(remaining - self.START_SPIN_TIME):
+                return False
+        while time.perf_counter() < deadline:
+            if self.stopevt.is_set():
+                return False
+        return True
+
+    def _do_trajectory(self, buf):
+        """
+        Streams buffered trajectory segments into the step loop. Step times are kept on deadlines accumulated
+        from the trajectory start, so per step overheads do not add up over long trajectories - but a late step
+        never makes following ones catch up faster than max velocity.
+        """
+        if self.stopevt.is_set():
+            return self._on_stop()
+        PositionStore.save(self, moving=True, force=True)
+        Trace.record(self.uuid, Trace.MOVE_START, buf.total_steps)
+        trace = Trace.record
+        publish = StateBlock.publisher(self)
+        min_interval = 1.0 / self.vel
+        velocity = 0.0
+        last = 0.0
+        n = 0
+        deadline = time.perf_counter()
+        while True:
+            seg = buf.pop()
+            if seg is None:
+                if buf.done():
+                    break
+                if abs(velocity) > buf.start_speed:
+                    # Can not stop cleanly without data - better to drop out now than to guess
+                    raise MoveException('Trajectory buffer underrun at {:.1f} steps/s'.format(velocity))
+                self.logger.warning('Trajectory buffer empty, holding for data')
+                waited = time.perf_counter()
+                while not buf.wait(0.01):
+                    if self.stopevt.is_set():
+                        return self._on_stop(last)
+                    if time.perf_counter() - waited > Trajectory.UNDERRUN_WAIT:
+                        raise MoveException('Trajectory buffer underrun while holding')
+                deadline = max(deadline, time.perf_counter())
+                continue
+            steps, interval = seg
+            interval *= 1e-6
+            if steps == 0:
+                velocity = 0.0
+                deadline += interval
+                if not self._hold_until(deadline):
+                    return self._on_stop(last)
+                continue
+            direction = Stepper.DIR_UP if steps > 0 else Stepper.DIR_DN
+            if direction != self.direction:
+                self._set_direction(direction)
+                publish = StateBlock.publisher(self)
+            self.loaded_dir = direction
+            self.takeup_left = 0
+            dir_factor = 1 if steps > 0 else -1
+            velocity = dir_factor / interval
+            for _ in range(abs(steps)):
+                self.check_interlocks(raise_exc=True)
+                GPIOMgr.pulse_pin(self.PIN_STEP, 0)
+                self.pulse_count += 1
+                self.position += dir_factor
+                trace(self.uuid, Trace.PULSE, self.position)
+                if publish is not None:
+                    publish(self.position)
+                last = time.perf_counter()
+                n += 1
+                if not n & 255:
+                    PositionStore.save(self, moving=True)
+                deadline = max(deadline + interval, last + min_interval)
+                while time.perf_counter() < deadline:
+                    if self.stopevt.is_set():
+                        return self._on_stop(last)
+        trace(self.uuid, Trace.MOVE_END, 0)
+        return 0
 
-            if current_delay > initial_delay or current_delay < 0:
-                self.logger.warning("Step %d - bad delay %f", i, current_delay)
-        self.logger.debug('Precomputed delays list length: %d', len(delays))
+    def soft_limits(self):
+        """
+        Allowed position range, derived from homed range and shrunk by soft limit margin on both ends
+        :return: (low, high) with None for a side not known yet, or None if motor is not homed
+        """
+        if not self.homed:
+            return None
+        near = self.soft_margin
+        far = self.travel_range - self.soft_margin if self.travel_range else None
+        if self.home_dir == Stepper.DIR_DN:
+            return near, far
+        return (-far if far is not None else None), -near
+
+    # Describes soft limit violation of move ending at end, None if it is allowed. Moves from outside of the
+    # limits back towards them are allowed, so motor can always recover
+    def _soft_limit_error(self, end, start=None):
+        limits = self.soft_limits()
+        if limits is None:
+            return None
+        lo, hi = limits
+        if start is not None:
+            lo = min(lo, start) if lo is not None else None
+            hi = max(hi, start) if hi is not None else None
+        if (lo is not None and end < lo) or (hi is not None and end > hi):
+            return 'Position {} outside of soft limits [{}, {}]'.format(end, *limits)
+        return None
+
+    def projected_position(self):
+        """
+        Position motor will be at once running and queued commands are done
+        :return: position in steps, or None if some command ends at a position not known in advance
+        """
+        current, queued = Supervisor.pending(self)
+        pos = self.position
+        if current is not None:
+            target = self.move_target
+            pos = target[1] if target is not None and target[0] is current else self._project(current, pos)
+        for msg in queued:
+            pos = self._project(msg, pos)
+        return pos
+
+    # End position of command started from pos, None if not known in advance
+    def _project(self, msg, pos):
+        if msg[0] == 'move_to':
+            return msg[1]
+        if pos is None or msg[0] in ('trajectory', 'range'):
+            return None
+        if msg[0] == 'move':
+            return pos + (msg[2] if msg[1] == Stepper.DIR_UP else -msg[2])
+        if msg[0] == 'home':
+            return 0
+        return pos
+
+    def _arm_triggers(self, positions, ns):
+        """
+        Prepares position-compare triggers for move of ns steps from current position - keeps positions the move
+        passes through, ordered as it reaches them, and resets the trigger report
+        :return: array of armed positions
+        """
+        dir_factor = 1 if self.direction == 1 else -1
+        end = self.position + dir_factor * ns
+        lo, hi = min(self.position, end), max(self.position, end)
+        armed = sorted({p for p in positions if lo <= p <= hi and p != self.position}, reverse=dir_factor < 0)
+        if len(armed) < len(positions):
+            self.logger.warning('%d trigger positions outside of move range skipped', len(positions) - len(armed))
+        armed = array.array('q', armed)
+        # Offset converts perf_counter stamps to wall time in the report
+        self.trigger_report = (armed, array.array('d', [0.0]) * len(armed), time.time() - time.perf_counter(),
+                               len(positions) - len(armed))
+        return armed
+
+    def trigger_times(self):
+        """
+        :return: report of last move's position-compare triggers, with wall time of each pulse (None if not fired)
+        """
+        if self.trigger_report is None:
+            return None
+        armed, times, offset, skipped = self.trigger_report
+        return {'positions': armed.tolist(), 'times': [t + offset if t else None for t in times],
+                'fired': sum(1 for t in times if t), 'skipped': skipped}
+
+    def _do_steps(self, ns, jerk=None, vel=None, acc=None, override=False, stop_on_unlatch=False, delays=None,
+                  start_at=None, triggers=None, scale=1, takeup=0, per_step=False):
+        # Busy wait smooth motion algorithm, optionally released at wall clock time start_at. Triggers are armed
+        # positions to pulse trigger output at - one compare per step against the next one due. Every pulse
+        # moves scale fine steps (coarse microstep mode), except for the first takeup ones taking up backlash.
+        # per_step keeps the move on this loop, checking interlocks before every pulse, even with a waveform backend
+        if triggers:
+            trig_times = self.trigger_report[1]
+            next_trig = triggers[0]
+        else:
+            next_trig = None
+        n_trig = 0
+        if delays is None:
+            delays = self._plan_delays(ns, jerk, vel, acc)
+            if delays is None:
+                return self._on_stop()
+        dir_factor = 1 if self.direction == 1 else -1
+        stride = dir_factor * scale
+        # Limit search and back-off need per step interlock checks, triggers a per step position compare
+        if self.waveform is not None and not (per_step or override or triggers):
+            if self.waveform.acquire():
+                try:
+                    return self._do_waveform(ns, delays, stride, takeup, start_at)
+                finally:
+                    self.waveform.release()
+            self.logger.debug('Waveform backend busy with another motor, using step loop')
 
         if override and stop_on_unlatch:
             initial_ilock = self.check_interlocks(raise_exc=False, silent=True)
@@ -346,7 +1040,21 @@ class Stepper:
             else:
                 self.logger.info('Awaiting release from ilock state %s', initial_ilock)
 
+        if self.stopevt.is_set():
+            return self._on_stop()
+        PositionStore.save(self, moving=True, force=True)
+        if start_at is not None and not self._wait_until(start_at):
+            return self._on_stop()
+        Trace.record(self.uuid, Trace.MOVE_START, ns)
+        trace = Trace.record
+        publish = StateBlock.publisher(self)
+        # Missing take-up is counted down per pulse, so a move cut short leaves the rest for the next one
+        self.loaded_dir = self.direction
+        self.takeup_left = takeup
+        start = 0.0
         for i in range(1, ns+1):
+            if not i & 255:
+                PositionStore.save(self, moving=True)
             if override:
                 # Ensure we can only move away from current interlock
                 r = self.check_interlocks(raise_exc=False, silent=True)
@@ -368,16 +1076,27 @@ class Stepper:
             else:
                 self.check_interlocks(raise_exc=True)
             GPIOMgr.pulse_pin(self.PIN_STEP, 0)
-            self.position += 1*dir_factor
+            self.pulse_count += 1
+            if i > takeup:
+                self.position += stride
+            else:
+                self.takeup_left = takeup - i
+            if self.position == next_trig:
+                GPIOMgr.pulse_pin(self.PIN_TRIGGER, 0)
+                trig_times[n_trig] = time.perf_counter()
+                n_trig += 1
+                next_trig = triggers[n_trig] if n_trig < len(triggers) else None
+            trace(self.uuid, Trace.PULSE, self.position)
+            if publish is not None:
+                publish(self.position)
             current_delay = delays[i-1]
             start = end = time.perf_counter()
+            if i == 1 and start_at is not None:
+                self._record_start_skew(start_at)
             while (end - start) < current_delay:
                 if self.stopevt.is_set():
-                    # Stop command received - clear things out
-                    self.logger.warning("Stop command detected!")
-                    self.queue.queue.clear()
-                    self.stopevt.clear()
-                    return -1
+                    # Stop command received - queue was already flushed by the requester
+                    return self._on_stop(start)
                 end = time.perf_counter()
             if i % 1000 == 0:
                 self.logger.debug("%d/%d, delay %f ms (actual %f)", i, ns, current_delay * 1000,
@@ -437,8 +1156,84 @@ class Stepper:
         #         end = time.perf_counter()
         #     if i %100 == 0: self.logger.debug("Step %d, delay %f ms (actual %f)", i, current_delay * 1000, (end-start)*1000)
         #     #self.logger.debug("Step %d of %d done", i+1, numsteps)
+        trace(self.uuid, Trace.MOVE_END, 0)
         return 0
 
+    def _do_waveform(self, ns, delays, stride, takeup=0, start_at=None):
+        """
+        Plays planned move through waveform backend. Position follows the compiled schedule, interlocks and stop
+        are polled every Waveform.POLL_INTERVAL instead of every step
+        :return: 0 when done, -1 if stopped, raises MoveException on interlock
+        """
+        if self.stopevt.is_set():
+            return self._on_stop()
+        PositionStore.save(self, moving=True, force=True)
+        if start_at is not None and not self._wait_until(start_at):
+            return self._on_stop()
+        Trace.record(self.uuid, Trace.MOVE_START, ns)
+        publish = StateBlock.publisher(self)
+        self.loaded_dir = self.direction
+        self.takeup_left = takeup
+        initial_pos = self.position
+        train = Waveform.PulseTrain(self.waveform, delays, self.PIN_STEP)
+        if start_at is not None:
+            self._record_start_skew(start_at)
+
+        # Halts output for good and settles position on the pulses sent until then - the move ends after this
+        def halt():
+            done = train.stop()
+            self.pulse_count += done
+            self.position = initial_pos + stride * max(0, done - takeup)
+            self.takeup_left = max(0, takeup - done)
+            self.position_estimated = True
+            if publish is not None:
+                publish(self.position)
+
+        try:
+            while True:
+                more = train.pump()
+                self.position = initial_pos + stride * max(0, train.steps_done() - takeup)
+                if publish is not None:
+                    publish(self.position)
+                if not more and train.finished():
+                    break
+                ilock = self.check_interlocks(raise_exc=False)
+                if ilock != ILOCK_OK:
+                    halt()
+                    # Switch may already bounce back, the trip that stopped output is what ends the move
+                    raise MoveException(ILOCK_STR[ilock][len('ILOCK_'):])
+                if self.stopevt.wait(Waveform.POLL_INTERVAL):
+                    halt()
+                    return self._on_stop(time.perf_counter())
+        except Waveform.WaveformException:
+            halt()
+            raise MoveException('Waveform backend failed')
+        self.position = initial_pos + stride * (ns - takeup)
+        self.pulse_count += ns
+        self.takeup_left = 0
+        Trace.record(self.uuid, Trace.MOVE_END, 0)
+        return 0
+
+    # Records how far first pulse of scheduled move was from its target time
+    def _record_start_skew(self, start_at):
+        self.last_start_skew = time.time() - start_at
+        Metrics.start_skew.observe(abs(self.last_start_skew), self.uuid)
+        self.logger.info('Scheduled move released with %f ms skew', self.last_start_skew * 1000)
+
+    # Accounts for a detected stop request, returns the stopped result code
+    def _on_stop(self, last_pulse=0.0):
+        now = time.perf_counter()
+        Trace.record(self.uuid, Trace.STOP, self.position)
+        Trace.record(self.uuid, Trace.MOVE_END, -1)
+        self.logger.warning("Stop command detected!")
+        requested = self.stop_requested_at
+        if requested is not None:
+            # Pulses issued after the request count against the bound, earlier ones do not
+            self.last_stop_latency = max(0.0, last_pulse - requested)
+            Metrics.stop_latency.observe(self.last_stop_latency, self.uuid)
+            Metrics.stop_detect.observe(now - requested, self.uuid)
+        return -1
+
     def check_interlocks(self, raise_exc=True, silent=False):
         """
         Checks if any of interlocks are active
@@ -446,6 +1241,7 @@ class Stepper:
         """
         # First check ESTOP
         if self.ESTOP:
+            self._ilock_transition(ILOCK_ESTOP)
             if not silent: self.logger.warning("M %s - ESTOP interlock fail", self.uuid)
             if raise_exc:
                 raise MoveException("ESTOP")
@@ -455,6 +1251,7 @@ class Stepper:
         up = GPIOMgr.get_pin_value(self.PIN_LIM_UP)
         up2 = GPIOMgr.get_pin_value(self.PIN_LIM_UP)
         if up == up2 == self.LIM_UP_HIT:
+            self._ilock_transition(ILOCK_UP)
             if not silent: self.logger.warning("M %s - LIM UP fail", self.uuid)
             if raise_exc:
                 raise MoveException("UP")
@@ -463,6 +1260,7 @@ class Stepper:
         dn = GPIOMgr.get_pin_value(self.PIN_LIM_DN)
         dn2 = GPIOMgr.get_pin_value(self.PIN_LIM_DN)
         if dn == dn2 == self.LIM_DN_HIT:
+            self._ilock_transition(ILOCK_DN)
             if not silent:
                 self.logger.warning("M %s - LIM DN state (%s)", self.uuid, self.LIM_DN_HIT)
                 self.logger.warning("DN state %s", GPIOMgr.get_pin_value(self.PIN_LIM_DN))
@@ -474,8 +1272,18 @@ class Stepper:
                 return ILOCK_DN
         # Nothing else for now, but we should add other sanity checks...
         #self.logger.debug("M %s - interlock check OK", self.full_name)
+        self._ilock_transition(ILOCK_OK)
         return ILOCK_OK
 
+    # Records interlock state changes into the event trace
+    def _ilock_transition(self, ilock):
+        if ilock != self.ilock_state:
+            Trace.record(self.uuid, Trace.ILOCK, ilock)
+            History.record_interlock(self.uuid, ilock)
+            if ilock != ILOCK_OK:
+                Metrics.interlock_trips.inc(self.uuid, ILOCK_STR[ilock])
+            self.ilock_state = ilock
+
     # Checks if limit reached (indicated by LOW, closed circuit)
     def is_lim_reached(self, direction):
         if direction == self.DIR_DN:
@@ -489,27 +1297,76 @@ class Stepper:
         self.logger.info("M %s - enabling", self.uuid)
         GPIOMgr.set_pin_value(self.PIN_ENABLE, GPIOMgr.GPIO.LOW)
         self.state = IDLE
+        StateBlock.publish(self)
         self.logger.debug("Done!")
 
     def _disable_direct(self):
         self.logger.info("M %s - disabling", self.uuid)
         GPIOMgr.set_pin_value(self.PIN_ENABLE, GPIOMgr.GPIO.HIGH)
         self.state = DISABLED
+        StateBlock.publish(self)
         self.logger.debug("Done!")
 
-    def move(self, dir, numsteps, block=False, force=False):
+    # Queues command message, returning future for its result
+    def _enqueue(self, msg):
+        fut = self.queue.put_nowait(msg)
+        if Supervisor.refused(fut):
+            self.logger.error('M %s - command %s refused, motor is not dispatched', self.uuid, msg[0])
+        return fut
+
+    def move(self, dir, numsteps, block=False, force=False, start_at=None, triggers=None):
         """
         Performs motor steps
         :param dir:
         :param numsteps:
         :param block:
+        :param start_at: optional wall clock time (epoch s) to release first pulse at, for synchronized starts
+        :param triggers: optional absolute positions to pulse trigger output at while passing them
         :return:
         """
         # Final safety checks
         numsteps = int(numsteps)
         assert (0 <= numsteps < 100000)
         assert dir in [Stepper.DIR_UP, Stepper.DIR_DN]
+        assert start_at is None or start_at - time.time() < self.MAX_SCHEDULE_AHEAD
+        assert triggers is None or (self.PIN_TRIGGER is not None and len(triggers) <= self.MAX_TRIGGERS)
+        msg = ['move', dir, numsteps, force]
+        if start_at is not None or triggers is not None:
+            msg += [start_at, triggers]
+        if not force:
+            projected = self.projected_position()
+            if projected is not None:
+                error = self._soft_limit_error(projected + (numsteps if dir == Stepper.DIR_UP else -numsteps),
+                                               projected)
+                if error is not None:
+                    raise SoftLimitException(error)
+        return self._submit(msg, block, force)
 
+    def move_to(self, target, block=False, units=False, vel=None, acc=None):
+        """
+        Moves to absolute position, rejected before queueing if it is outside of soft limits
+        :param target: position in steps, or in user units (step_size per step) with units=True
+        :param block:
+        :param vel: velocity for this move only, configured one if None
+        :param acc: acceleration for this move only, configured one if None
+        :return:
+        """
+        assert all(x is None or 0 < x < 20000 for x in (vel, acc))
+        steps = int(round(target / self.step_size)) if units else int(target)
+        projected = self.projected_position()
+        error = self._soft_limit_error(steps, projected)
+        if error is not None:
+            raise SoftLimitException(error)
+        self.logger.debug('Move to %d, from projected position %s', steps, projected)
+        if projected is not None:
+            assert abs(steps - projected) < 100000
+        msg = ['move_to', steps]
+        if vel is not None or acc is not None:
+            msg.append((vel, acc))
+        return self._submit(msg, block, False)
+
+    # Queues move message, optionally waiting for it
+    def _submit(self, msg, block, force):
         # If queue is full, we reject command
         try:
             if (self.is_moving() or not self.queue.empty()) and block:
@@ -518,18 +1375,21 @@ class Stepper:
             if (self.is_moving() or not self.queue.empty()) and force:
                 self.logger.warning('Forced commands cannot be queued, queue will be flushed!')
                 self.logger.warning('Currently in queue - %s', self.queue.qsize())
-                self.queue.empty()
+                self.queue.clear()
                 #return 'Failed'
 
             if self.is_moving():
                 self.logger.warning('Another move running - command will be queued')
-                self.queue.put_nowait(['move', dir, numsteps, force])
+                if Supervisor.refused(self._enqueue(msg)):
+                    return 'Failed'
                 return 'Queued'
             if block:
-                self.doneevt.clear()
-                self.queue.put_nowait(['move', dir, numsteps, force])
+                fut = self._enqueue(msg)
                 self.logger.debug('Awaiting move completion')
-                self.doneevt.wait()
+                try:
+                    fut.result()
+                except Exception:
+                    return 'Failed'
                 if self.error != 0:
                     return 'Failed'
                 else:
@@ -537,11 +1397,47 @@ class Stepper:
             else:
                 if self.is_moving():
                     self.logger.warning('Another move running - command will be queued')
-                self.queue.put_nowait(['move', dir, numsteps, force])
+                if Supervisor.refused(self._enqueue(msg)):
+                    return 'Failed'
                 return 'Queued'
         except queue.Full:
             return 'Fail'
 
+    def run_trajectory(self, data, final=False):
+        """
+        Queues execution of binary trajectory, see Trajectory module for format
+        :param data: first chunk of segments, more can follow through append_trajectory while it runs
+        :param final: whether this is the only chunk
+        :return: trajectory buffer
+        """
+        buf = Trajectory.TrajectoryBuffer(self.start_speed or start_rate(self.acc), self.vel, self.acc,
+                                          limit_check=self._check_trajectory_range)
+        buf.set_origin(self.projected_position())
+        buf.append(data, final)
+        buf.future = self._enqueue(['trajectory', buf])
+        if Supervisor.refused(buf.future):
+            raise Trajectory.TrajectoryException('Motor is not dispatched, trajectory refused')
+        self.trajectory = buf
+        return buf
+
+    # Rejects trajectory range reaching outside of soft limits, as move and move_to are
+    def _check_trajectory_range(self, low, high, start):
+        for end in (low, high):
+            error = self._soft_limit_error(end, start)
+            if error is not None:
+                raise SoftLimitException('Trajectory range - ' + error)
+
+    def append_trajectory(self, data, final=False):
+        """
+        Adds chunk of segments to the current trajectory, queued or running
+        :return: trajectory buffer
+        """
+        buf = self.trajectory
+        if buf is None or buf.future.cancelled():
+            raise Trajectory.TrajectoryException('No trajectory is queued or running')
+        buf.append(data, final)
+        return buf
+
     def home(self, dir):
         """
         Performs motor homing sequence, by default towards dir 0 (LIM_DN)
@@ -556,14 +1452,33 @@ class Stepper:
             if not self.state == IDLE or self.is_moving():
                 self.logger.error('Attempt to home in state %s - very bad!', self.state)
                 return False
-            self.doneevt.clear()
-            self.queue.put_nowait(['home', dir])
-            self.doneevt.wait()
-            return True
+            fut = self._enqueue(['home', dir])
+            try:
+                return fut.result() == 0
+            except Exception:
+                return False
         else:
             self.logger.warning('Attempt to home with queued commands!')
             return False
 
+    def check_range(self):
+        """
+        Measures travel between limits of a homed motor, ending up backed off the far limit
+        :return: True if travel was measured
+        """
+        if self.queue.empty():
+            if not self.state == IDLE or not self.homed:
+                self.logger.error('Attempt to check range in state %s (homed %s)', self.state, self.homed)
+                return False
+            fut = self._enqueue(['range'])
+            try:
+                return fut.result() == 0
+            except Exception:
+                return False
+        else:
+            self.logger.warning('Attempt to check range with queued commands!')
+            return False
+
     def enable(self, force=False):
         """
         Queues enabling of the motor
@@ -578,7 +1493,8 @@ class Stepper:
         # If queue is not empty, reject command (no queue for enabling)
         if self.queue.empty():
             try:
-                self.queue.put_nowait(['enable', force])
+                if Supervisor.refused(self._enqueue(['enable', force])):
+                    return "Rejected"
                 return "Queued"
             except queue.Full:
                 return "Rejected"
@@ -599,8 +1515,7 @@ class Stepper:
         # If queue is not empty, reject command (no queue for enabling)
         if self.queue.empty():
             try:
-                self.queue.put_nowait(['disable'])
-                return True
+                return not Supervisor.refused(self._enqueue(['disable']))
             except queue.Full:
                 return False
         else:
@@ -608,19 +1523,19 @@ class Stepper:
 
     def stop(self):
         """
-        Sets stop event indicator for the running thread
+        Preempts running command and flushes queue, bypassing normal command intake
 
-        :return:
+        :return: True if there was anything to stop
         """
-        # Thread will detect this event and react
-        if self.state == MOVING:
-            self.stopevt.set()
+        # Executor will detect the event at its next checkpoint and react
+        if Supervisor.preempt(self):
             return True
         else:
             self.logger.warning('Attempt to stop non-moving motor')
             return False
 
     def dump_state(self):
+        Metrics.dump_state_calls.inc()
         results = {
             'fname': self.full_name,
             'name': self.name,
@@ -628,6 +1543,7 @@ class Stepper:
             'state': self.state,
             'statestr': STATES_STR[self.state],
             'threadon': self.thread_on,
+            'estop': Stepper.ESTOP,
             'limup': GPIOMgr.get_pin_value(self.PIN_LIM_UP) == self.LIM_UP_HIT,
             'limdn': GPIOMgr.get_pin_value(self.PIN_LIM_DN) == self.LIM_DN_HIT,
         }
@@ -648,7 +1564,15 @@ class Stepper:
                 'limdn': GPIOMgr.get_pin_value(self.PIN_LIM_DN) == self.LIM_DN_HIT,
                 'jerk': self.jerk,
                 'vel': self.vel,
-                'acc': self.acc
+                'acc': self.acc,
+                'start_speed': self.start_speed or start_rate(self.acc),
+                'homed': self.homed,
+                'travel': self.travel_range,
+                'softlim': self.soft_limits(),
+                'projected': self.projected_position(),
+                'stoplat': self.last_stop_latency,
+                'skew': self.last_start_skew,
+                'microstep': self.microstep_ratio if self.coarse else 1
              })
             return results
 
@@ -662,13 +1586,14 @@ class Stepper:
         self.logger.info('Shutdown initiated - stopping and cleaning up')
         if self.is_moving():
             self.stop()
-        self.thread_on = False
-        time.sleep(0.5)
-        if self.t.is_alive():
-            self.logger.error('Control thread %s did not shut down in time!', self.t.name)
+        if not Supervisor.unregister(self, timeout=0.5):
+            self.logger.error('Motor %s executor did not shut down in time!', self.uuid)
             return False
         else:
-            #
+            PositionStore.save(self, clean=True, force=True)
+            if self.waveform is not None:
+                Waveform.close_backend(self.waveform)
+                self.waveform = None
             return True
 
     def names(self):
@@ -685,6 +1610,7 @@ class Stepper:
     def _set_direction(self, dir):
         GPIOMgr.set_pin_value(self.PIN_DIR, dir)
         self.direction = dir
+        Trace.record(self.uuid, Trace.DIRECTION, dir)
 
     # Checks actual pin value for current direction
     def is_enabled(self):
@@ -700,4 +1626,7 @@ class MoveException(Exception):
     pass
 
 class MotorException(Exception):
+    pass
+
+class SoftLimitException(MotorException):
     pass
\ No newline at end of file
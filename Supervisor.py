@@ -0,0 +1,220 @@
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+import Profiler
+
+# Single supervisor owning command intake for all motors. Commands land in per-motor CommandQueues, which
+# notify one shared condition variable - the supervisor thread sleeps on it until there is work, so idle motors
+# cause no wakeups at all. Each dequeued command is handed to its motor's single-worker executor, which keeps
+# commands for one motor strictly ordered while different motors run independently.
+
+logger = logging.getLogger(__name__)
+
+
+class MotorDropped(Exception):
+    """
+    Command can not run because its motor was taken out of dispatch
+    """
+    pass
+
+
+_cond = threading.Condition()
+_motors = []
+_thread = None
+_running = False
+
+
+class CommandQueue:
+    """
+    Bounded FIFO of (enqueue time, message, future) entries for a single motor
+    """
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        # Set once the motor is taken out of dispatch - nothing would ever execute further commands
+        self.closed = False
+
+    def put_nowait(self, msg):
+        """
+        Queues command message
+        :return: Future resolving to command result once executed, already failed if motor is not dispatched
+        """
+        fut = concurrent.futures.Future()
+        with _cond:
+            if self.closed:
+                fut.set_exception(MotorDropped('motor is not dispatched'))
+                return fut
+            if len(self.items) >= self.maxsize:
+                raise queue.Full
+            self.items.append((time.perf_counter(), msg, fut))
+            _cond.notify()
+        return fut
+
+    def clear(self):
+        with _cond:
+            dropped, self.items = self.items, collections.deque()
+        for _, _, fut in dropped:
+            fut.cancel()
+        return len(dropped)
+
+    def close(self, reason):
+        """
+        Stops intake and fails queued commands
+        :return: number of failed commands
+        """
+        with _cond:
+            self.closed = True
+            dropped, self.items = self.items, collections.deque()
+        for _, _, fut in dropped:
+            fut.set_exception(MotorDropped(reason))
+        return len(dropped)
+
+    def snapshot(self):
+        with _cond:
+            return [msg for _, msg, _ in self.items]
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+
+def refused(fut):
+    """
+    :return: True if command future was failed because its motor is out of dispatch
+    """
+    return fut.done() and not fut.cancelled() and isinstance(fut.exception(), MotorDropped)
+
+
+def register(mt):
+    global _thread, _running
+    with _cond:
+        if mt not in _motors:
+            mt.busy = False
+            mt.current = None
+            mt.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                thread_name_prefix='mt_thr_{}'.format(mt.uuid))
+            _motors.append(mt)
+        mt.queue.closed = False
+        mt.thread_on = True
+        if not _running:
+            _running = True
+            _thread = threading.Thread(name='supervisor', target=_run, args=())
+            _thread.daemon = False
+            _thread.start()
+        _cond.notify()
+    logger.info('Motor %s registered with supervisor', mt.uuid)
+
+
+def unregister(mt, timeout=5.0):
+    """
+    Removes motor from dispatch, dropping queued commands and waiting for the running one to finish
+    :return: True if motor executor went idle within timeout
+    """
+    with _cond:
+        if mt in _motors:
+            _motors.remove(mt)
+        mt.thread_on = False
+    mt.queue.close('motor unregistered')
+    with _cond:
+        idle = _cond.wait_for(lambda: not mt.busy, timeout)
+    mt.executor.shutdown(wait=idle)
+    logger.info('Motor %s unregistered from supervisor', mt.uuid)
+    return idle
+
+
+def pending(mt):
+    """
+    :return: (message of command being executed or None, list of queued messages) of motor, taken together
+    """
+    with _cond:
+        return mt.current, [msg for _, msg, _ in mt.queue.items]
+
+
+def preempt(mt, requested_at=None):
+    """
+    Priority stop path - flushes queued commands and signals running one, without waiting behind the queue
+    :return: True if a command was running or queued
+    """
+    with _cond:
+        mt.stop_requested_at = requested_at or time.perf_counter()
+        dropped, mt.queue.items = mt.queue.items, collections.deque()
+        active = mt.busy
+        if active:
+            mt.stopevt.set()
+    for _, _, fut in dropped:
+        fut.cancel()
+    return active or bool(dropped)
+
+
+def preempt_all():
+    """
+    Fans stop out to every registered motor with a common request timestamp
+    :return: dict of motor uuid to preempt result
+    """
+    requested_at = time.perf_counter()
+    with _cond:
+        motors = list(_motors)
+    return {mt.uuid: preempt(mt, requested_at) for mt in motors}
+
+
+def shutdown(timeout=1.0):
+    global _running
+    with _cond:
+        _running = False
+        _cond.notify_all()
+    if _thread is not None and _thread.is_alive() and _thread is not threading.current_thread():
+        _thread.join(timeout)
+
+
+def _run():
+    logger.info('Supervisor thread starting up')
+    with _cond:
+        while _running:
+            dispatched = False
+            for mt in _motors:
+                if not mt.busy and mt.queue.items:
+                    queued_at, msg, fut = mt.queue.items.popleft()
+                    dispatched = True
+                    if not fut.set_running_or_notify_cancel():
+                        continue
+                    mt.busy = True
+                    mt.current = msg
+                    mt.executor.submit(_execute, mt, queued_at, msg, fut)
+            if not dispatched:
+                _cond.wait()
+    logger.info('Supervisor thread stopping gracefully')
+
+
+# Runs on the motor executor thread
+def _execute(mt, queued_at, msg, fut):
+    prof = Profiler.attach(mt.uuid) if Profiler.current is not None else None
+    try:
+        fut.set_result(mt.execute(queued_at, msg))
+    except (KeyboardInterrupt, SystemExit) as e:
+        fut.set_exception(e)
+        raise
+    except Exception as e:
+        # Failure in command execution leaves motor in unknown condition, stop dispatching to it
+        mt.logger.exception(e)
+        fut.set_exception(e)
+        with _cond:
+            if mt in _motors:
+                _motors.remove(mt)
+            mt.thread_on = False
+        mt.queue.close('motor dropped after failed command: {}'.format(e))
+    finally:
+        if prof is not None:
+            Profiler.detach(prof)
+        # Stop requests only target the command that was running when they arrived
+        with _cond:
+            mt.stopevt.clear()
+            mt.stop_requested_at = None
+            mt.current = None
+            mt.busy = False
+            _cond.notify_all()
@@ -0,0 +1,163 @@
+import array
+import struct
+import threading
+
+# Buffered step trajectories - arbitrary velocity-vs-time profiles uploaded as compact binary segments and
+# streamed into the step loop. Segments sit in preallocated ring arrays, so the executor pops them without
+# allocating, while the uploader keeps appending chunks during execution for arbitrarily long trajectories.
+#
+# Wire format (little endian): repeated '<iI' records of (signed step count, step interval in us). Sign of the
+# step count gives direction (positive is UP), each step is followed by one interval, and a zero step count
+# is a dwell of one interval.
+#
+# Every chunk is checked against motion limits before it is accepted - no segment may exceed max velocity,
+# and velocity may change between consecutive segments (across chunks too) by at most start speed plus
+# acceleration times the new segment interval. Start speed is the motor's start_speed config, by default the
+# rate of the first step of the step loop ramp (about 1.7 * sqrt(acceleration)). A trajectory starts from rest,
+# so its first segment may be at most start speed (plus acceleration share), and the final chunk must end at
+# or below start speed - a closing dwell segment (zero steps) ends it at rest. The
+# position range the trajectory covers is tracked relative to its start, so that once the start position is
+# known the whole range can be held against soft limits - on every chunk and again when execution starts.
+
+SEGMENT = struct.Struct('<iI')
+CAPACITY = 1 << 14          # segments buffered at once, must be power of 2
+MAX_SEGMENT_STEPS = 100000
+UNDERRUN_WAIT = 1.0         # s executor holds at or below start speed waiting for late data
+
+
+class TrajectoryException(Exception):
+    pass
+
+
+class BufferFull(TrajectoryException):
+    pass
+
+
+class TrajectoryBuffer:
+    def __init__(self, start_speed, vel, acc, capacity=CAPACITY, limit_check=None):
+        """
+        :param start_speed: velocity (steps/s) that may be started, stopped or changed by at once
+        :param limit_check: called with (lowest, highest, start) absolute position of appended data once start
+                            position is known, raises to reject it
+        """
+        assert capacity & (capacity - 1) == 0
+        self.start_speed, self.vel, self.acc = start_speed, vel, acc
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self.steps = array.array('i', [0]) * capacity
+        self.interval = array.array('I', [0]) * capacity
+        self.head = 0               # segments popped
+        self.tail = 0               # segments appended
+        self.total_steps = 0        # absolute steps appended
+        self.last_velocity = 0.0    # signed velocity at end of appended data, steps/s
+        self.net_steps = 0          # signed displacement at end of appended data
+        self.low = self.high = 0    # displacement extremes over appended data
+        self.origin = None          # absolute start position, None while not known
+        self.limit_check = limit_check
+        self.final = False
+        self.closed = False
+        self.future = None
+        self.cond = threading.Condition()
+
+    def _validate(self, data):
+        """
+        Parses chunk and checks it continues from already appended data within motion limits
+        :return: (list of (steps, interval us) segments, signed end velocity)
+        """
+        if len(data) % SEGMENT.size:
+            raise TrajectoryException('Chunk length {} is not a multiple of {}'.format(len(data), SEGMENT.size))
+        segments = list(SEGMENT.iter_unpack(data))
+        v_prev = self.last_velocity
+        for n, (steps, interval) in enumerate(segments, self.tail):
+            if abs(steps) > MAX_SEGMENT_STEPS or interval == 0:
+                raise TrajectoryException('Segment {} - bad step count {} or interval {}'.format(n, steps, interval))
+            dt = interval * 1e-6
+            v = 0.0 if steps == 0 else (1.0 if steps > 0 else -1.0) / dt
+            if abs(v) > self.vel:
+                raise TrajectoryException('Segment {} - velocity {:.1f} above limit {}'.format(n, v, self.vel))
+            if abs(v - v_prev) > self.start_speed + self.acc * dt:
+                raise TrajectoryException('Segment {} - velocity change {:.1f} to {:.1f} above acceleration '
+                                          'limit (start speed {:.1f} + {} * interval)'.format(
+                                              n, v_prev, v, self.start_speed, self.acc))
+            v_prev = v
+        return segments, v_prev
+
+    def append(self, data, final=False):
+        """
+        Validates and buffers a chunk of binary segments, all or nothing
+        :param final: no more chunks follow, executor finishes once buffer drains
+        :return: number of segments accepted
+        """
+        with self.cond:
+            if self.closed:
+                raise TrajectoryException('Trajectory is no longer running')
+            if self.final:
+                raise TrajectoryException('Trajectory already finalized')
+            segments, v_end = self._validate(data)
+            net, low, high = self.net_steps, self.low, self.high
+            for steps, _ in segments:
+                net += steps
+                low, high = min(low, net), max(high, net)
+            if self.limit_check is not None and self.origin is not None:
+                self.limit_check(self.origin + low, self.origin + high, self.origin)
+            if final and abs(v_end) > self.start_speed:
+                raise TrajectoryException('Final velocity {:.1f} above start speed {:.1f} - slow down further or '
+                                          'end with a dwell segment'.format(v_end, self.start_speed))
+            if len(segments) > self.capacity - (self.tail - self.head):
+                raise BufferFull('{} segments do not fit, {} free'.format(len(segments),
+                                                                           self.capacity - (self.tail - self.head)))
+            for steps, interval in segments:
+                i = self.tail & self._mask
+                self.steps[i] = steps
+                self.interval[i] = interval
+                self.tail += 1
+                self.total_steps += abs(steps)
+            self.last_velocity = v_end
+            self.net_steps, self.low, self.high = net, low, high
+            self.final = final
+            self.cond.notify_all()
+        return len(segments)
+
+    def set_origin(self, origin):
+        """
+        Anchors trajectory to absolute start position and checks data appended so far against limits
+        """
+        with self.cond:
+            self.origin = origin
+            if self.limit_check is not None and origin is not None:
+                self.limit_check(origin + self.low, origin + self.high, origin)
+
+    def pop(self):
+        """
+        :return: next (steps, interval us) segment, or None if nothing is buffered
+        """
+        with self.cond:
+            if self.head == self.tail:
+                return None
+            i = self.head & self._mask
+            self.head += 1
+            return self.steps[i], self.interval[i]
+
+    def wait(self, timeout):
+        """
+        Waits for more data or end of trajectory
+        :return: True if there is something to act on
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.head != self.tail or self.final or self.closed, timeout)
+
+    def done(self):
+        with self.cond:
+            return self.head == self.tail and (self.final or self.closed)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def status(self):
+        with self.cond:
+            return {'segments': self.tail, 'executed': self.head, 'free': self.capacity - (self.tail - self.head),
+                    'steps': self.total_steps, 'range': [self.low, self.high],
+                    'start_speed': self.start_speed, 'final': self.final,
+                    'closed': self.closed}
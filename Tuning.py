@@ -0,0 +1,242 @@
+import json
+import logging
+import threading
+import time
+
+import GPIOMgr
+from Stepper import Stepper, SoftLimitException
+
+# Velocity/acceleration tuning of homed motors against their home limit switch. For every motor the job runs
+# ramp trials at rising velocity (at configured acceleration), then rising acceleration (at best velocity found):
+# a trial drives back and forth over a test distance with the trial parameters, then re-homes at configured
+# parameters - drift of the step counter against the limit reference shows steps lost during the trial. The
+# highest parameters with drift within tolerance, derated by a safety margin, are recommended and can be written
+# out as a copy of the worker config. Moves go through the motor command queues and are preempted by stop.
+# Trial parameters travel with each trial move, configured ones stay in effect for everything else. Cycling
+# keeps LIMIT_GAP clear of the soft limit margin. One tuning job at a time.
+
+logger = logging.getLogger(__name__)
+
+VEL_MAX = 10000
+ACC_MAX = 10000
+LEVEL_FACTOR = 1.25
+LIMIT_GAP = 200             # steps kept clear of the home limit while cycling
+
+# Job states
+RUNNING = 'running'
+DONE = 'done'
+ABORTED = 'aborted'
+FAILED = 'failed'
+
+_lock = threading.Lock()
+current = None
+
+
+class TuningException(Exception):
+    pass
+
+
+def levels(start, maximum, factor=LEVEL_FACTOR):
+    """
+    :return: geometric ladder of integer parameter values from start up to maximum, both included
+    """
+    out = [int(start)]
+    while out[-1] < maximum:
+        out.append(min(int(maximum), max(out[-1] + 1, int(out[-1] * factor))))
+    return out
+
+
+class TuningJob:
+    def __init__(self, motors, distance=5000, cycles=3, tolerance=2, margin=0.2):
+        """
+        :param motors: list of Stepper objects, tuned one after another
+        :param distance: steps travelled each way per cycle, capped by known travel range
+        :param cycles: back and forth cycles per trial
+        :param tolerance: max drift against limit reference (steps) for a trial to pass
+        :param margin: fraction taken off best passing parameters for the recommendation
+        """
+        if not motors or len(set(mt.uuid for mt in motors)) != len(motors):
+            raise TuningException('Tuning needs distinct motors')
+        if distance < 1 or not 1 <= cycles <= 100 or tolerance < 0 or not 0 <= margin < 1:
+            raise TuningException('Bad distance, cycles, tolerance or margin')
+        self.motors = motors
+        self.distance = int(distance)
+        self.cycles = int(cycles)
+        self.tolerance = tolerance
+        self.margin = margin
+        self.state = RUNNING
+        self.error = None
+        self.trials = []
+        self.results = {}
+        self.started = self.finished = None
+        self.abortevt = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+        self._thread = threading.Thread(name='tuning', target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def abort(self):
+        """
+        Stops tuning at the next checkpoint, preempting any move in flight
+        """
+        self.abortevt.set()
+        for mt in self.motors:
+            mt.stop()
+
+    # Moves motor to target through the public entry point and waits for it, returning the reply ('Done' once
+    # the move completed)
+    def _move_to(self, mt, target, vel=None, acc=None):
+        if self.abortevt.is_set():
+            raise TuningException('Aborted')
+        try:
+            result = mt.move_to(target, block=True, vel=vel, acc=acc)
+        except SoftLimitException as e:
+            raise TuningException('Motor {} - {}'.format(mt.uuid, e))
+        if self.abortevt.is_set():
+            raise TuningException('Aborted')
+        return result
+
+    def _home(self, mt):
+        if self.abortevt.is_set():
+            raise TuningException('Aborted')
+        mt.last_home_drift = None
+        done = mt.home(mt.home_dir)
+        if self.abortevt.is_set():
+            raise TuningException('Aborted')
+        if not done:
+            raise TuningException('Homing of motor {} failed'.format(mt.uuid))
+        return mt.last_home_drift
+
+    def _trial(self, mt, distance, vel, acc):
+        """
+        Cycles motor over distance at trial parameters and re-homes at configured ones
+        :return: trial report dict
+        """
+        # Position grows away from the home limit
+        sign = 1 if mt.home_dir == Stepper.DIR_DN else -1
+        gap = LIMIT_GAP + mt.soft_margin
+        near, far = sign * gap, sign * (gap + distance)
+        result = self._move_to(mt, near)
+        t0 = time.perf_counter()
+        for _ in range(self.cycles):
+            if result != 'Done':
+                break
+            result = self._move_to(mt, far, vel, acc)
+            if result == 'Done':
+                result = self._move_to(mt, near, vel, acc)
+        elapsed = time.perf_counter() - t0
+        # Lost steps towards the limit end the move on it, homing then recovers the reference
+        drift = self._home(mt)
+        passed = result == 'Done' and drift is not None and abs(drift) <= self.tolerance
+        trial = {'uuid': mt.uuid, 'vel': vel, 'acc': acc, 'result': result, 'drift': drift, 'time': elapsed,
+                 'passed': passed}
+        logger.info('Motor %s trial at %d/%d (v/a) - result %s, drift %s steps: %s', mt.uuid, vel, acc, result,
+                    drift, 'pass' if passed else 'FAIL')
+        self.trials.append(trial)
+        if mt.error != 0:
+            # Motor refuses further moves until the error is cleared with a forced enable
+            raise TuningException('Motor {} latched error {} in trial at {}/{} (v/a)'.format(mt.uuid, mt.error,
+                                                                                           vel, acc))
+        return trial
+
+    # Runs trials over ladder until the first failure, returning the last passing value or None
+    def _sweep(self, mt, distance, ladder, trial_params):
+        best = None
+        for value in ladder:
+            if not self._trial(mt, distance, *trial_params(value))['passed']:
+                break
+            best = value
+        return best
+
+    def _tune(self, mt):
+        if not mt.homed:
+            logger.info('Motor %s not homed, homing first', mt.uuid)
+            self._home(mt)
+        distance = self.distance
+        if mt.travel_range:
+            distance = min(distance, mt.travel_range - 2 * LIMIT_GAP - 2 * mt.soft_margin)
+        if distance < 1:
+            raise TuningException('Travel of motor {} too short for tuning'.format(mt.uuid))
+        base = {'jerk': mt.jerk, 'velocity': mt.vel, 'acceleration': mt.acc}
+        best_vel = self._sweep(mt, distance, levels(mt.vel, VEL_MAX), lambda v: (v, base['acceleration']))
+        if best_vel is None:
+            raise TuningException('Motor {} fails at configured parameters'.format(mt.uuid))
+        best_acc = self._sweep(mt, distance, levels(mt.acc, ACC_MAX)[1:], lambda a: (best_vel, a)) \
+            or base['acceleration']
+        self.results[mt.uuid] = {
+            'name': mt.name, 'distance': distance, 'configured': base,
+            'reliable': {'velocity': best_vel, 'acceleration': best_acc},
+            'recommended': {'jerk': base['jerk'], 'velocity': max(1, int(best_vel * (1 - self.margin))),
+                            'acceleration': max(1, int(best_acc * (1 - self.margin)))}}
+        logger.info('Motor %s reliable up to %d/%d (v/a), recommended %s', mt.uuid, best_vel, best_acc,
+                    self.results[mt.uuid]['recommended'])
+
+    def _run(self):
+        logger.info('Tuning of motors %s starting', [mt.uuid for mt in self.motors])
+        try:
+            for mt in self.motors:
+                self._tune(mt)
+            self.state = DONE
+        except TuningException as e:
+            self.state = ABORTED if self.abortevt.is_set() else FAILED
+            self.error = str(e)
+        except Exception as e:
+            logger.exception('Tuning failed')
+            self.state = FAILED
+            self.error = str(e)
+        self.finished = time.time()
+        logger.info('Tuning %s after %d trials (%s)', self.state, len(self.trials), self.error)
+
+    def recommended_config(self, config):
+        """
+        :param config: worker config dict
+        :return: copy of config with motion parameters of tuned motors replaced by the recommended ones
+        """
+        config = json.loads(json.dumps(config))
+        for res in self.results.values():
+            config['motors'][res['name']].update(res['recommended'])
+        return config
+
+    def status(self):
+        return {'state': self.state, 'error': self.error, 'motors': [mt.uuid for mt in self.motors],
+                'started': self.started, 'finished': self.finished, 'trials': self.trials,
+                'results': self.results}
+
+
+def start(motors, distance=5000, cycles=3, tolerance=2, margin=0.2):
+    global current
+    with _lock:
+        if current is not None and current.state == RUNNING:
+            raise TuningException('Another tuning job is running')
+        job = TuningJob(motors, distance, cycles, tolerance, margin)
+        current = job
+        job.start()
+    return job
+
+
+def abort():
+    """
+    :return: True if a running tuning job was aborted
+    """
+    job = current
+    if job is not None and job.state == RUNNING:
+        job.abort()
+        return True
+    return False
+
+
+def write_config(job, path=None):
+    """
+    Writes worker config with recommended motion parameters, by default next to the loaded config
+    :return: path written
+    """
+    if not job.results:
+        raise TuningException('No tuning results to write')
+    path = path or GPIOMgr.config_path.rsplit('.json', 1)[0] + '.tuned.json'
+    with open(path, 'w') as f:
+        json.dump(job.recommended_config(GPIOMgr.config_raw), f, indent=2)
+    logger.info('Recommended motion config written to %s', path)
+    return path
@@ -29,8 +29,31 @@ def module_exists(module_name):
         return True
 
 
-# Initialize logging configuration with console+rotating logs
-def init_logger(is_quiet):
+# File sink settings - sized to keep SD card writes infrequent and bounded
+LOG_FLUSH_INTERVAL = 10.0       # s between periodic flushes
+LOG_FLUSH_BYTES = 65536         # buffered bytes forcing a flush
+LOG_SEGMENT_BYTES = 4194304     # live file size before rotation
+LOG_TOTAL_BYTES = 33554432      # cap on live file plus compressed segments
+
+
+def _file_handler(level, filename, formatter):
+    return {
+        "class": "LogWriter.BatchedRotatingHandler",
+        "level": level,
+        "formatter": formatter,
+        "filename": filename,
+        "flush_interval": LOG_FLUSH_INTERVAL,
+        "flush_bytes": LOG_FLUSH_BYTES,
+        "max_bytes": LOG_SEGMENT_BYTES,
+        "max_total_bytes": LOG_TOTAL_BYTES,
+        "encoding": "utf8"
+    }
+
+
+# Initialize logging configuration with console+batched rotating logs (optionally as json lines)
+def init_logger(is_quiet, json_logs=False):
+    file_formatter = "jsonl" if json_logs else "simple"
+    file_ext = "jsonl" if json_logs else "log"
     if not is_quiet:
         logging.config.dictConfig({
             "version": 1,
@@ -38,6 +61,9 @@ def init_logger(is_quiet):
             "formatters": {
                 "simple": {
                     "format": "%(asctime)s - %(levelname)s:%(lineno)d:%(name)s:%(threadName)s - %(message)s"
+                },
+                "jsonl": {
+                    "()": "LogWriter.JsonLinesFormatter"
                 }
             },
 
@@ -49,25 +75,9 @@ def init_logger(is_quiet):
                     "stream": "ext://sys.stdout"
                 },
 
-                "info_file_handler": {
-                    "class": "logging.handlers.RotatingFileHandler",
-                    "level": "INFO",
-                    "formatter": "simple",
-                    "filename": "info.log",
-                    "maxBytes": 1048576,
-                    "backupCount": 20,
-                    "encoding": "utf8"
-                },
+                "info_file_handler": _file_handler("INFO", "info." + file_ext, file_formatter),
 
-                "error_file_handler": {
-                    "class": "logging.handlers.RotatingFileHandler",
-                    "level": "ERROR",
-                    "formatter": "simple",
-                    "filename": "errors.log",
-                    "maxBytes": 1048576,
-                    "backupCount": 20,
-                    "encoding": "utf8"
-                }
+                "error_file_handler": _file_handler("ERROR", "errors." + file_ext, file_formatter)
             },
 
             "loggers": {
@@ -90,6 +100,9 @@ def init_logger(is_quiet):
             "formatters": {
                 "simple": {
                     "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+                },
+                "jsonl": {
+                    "()": "LogWriter.JsonLinesFormatter"
                 }
             },
 
@@ -101,25 +114,9 @@ def init_logger(is_quiet):
                     "stream": "ext://sys.stdout"
                 },
 
-                "info_file_handler": {
-                    "class": "logging.handlers.RotatingFileHandler",
-                    "level": "INFO",
-                    "formatter": "simple",
-                    "filename": "info.log",
-                    "maxBytes": 1048576,
-                    "backupCount": 20,
-                    "encoding": "utf8"
-                },
+                "info_file_handler": _file_handler("INFO", "info." + file_ext, file_formatter),
 
-                "error_file_handler": {
-                    "class": "logging.handlers.RotatingFileHandler",
-                    "level": "ERROR",
-                    "formatter": "simple",
-                    "filename": "errors.log",
-                    "maxBytes": 1048576,
-                    "backupCount": 20,
-                    "encoding": "utf8"
-                }
+                "error_file_handler": _file_handler("ERROR", "errors." + file_ext, file_formatter)
             },
 
             "loggers": {
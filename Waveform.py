@@ -0,0 +1,313 @@
+import array
+import bisect
+import collections
+import logging
+import threading
+import time
+
+# Hardware-timed step output. A planned profile is compiled into chunks of pulse descriptors - (on mask, off
+# mask, delay in us) triplets in the style of pigpio waveforms - which a backend plays out on its own timing,
+# so step rate is no longer bound by the Python step loop. Python only keeps a few chunks queued ahead and
+# polls progress; position is derived from the compiled schedule of the chunk being played.
+#
+# Backends: 'pigpio' (needs the pigpiod daemon and the pigpio module), 'sim' (local thread playing chunks in
+# real time without touching pins, for tests and development). The daemon transmits one waveform at a time and
+# wave ids are global to it, so motors share one backend per daemon connection and take turns on it - a move
+# that finds it busy runs on the step loop instead.
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_shared = {}                # pigpio host -> shared backend
+_cleared = set()            # pigpio hosts whose leftover waves were cleared by this process
+
+CHUNK_STEPS = 1500          # steps per chunk, two pulses each
+AHEAD = 2                   # chunks queued beyond the one playing
+# In flight are (AHEAD + 1) * CHUNK_STEPS * 2 = 9000 pulses, kept clear of the 12000 pulse default of pigpiod
+PULSE_WIDTH = 5e-6          # s step pulse high time, shortened for faster steps
+MIN_GAP = 2e-6              # s low time kept between pulses
+POLL_INTERVAL = 0.001       # s between progress polls while playing
+
+Chunk = collections.namedtuple('Chunk', 'pulses steps offsets duration')
+
+
+class WaveformException(Exception):
+    pass
+
+
+def compile_chunks(delays, pin, chunk_steps=CHUNK_STEPS, width=PULSE_WIDTH):
+    """
+    Compiles profile delays (s after each step, as planned for the step loop) into pulse chunks. Step times
+    are rounded to whole us on the accumulated schedule, so rounding does not add up over long moves
+    :param pin: BCM step pin
+    :return: generator of Chunk - flat array of (on mask, off mask, us) triplets, number of steps, array of
+             step start offsets (s) within the chunk, and chunk duration (s)
+    """
+    mask = 1 << pin
+    total = 0.0
+    last_us = 0
+    for first in range(0, len(delays), chunk_steps):
+        pulses = array.array('I')
+        offsets = array.array('d')
+        chunk_start = last_us
+        for d in delays[first:first + chunk_steps]:
+            offsets.append((last_us - chunk_start) * 1e-6)
+            total += d
+            end_us = int(round(total * 1e6))
+            period = max(end_us - last_us, int(round((width + MIN_GAP) * 1e6)))
+            high = max(1, min(int(round(width * 1e6)), period // 2))
+            pulses.extend((mask, 0, high, 0, mask, period - high))
+            last_us += period
+        yield Chunk(pulses, len(offsets), offsets, (last_us - chunk_start) * 1e-6)
+
+
+class _Backend:
+    """
+    Exclusive use of a backend for one move at a time
+    """
+    def __init__(self):
+        self._owner = threading.Lock()
+        self.users = 0
+
+    def acquire(self):
+        """
+        :return: True if taken, False if another move is playing on it
+        """
+        return self._owner.acquire(blocking=False)
+
+    def release(self):
+        self._owner.release()
+
+
+class SimBackend(_Backend):
+    """
+    Plays chunks in real time on a local thread, without output - stands in for the waveform daemon
+    """
+    def __init__(self):
+        super().__init__()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._done = 0
+        self._current_start = None
+        self._stopped = False
+        self._thread = threading.Thread(name='waveform_sim', target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while not self._queue:
+                    self._cond.wait()
+                chunk = self._queue[0]
+                self._current_start = start = time.perf_counter()
+                while not self._stopped:
+                    remaining = chunk.duration - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    self._queue.clear()
+                    self._stopped = False
+                else:
+                    self._queue.popleft()
+                    self._done += 1
+                self._current_start = None
+                self._cond.notify_all()
+
+    def reset(self):
+        with self._cond:
+            self._done = 0
+
+    def send(self, chunk):
+        with self._cond:
+            self._queue.append(chunk)
+            self._cond.notify_all()
+
+    def status(self):
+        """
+        :return: (chunks completed, perf_counter start time of chunk playing or None)
+        """
+        with self._cond:
+            return self._done, self._current_start
+
+    def stop(self):
+        """
+        :return: (chunks completed, start time of chunk playing or None, perf_counter time output stopped)
+        """
+        with self._cond:
+            # Playing thread waits on the condition, so it can not advance past this point
+            snapshot = (self._done, self._current_start, time.perf_counter())
+            if self._queue:
+                self._stopped = True
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: not self._stopped, 1.0)
+        return snapshot
+
+    def close(self):
+        self.stop()
+
+
+class PigpioBackend(_Backend):
+    """
+    Plays chunks as chained pigpio waveforms (one-shot sync mode, so each starts as the previous one ends)
+    """
+    def __init__(self, host='localhost'):
+        super().__init__()
+        try:
+            import pigpio
+        except ImportError:
+            raise WaveformException('pigpio module is not installed')
+        self._pigpio = pigpio
+        self._pi = pigpio.pi(host)
+        if not self._pi.connected:
+            raise WaveformException('pigpiod is not running on {}'.format(host))
+        # Waves left by a previous run are cleared once - later connections (config reload) would delete the
+        # ones another motor is playing
+        if host not in _cleared:
+            self._pi.wave_clear()
+            _cleared.add(host)
+        self._waves = []            # wave ids sent and not yet deleted, oldest first
+        self._done = 0
+        self._times = {}            # wave id -> (perf_counter start, end) expected when it was sent
+        self._end = 0.0             # expected end of the last wave sent
+
+    def reset(self):
+        self._done = 0
+
+    def send(self, chunk):
+        pulse = self._pigpio.pulse
+        p = chunk.pulses
+        self._pi.wave_add_generic([pulse(p[n], p[n + 1], p[n + 2]) for n in range(0, len(p), 3)])
+        wid = self._pi.wave_create()
+        if wid < 0:
+            raise WaveformException('pigpio wave_create failed with {}'.format(wid))
+        self._pi.wave_send_using_mode(wid, self._pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+        # Sync mode starts the wave as the previous one ends, or right away if the chain already ran dry. Start
+        # is taken once the send returned, so it lags the real one by the send latency at most
+        start = max(time.perf_counter(), self._end)
+        self._end = start + chunk.duration
+        self._times[wid] = (start, self._end)
+        self._waves.append(wid)
+
+    def status(self):
+        at = self._pi.wave_tx_at()
+        busy = self._pi.wave_tx_busy()
+        finished = len(self._waves) if not busy else (self._waves.index(at) if at in self._waves else 0)
+        for wid in self._waves[:finished]:
+            self._pi.wave_delete(wid)
+            del self._times[wid]
+        self._waves = self._waves[finished:]
+        self._done += finished
+        if not busy or not self._waves:
+            return self._done, None
+        return self._done, self._times[self._waves[0]][0]
+
+    def stop(self):
+        """
+        :return: (chunks completed, start time of chunk playing or None, perf_counter time output stopped),
+                 placed on the schedule expected at send - the daemon no longer reports progress once stopped
+        """
+        self._pi.wave_tx_stop()
+        stopped_at = time.perf_counter()
+        done, started = self._done, None
+        for wid in self._waves:
+            start, end = self._times[wid]
+            if end > stopped_at:
+                started = start if start <= stopped_at else None
+                break
+            done += 1
+        for wid in self._waves:
+            self._pi.wave_delete(wid)
+        self._waves = []
+        self._times = {}
+        return done, started, stopped_at
+
+    def close(self):
+        self.stop()
+        self._pi.stop()
+
+
+def open_backend(name, host='localhost'):
+    """
+    :param name: 'pigpio' or 'sim'
+    :return: backend, shared with other motors for the same pigpio daemon - hand back with close_backend
+    """
+    with _lock:
+        if name == 'sim':
+            backend = SimBackend()
+        elif name == 'pigpio':
+            backend = _shared.get(host)
+            if backend is None:
+                backend = _shared[host] = PigpioBackend(host)
+        else:
+            raise WaveformException('Unknown waveform backend {}'.format(name))
+        backend.users += 1
+    return backend
+
+
+def close_backend(backend):
+    """
+    Closes backend once its last motor is done with it
+    """
+    with _lock:
+        backend.users -= 1
+        if backend.users > 0:
+            return
+        for host, b in list(_shared.items()):
+            if b is backend:
+                del _shared[host]
+    backend.close()
+
+
+class PulseTrain:
+    """
+    Feeds compiled chunks of one move to a backend and tracks how many steps were played
+    """
+    def __init__(self, backend, delays, pin):
+        self.backend = backend
+        self.total = len(delays)
+        self._chunks = compile_chunks(delays, pin)
+        self._steps = [0]           # steps before each sent chunk
+        self._offsets = []          # step offsets of each sent chunk
+        backend.reset()
+
+    def pump(self):
+        """
+        Sends chunks until AHEAD are queued beyond the one playing
+        :return: True while chunks remain to be sent
+        """
+        done, _ = self.backend.status()
+        while len(self._offsets) - done <= AHEAD:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            self.backend.send(chunk)
+            self._offsets.append(chunk.offsets)
+            self._steps.append(self._steps[-1] + chunk.steps)
+        return True
+
+    def steps_done(self):
+        """
+        :return: steps started so far, from completed chunks plus the schedule of the one playing
+        """
+        done, started = self.backend.status()
+        return self._steps_at(done, started, time.perf_counter())
+
+    # Steps started by time t, with done chunks completed and the next one playing since started
+    def _steps_at(self, done, started, t):
+        steps = self._steps[min(done, len(self._offsets))]
+        if started is not None and done < len(self._offsets):
+            steps += bisect.bisect_right(self._offsets[done], t - started)
+        return min(steps, self.total)
+
+    def finished(self):
+        return self.backend.status()[0] >= len(self._offsets) and self._steps[-1] >= self.total
+
+    def stop(self):
+        """
+        Stops output at once
+        :return: steps done by the time output stopped
+        """
+        done, started, stopped_at = self.backend.stop()
+        return self._steps_at(done, started, stopped_at)
@@ -1,14 +1,27 @@
 import collections
 import datetime
 import logging
+import math
+import queue
 import socket
+import threading
+import time
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, g, render_template, jsonify, request
 from werkzeug.serving import WSGIRequestHandler
 
 import GPIOMgr
+import History
 import Main
+import Metrics
+import Profiler
+import Recorder
+import Scan
 import Stepper
+import Supervisor
+import Trace
+import Trajectory
+import Tuning
 import Util
 
 app = Flask(__name__)
@@ -17,9 +30,34 @@ app = Flask(__name__)
 logger = logging.getLogger("IOTAPI-worker")
 
 
-def init_flask():
+def init_flask(port=8080):
     WSGIRequestHandler.protocol_version = "HTTP/1.1"
-    app.run(host='0.0.0.0', port=8080, use_reloader=False, debug=False, threaded=True)
+    app.run(host='0.0.0.0', port=port, use_reloader=False, debug=False, threaded=True)
+
+
+@app.before_request
+def request_timer_start():
+    g.t_start = time.perf_counter()
+    if Recorder.recording():
+        Recorder.record(request.method, request.full_path if request.query_string else request.path,
+                        request.get_data(), request.is_json)
+    if Profiler.current is not None:
+        g.profile = Profiler.attach(Profiler.WEB)
+
+
+@app.after_request
+def request_timer_stop(response):
+    if 't_start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        Metrics.http_latency.observe(time.perf_counter() - g.t_start, route, request.method)
+    return response
+
+
+@app.teardown_request
+def request_profile_stop(exc):
+    token = g.pop('profile', None)
+    if token is not None:
+        Profiler.detach(token)
 
 
 @app.route("/")
@@ -118,7 +156,334 @@ def web_motor_command_move():
         if 'force' in content and str(content['force']) == '1':
             logger.debug('M %s - this will be a FORCED move', motor.uuid)
             force = True
-        return motor.move(direction, steps, block, force)
+        start_at = None
+        if 'start_at' in content:
+            try:
+                start_at = float(content['start_at'])
+            except (TypeError, ValueError):
+                start_at = float('nan')
+            if not (start_at - time.time() < Stepper.Stepper.MAX_SCHEDULE_AHEAD):
+                logger.warning('Invalid start time specified!')
+                return 'Invalid start time specified!', 400
+            logger.debug('M %s - move scheduled to start at %f', motor.uuid, start_at)
+        triggers = None
+        if 'triggers' in content:
+            if motor.PIN_TRIGGER is None:
+                return 'Motor {} has no trigger output configured'.format(motor.uuid), 400
+            try:
+                triggers = [int(p) for p in content['triggers']]
+                assert len(triggers) <= Stepper.Stepper.MAX_TRIGGERS
+            except:
+                return 'Bad triggers parameter specified', 400
+            logger.debug('M %s - %d position triggers requested', motor.uuid, len(triggers))
+        try:
+            return motor.move(direction, steps, block, force, start_at, triggers)
+        except Stepper.SoftLimitException as e:
+            logger.warning('M %s - %s', motor.uuid, e)
+            return str(e), 400
+
+
+@app.route("/move_to/", methods=['POST'])
+def web_motor_command_move_to():
+    """
+    Absolute move - json with uuid and pos, in steps or with units=1 in user units (step_size per step)
+    """
+    logger.debug("Incoming move_to command %s", request.data)
+    content = request.get_json(force=False, silent=True)
+    if not request.is_json or content is None:
+        logger.warning('Did not receive valid json!')
+        return 'Did not receive valid json!', 400
+    if 'uuid' not in content:
+        logger.warning('No motor specified!')
+        return 'No motor specified!', 400
+    mtnum = content['uuid']
+    if mtnum not in GPIOMgr.motors.keys():
+        logger.warning('Nonexistent motor uuid specified!')
+        return 'Nonexistent motor uuid specified!', 400
+    motor = GPIOMgr.motors[mtnum]
+    try:
+        target = float(content['pos'])
+        assert math.isfinite(target)
+    except:
+        return 'Bad pos parameter specified', 400
+    units = str(content.get('units', 0)) == '1'
+    block = str(content.get('block', 0)) == '1'
+    logger.info('M %s - move to %s%s ordered in state %s', motor.uuid, target, ' units' if units else '',
+                motor.state_hr())
+    if not (motor.state == Stepper.IDLE or motor.state == Stepper.MOVING):
+        logger.warning('M %s - in bad state %s', motor.uuid, motor.state_hr())
+        return 'Motor {} in bad state {}'.format(motor.uuid, motor.state_hr()), 500
+    try:
+        return motor.move_to(target, block, units)
+    except Stepper.SoftLimitException as e:
+        logger.warning('M %s - %s', motor.uuid, e)
+        return str(e), 400
+    except AssertionError:
+        return 'Move too long', 400
+
+
+@app.route("/home/", methods=['POST'])
+def web_motor_command_home():
+    logger.debug("Incoming home command %s", request.data)
+    content = request.get_json(force=False, silent=True)
+    if not request.is_json or content is None:
+        logger.warning('Did not receive valid json!')
+        return 'Did not receive valid json!', 400
+    if 'uuid' not in content:
+        logger.warning('No motor specified!')
+        return 'No motor specified!', 400
+    mtnum = content['uuid']
+    if mtnum not in GPIOMgr.motors.keys():
+        logger.warning('Nonexistent motor uuid specified!')
+        return 'Nonexistent motor uuid specified!', 400
+    motor = GPIOMgr.motors[mtnum]
+    try:
+        direction = int(content.get('dir', Stepper.Stepper.DIR_DN))
+        assert direction in [0, 1]
+    except:
+        return 'Bad dir parameter specified', 400
+    logger.info('M %s - home in dir %s ordered in state %s', motor.uuid, direction, motor.state_hr())
+    if not motor.state == Stepper.IDLE:
+        logger.warning('M %s - in bad state %s', motor.uuid, motor.state_hr())
+        return 'Motor {} in bad state {}'.format(motor.uuid, motor.state_hr()), 500
+    else:
+        return 'Done' if motor.home(direction) else 'Failed'
+
+
+@app.route("/range/", methods=['POST'])
+def web_motor_command_range():
+    logger.debug("Incoming range check command %s", request.data)
+    content = request.get_json(force=False, silent=True)
+    if not request.is_json or content is None:
+        logger.warning('Did not receive valid json!')
+        return 'Did not receive valid json!', 400
+    if 'uuid' not in content:
+        logger.warning('No motor specified!')
+        return 'No motor specified!', 400
+    mtnum = content['uuid']
+    if mtnum not in GPIOMgr.motors.keys():
+        logger.warning('Nonexistent motor uuid specified!')
+        return 'Nonexistent motor uuid specified!', 400
+    motor = GPIOMgr.motors[mtnum]
+    logger.info('M %s - range check ordered in state %s', motor.uuid, motor.state_hr())
+    if not motor.state == Stepper.IDLE or not motor.homed:
+        logger.warning('M %s - in bad state %s (homed %s)', motor.uuid, motor.state_hr(), motor.homed)
+        return 'Motor {} in bad state {} or not homed'.format(motor.uuid, motor.state_hr()), 500
+    elif motor.check_range():
+        return jsonify({motor.uuid: motor.travel_range})
+    else:
+        return 'Failed'
+
+
+@app.route("/trajectory/", methods=['GET', 'POST'], strict_slashes=False)
+def web_motor_trajectory():
+    """
+    Binary trajectory upload - body is raw '<iI' segments, motor given as ?uuid=. Starts new trajectory, or with
+    append=1 adds chunk to the queued or running one. final=1 marks the last chunk, which must end at or below
+    the motor's start speed (start_speed in motor state) - usually with a dwell segment. GET returns buffer status.
+    """
+    try:
+        mtnum = int(request.args['uuid'])
+    except:
+        logger.warning('No motor specified!')
+        return 'No motor specified!', 400
+    if mtnum not in GPIOMgr.motors.keys():
+        logger.warning('Nonexistent motor uuid specified!')
+        return 'Nonexistent motor uuid specified!', 400
+    motor = GPIOMgr.motors[mtnum]
+    if request.method == 'GET':
+        if motor.trajectory is None:
+            return 'No trajectory uploaded', 404
+        return jsonify(motor.trajectory.status())
+    data = request.get_data()
+    final = request.args.get('final') == '1'
+    try:
+        if request.args.get('append') == '1':
+            buf = motor.append_trajectory(data, final)
+        else:
+            logger.info('M %s - trajectory of %d bytes ordered in state %s', motor.uuid, len(data),
+                        motor.state_hr())
+            if not (motor.state == Stepper.IDLE or motor.state == Stepper.MOVING):
+                logger.warning('M %s - in bad state %s', motor.uuid, motor.state_hr())
+                return 'Motor {} in bad state {}'.format(motor.uuid, motor.state_hr()), 500
+            buf = motor.run_trajectory(data, final)
+    except Trajectory.BufferFull as e:
+        return str(e), 503
+    except Trajectory.TrajectoryException as e:
+        logger.warning('M %s - trajectory rejected: %s', motor.uuid, e)
+        return str(e), 400
+    except Stepper.SoftLimitException as e:
+        logger.warning('M %s - trajectory rejected: %s', motor.uuid, e)
+        return str(e), 400
+    except queue.Full:
+        return 'Queue full', 503
+    return jsonify(buf.status())
+
+
+@app.route("/simulate/", methods=['GET', 'POST'], strict_slashes=False)
+def web_simulate():
+    """
+    Dry run of motion planner, nothing is moved. Takes steps with jerk/vel/acc (defaulting to those of motor
+    given by uuid), and profile=1 to include the delay list. With uuid, also predicts when the motor queue drains
+    and lists (pulses, fine steps per pulse) phases of moves split for microstep switching.
+    """
+    content = request.get_json(force=False, silent=True) if request.is_json else request.args.to_dict()
+    if content is None:
+        logger.warning('Did not receive valid json!')
+        return 'Did not receive valid json!', 400
+    motor = None
+    if 'uuid' in content:
+        try:
+            motor = GPIOMgr.motors[int(content['uuid'])]
+        except:
+            logger.warning('Nonexistent motor uuid specified!')
+            return 'Nonexistent motor uuid specified!', 400
+    elif 'steps' not in content:
+        return 'Specify steps and/or uuid', 400
+    results = {}
+    if 'steps' in content:
+        try:
+            steps = int(content['steps'])
+            assert 0 <= steps < 100000
+            jerk, vel, acc = [float(content[k]) if k in content else getattr(motor, k)
+                              for k in ('jerk', 'vel', 'acc')]
+            assert 0 <= jerk <= 10000 and 0 < vel <= 10000 and 0 < acc <= 10000
+        except:
+            return 'Bad steps or motion parameters specified', 400
+        delays, summary = Stepper.plan_profile(steps, jerk, vel, acc)
+        results['plan'] = dict(summary)
+        if motor is not None:
+            results['plan']['estimate'] = summary['duration'] + steps * motor.step_overhead
+            # Long moves of motors with microstep switching run as fine/coarse/fine phases instead
+            phases = motor._microstep_phases(steps)
+            if len(phases) > 1:
+                results['plan']['phases'] = phases
+                results['plan']['estimate'] = motor._estimate_phases(phases)
+        if str(content.get('profile', 0)) == '1':
+            results['plan']['delays'] = delays.tolist()
+    if motor is not None:
+        results['queue'] = motor.queue_eta()
+    return jsonify(results)
+
+
+@app.route("/triggers/", strict_slashes=False)
+def web_motor_triggers():
+    """
+    Position-compare trigger report of last move with triggers, motor given as ?uuid=
+    """
+    try:
+        mtnum = int(request.args['uuid'])
+    except:
+        logger.warning('No motor specified!')
+        return 'No motor specified!', 400
+    if mtnum not in GPIOMgr.motors.keys():
+        logger.warning('Nonexistent motor uuid specified!')
+        return 'Nonexistent motor uuid specified!', 400
+    report = GPIOMgr.motors[mtnum].trigger_times()
+    if report is None:
+        return 'No triggered move done', 404
+    return jsonify(report)
+
+
+@app.route("/scan/", methods=['GET', 'POST'], strict_slashes=False)
+def web_scan():
+    """
+    Starts raster scan - json with uuids (motor per coordinate) and either points (list of absolute positions)
+    or grid (list of [start, stop, num] per motor, with optional snake=0), plus optional dwell (s),
+    trigger_pin and trigger_width (ms). GET returns state and per point report, from ?since=<index>.
+    """
+    if request.method == 'GET':
+        if Scan.current is None:
+            return 'No scan started', 404
+        try:
+            since = int(request.args.get('since', 0))
+        except ValueError:
+            return 'Bad since parameter', 400
+        return jsonify(Scan.current.status(since))
+    logger.debug("Incoming scan command %s", request.data)
+    content = request.get_json(force=False, silent=True)
+    if not request.is_json or content is None:
+        logger.warning('Did not receive valid json!')
+        return 'Did not receive valid json!', 400
+    try:
+        motors = [GPIOMgr.motors[u] for u in content['uuids']]
+    except:
+        logger.warning('Nonexistent or no motor uuids specified!')
+        return 'Nonexistent or no motor uuids specified!', 400
+    for motor in motors:
+        if not motor.state == Stepper.IDLE or not motor.queue.empty():
+            logger.warning('M %s - in bad state %s', motor.uuid, motor.state_hr())
+            return 'Motor {} in bad state {}'.format(motor.uuid, motor.state_hr()), 500
+    if Tuning.current is not None and Tuning.current.state == Tuning.RUNNING:
+        return 'Tuning is running', 500
+    try:
+        if 'grid' in content:
+            points = Scan.grid_points(content['grid'], str(content.get('snake', 1)) == '1')
+        else:
+            points = content['points']
+        trigger_pin = content.get('trigger_pin')
+        job = Scan.start(motors, points, float(content.get('dwell', 0)),
+                         int(trigger_pin) if trigger_pin is not None else None,
+                         float(content.get('trigger_width', 1)) / 1000)
+    except (Scan.ScanException, KeyError, TypeError, ValueError) as e:
+        logger.warning('Scan rejected: %s', e)
+        return 'Scan rejected: {}'.format(e), 400
+    logger.info('Scan of %d points over motors %s started', len(job.points), content['uuids'])
+    return jsonify(job.status())
+
+
+@app.route("/tune/", methods=['GET', 'POST'], strict_slashes=False)
+def web_tune():
+    """
+    Starts velocity/acceleration tuning - json with uuids, plus optional distance (steps), cycles, tolerance
+    (steps of drift) and margin (fraction). GET returns state, trials and recommended parameters.
+    """
+    if request.method == 'GET':
+        if Tuning.current is None:
+            return 'No tuning started', 404
+        return jsonify(Tuning.current.status())
+    logger.debug("Incoming tuning command %s", request.data)
+    content = request.get_json(force=False, silent=True)
+    if not request.is_json or content is None:
+        logger.warning('Did not receive valid json!')
+        return 'Did not receive valid json!', 400
+    try:
+        motors = [GPIOMgr.motors[u] for u in content['uuids']]
+    except:
+        logger.warning('Nonexistent or no motor uuids specified!')
+        return 'Nonexistent or no motor uuids specified!', 400
+    for motor in motors:
+        if not motor.state == Stepper.IDLE or not motor.queue.empty():
+            logger.warning('M %s - in bad state %s', motor.uuid, motor.state_hr())
+            return 'Motor {} in bad state {}'.format(motor.uuid, motor.state_hr()), 500
+    if Scan.current is not None and Scan.current.state == Scan.RUNNING:
+        return 'Scan is running', 500
+    try:
+        job = Tuning.start(motors, int(content.get('distance', 5000)), int(content.get('cycles', 3)),
+                           int(content.get('tolerance', 2)), float(content.get('margin', 0.2)))
+    except (Tuning.TuningException, TypeError, ValueError) as e:
+        logger.warning('Tuning rejected: %s', e)
+        return 'Tuning rejected: {}'.format(e), 400
+    logger.info('Tuning of motors %s started', content['uuids'])
+    return jsonify(job.status())
+
+
+@app.route("/tune/write", methods=['POST'])
+def web_tune_write():
+    """
+    Writes copy of worker config with recommended motion parameters of finished tuning next to the config file
+    """
+    job = Tuning.current
+    if job is None or job.state == Tuning.RUNNING:
+        return 'No finished tuning', 409
+    try:
+        path = Tuning.write_config(job)
+    except Tuning.TuningException as e:
+        return str(e), 409
+    except (OSError, KeyError) as e:
+        logger.exception('Writing tuned config failed')
+        return 'Writing tuned config failed: {}'.format(e), 500
+    return jsonify({'path': path, 'recommended': {uuid: r['recommended'] for uuid, r in job.results.items()}})
 
 
 @app.route("/config/motion", methods=['POST'])
@@ -176,6 +541,23 @@ def web_config_motion():
         return 'OK'
 
 
+@app.route("/config/reload", methods=['POST'])
+def web_config_reload():
+    """
+    Re-read config file, reinitializing only motors whose settings changed
+    """
+    logger.info("Config reload requested")
+    try:
+        actions = Main.reload_config()
+    except Main.ConfigException as e:
+        logger.warning('Config reload rejected - %s', e)
+        return 'Config reload rejected: {}'.format(e), 500
+    except Exception as e:
+        logger.exception('Config reload failed')
+        return 'Invalid config: {}'.format(e), 400
+    return jsonify(actions)
+
+
 @app.route("/enable/", methods=['POST'])
 def web_motor_command_enable():
     logger.debug("Incoming enable command: %s", request.data)
@@ -248,23 +630,49 @@ def web_motor_abort():
             mt = GPIOMgr.motors[mtnum]
     mts = [mt] if mt else GPIOMgr.motors.values()
     results = {}
+    # Scan would otherwise go on to the next point
+    if (mt is None or (Scan.current is not None and mt in Scan.current.motors)) and Scan.abort():
+        logger.info('Running scan aborted')
+    if (mt is None or (Tuning.current is not None and mt in Tuning.current.motors)) and Tuning.abort():
+        logger.info('Running tuning aborted')
     for mt in mts:
         state = mt.state
         if state == Stepper.UNINITIALIZED:
             logger.warning('M %s - attempt to stop while UNINITIALIZED', mt.uuid)
             results[mt.uuid] = 'Failed, uninitialized!'
-        elif state == Stepper.IDLE:
-            logger.warning('M %s - attempt to stop while IDLE', mt.uuid)
-            results[mt.uuid] = 'Failed, already idle!'
+        elif mt.stop():
+            # Stop goes out before any logging, commands in flight may be between state changes
+            logger.info('STOP for motor %s in state %s', mt.uuid, Stepper.STATES_STR[state])
+            results[mt.uuid] = 'OK'
         elif state == Stepper.DISABLED:
             logger.warning('M %s - attempt to stop while DISABLED', mt.uuid)
             results[mt.uuid] = 'Failed, already disabled!'
         else:
-            logger.info('STOP for motor %s in state %s', mt.uuid, state_hr())
-            results[mt.uuid] = 'OK' if mt.stop() else 'FAIL'
+            logger.warning('M %s - attempt to stop while IDLE', mt.uuid)
+            results[mt.uuid] = 'Failed, already idle!'
     return jsonify(results)
 
 
+@app.route("/estop/", methods=['POST'], strict_slashes=False)
+def web_estop():
+    """
+    Latches global ESTOP interlock and preempts all motors at once, or releases the latch with clear=1
+    :return:
+    """
+    content = request.get_json(force=False, silent=True)
+    if content is not None and str(content.get('clear')) == '1':
+        logger.warning('ESTOP latch cleared')
+        Stepper.Stepper.ESTOP = False
+        return jsonify({'estop': False})
+    # Interlock flag is shared by all motors, so set it before fanning out stop events
+    Stepper.Stepper.ESTOP = True
+    Scan.abort()
+    Tuning.abort()
+    results = Supervisor.preempt_all()
+    logger.critical('ESTOP engaged, preempted %s', results)
+    return jsonify({'estop': True, 'preempted': results})
+
+
 @app.route("/shutdown/", methods=['POST'], strict_slashes=False)
 def web_shutdown():
     shutdown()
@@ -278,7 +686,128 @@ def shutdown():
     func()
 
 
+@app.route("/metrics", strict_slashes=False)
+def web_metrics():
+    """
+    Runtime counters in Prometheus text exposition format
+    """
+    return Response(Metrics.render(), content_type=Metrics.CONTENT_TYPE)
+
+
+@app.route("/history/", strict_slashes=False)
+def web_history():
+    """
+    Executed command history, newest first - filtered by optional uuid, cmd, since and until (wall time s),
+    paged by limit and before=<next from previous page>. With events=1 returns interlock transitions instead.
+    """
+    if not History.enabled():
+        return 'History is disabled', 404
+    try:
+        uuid = int(request.args['uuid']) if 'uuid' in request.args else None
+        since, until = [float(request.args[k]) if k in request.args else None for k in ('since', 'until')]
+        before = int(request.args['before']) if 'before' in request.args else None
+        limit = int(request.args.get('limit', 100))
+        assert 0 < limit <= History.MAX_PAGE
+    except:
+        return 'Bad history query parameters', 400
+    if request.args.get('events') == '1':
+        rows = History.interlocks(uuid, since, until, before, limit)
+    else:
+        rows = History.commands(uuid, since, until, request.args.get('cmd'), before, limit)
+    return jsonify({'entries': rows, 'next': rows[-1]['id'] if len(rows) == limit else None})
+
+
+@app.route("/history/prune", methods=['POST'])
+def web_history_prune():
+    """
+    Deletes history older than json days, by default the configured retention
+    """
+    if not History.enabled():
+        return 'History is disabled', 404
+    content = request.get_json(force=False, silent=True) or {}
+    try:
+        older_than = float(content['days']) * 86400 if 'days' in content else None
+        assert older_than is None or older_than >= 0
+        return jsonify(History.prune(older_than))
+    except (AssertionError, TypeError, ValueError) as e:
+        return 'Bad days parameter specified', 400
+
+
+@app.route("/profile/", methods=['GET', 'POST'], strict_slashes=False)
+def web_profile():
+    """
+    Starts profiling session - json with mode (sample or cprofile), scope ('web' or motor uuid), duration (s) and
+    for sampling interval (ms). GET returns state of the last session.
+    """
+    if request.method == 'GET':
+        if Profiler.current is None:
+            return 'No profiling started', 404
+        return jsonify(Profiler.current.status())
+    content = request.get_json(force=False, silent=True)
+    if not request.is_json or content is None:
+        logger.warning('Did not receive valid json!')
+        return 'Did not receive valid json!', 400
+    scope = content.get('scope', Profiler.WEB)
+    busy = []
+    if scope != Profiler.WEB:
+        if scope not in GPIOMgr.motors.keys():
+            logger.warning('Nonexistent motor uuid specified!')
+            return 'Nonexistent motor uuid specified!', 400
+        # Sampling picks up a command already running on the motor executor
+        if GPIOMgr.motors[scope].busy:
+            busy = [(t.ident, t.name) for t in threading.enumerate()
+                    if t.name.startswith('mt_thr_{}_'.format(scope))]
+    try:
+        session = Profiler.start(content.get('mode', Profiler.SAMPLE), scope, float(content.get('duration', 10)),
+                                 float(content.get('interval', 5)) / 1000, busy)
+    except (Profiler.ProfilerException, TypeError, ValueError) as e:
+        logger.warning('Profiling rejected: %s', e)
+        return 'Profiling rejected: {}'.format(e), 400
+    return jsonify(session.status())
+
+
+@app.route("/profile/stop", methods=['POST'])
+def web_profile_stop():
+    if not Profiler.stop():
+        return 'No profiling running', 409
+    return jsonify(Profiler.current.status())
+
+
+@app.route("/profile/result")
+def web_profile_result():
+    """
+    Download of last session result - collapsed stacks (sampling) or pstats file (cprofile)
+    """
+    session = Profiler.current
+    if session is None:
+        return 'No profiling started', 404
+    result = session.result()
+    if result is None:
+        return 'Nothing captured', 404
+    data, mimetype, filename = result
+    return Response(data, mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
 # Utility pages for debugging mostly
+@app.route("/trace/", strict_slashes=False)
+def web_dump_trace():
+    """
+    Dump motion event trace, as .npy (default) or raw binary records
+    """
+    fmt = request.args.get('format', 'npy')
+    if fmt == 'npy':
+        data, fname = Trace.dump_npy(), 'trace.npy'
+    elif fmt == 'bin':
+        data, fname = Trace.dump_binary(), 'trace.bin'
+    else:
+        return 'Unknown trace format', 400
+    if request.args.get('clear') == '1':
+        Trace.clear()
+    return Response(data, mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(fname)})
+
+
 @app.route("/config/")
 def web_dump_config():
     """
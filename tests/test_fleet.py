@@ -0,0 +1,139 @@
+import http.server
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import Fleet
+import Replay
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'client-configs',
+                      'iotapi-worker-prod-m3l.json')
+MOTOR = 1
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def position(fleet, name):
+    return fleet.status([name])[name]['body'][str(MOTOR)]['pos']
+
+
+def wait_idle(fleet, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        states = [r['body'][str(MOTOR)]['state'] for r in fleet.status().values()]
+        if all(s != 200 for s in states):
+            return
+        time.sleep(0.05)
+    raise AssertionError('Motors still moving')
+
+
+@pytest.fixture(scope='module')
+def fleet(tmp_path_factory):
+    ports = {'a': free_port(), 'b': free_port()}
+    # Workers write their logs to the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('workers'))
+    procs = []
+    fleet = Fleet.FleetCoordinator({name: '127.0.0.1:{}'.format(port) for name, port in ports.items()})
+    try:
+        try:
+            for port in ports.values():
+                procs.append(Replay.spawn_worker(CONFIG, port))
+        finally:
+            os.chdir(cwd)
+        assert all(r['ok'] for r in fleet.warm().values())
+        assert all(r[0]['ok'] for r in fleet.enable({'a': MOTOR, 'b': MOTOR}).values())
+        yield fleet
+    finally:
+        fleet.close()
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+
+def test_move_fans_out(fleet):
+    start = {name: position(fleet, name) for name in fleet.pools}
+    results = fleet.move({'a': {'uuid': MOTOR, 'dir': 1, 'steps': 200, 'block': 1},
+                          'b': {'uuid': MOTOR, 'dir': 1, 'steps': 300, 'block': 1}})
+    assert {name: r['body'] for name, r in results.items()} == {'a': 'Done', 'b': 'Done'}
+    assert position(fleet, 'a') == start['a'] + 200
+    assert position(fleet, 'b') == start['b'] + 300
+
+
+def test_synchronized_move(fleet):
+    start = {name: position(fleet, name) for name in fleet.pools}
+    start_at, results = fleet.synchronized_move({name: {'uuid': MOTOR, 'dir': 0, 'steps': 100, 'block': 1}
+                                                 for name in fleet.pools}, lead=1.0)
+    assert all(r['body'] == 'Done' for r in results.values())
+    for name in fleet.pools:
+        state = fleet.status([name])[name]['body'][str(MOTOR)]
+        assert state['pos'] == start[name] - 100
+        assert abs(state['skew']) < 0.05
+
+
+def test_stop_fans_out(fleet):
+    start = {name: position(fleet, name) for name in fleet.pools}
+    results = fleet.move({name: {'uuid': MOTOR, 'dir': 1, 'steps': 50000} for name in fleet.pools})
+    assert all(r['body'] == 'Queued' for r in results.values())
+    time.sleep(0.5)
+    assert all(r['ok'] for r in fleet.stop().values())
+    wait_idle(fleet)
+    for name in fleet.pools:
+        assert start[name] < position(fleet, name) < start[name] + 50000
+
+
+def test_estop_fans_out(fleet):
+    fleet.move({name: {'uuid': MOTOR, 'dir': 1, 'steps': 50000} for name in fleet.pools})
+    time.sleep(0.5)
+    results = fleet.estop()
+    assert all(r['ok'] and r['body']['estop'] for r in results.values())
+    wait_idle(fleet)
+    held = {name: position(fleet, name) for name in fleet.pools}
+    fleet.move({name: {'uuid': MOTOR, 'dir': 1, 'steps': 100, 'block': 1} for name in fleet.pools})
+    assert {name: position(fleet, name) for name in fleet.pools} == held
+    assert all(r['ok'] and not r['body']['estop'] for r in fleet.estop(clear=True).values())
+
+
+class _SlowHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    hits = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.hits.append(self.path)
+        time.sleep(0.5)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+        except OSError:
+            pass
+
+
+def test_timed_out_post_is_not_resent():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pool = Fleet.WorkerConnectionPool('127.0.0.1:{}'.format(server.server_port))
+    try:
+        # Pooled connection first, so a retry of reused connections would be possible
+        pool.warm()
+        with pytest.raises(TimeoutError):
+            pool.request('POST', '/move/', {'uuid': MOTOR, 'dir': 1, 'steps': 100}, timeout=0.1)
+        time.sleep(1.0)
+        assert _SlowHandler.hits == ['/move/']
+    finally:
+        pool.close()
+        server.shutdown()
+        server.server_close()